@@ -16,19 +16,154 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
 import sys
+from collections import namedtuple
+from math import pi
 import numpy as np
 
-from scipy import signal
-from scipy.constants import pi
-from scipy.constants import mu_0
-from scipy.optimize import curve_fit
+# The scipy modules take longer to load than anything else here, and most of
+# the programs that import this module only need a few of the functions. So
+# scipy.signal, scipy.optimize and scipy.constants are imported by the
+# functions that use them.
 
 import magscreen.semcsv as semcsv
+import magscreen.profiling as profiling
 
 perr = sys.stderr.write  # shorten a long function name
 
-def spectrum(vTime, vData):
+Gaps = namedtuple('Gaps', ['index', 'interval', 'period', 'missing'])
+
+# Welch segment length for tests that don't record one, see planner.py
+g_nSegLen = 256
+
+# Fit spectra from the sample times instead of the nominal rate, set by
+# set_use_times() or the MAGSCREEN_USE_TIMES environment variable
+g_bUseTimes = False
+
+def set_use_times(bUseTimes):
+	"""Choose how dipole_from_rotation() gets its spectra for fits run after
+	this call
+
+	Args:
+		bUseTimes (bool): If True the Offset sample times are used, see
+			spectrum_irregular(), otherwise the nominal Rate property.
+
+	Returns (bool): The previous setting
+	"""
+	global g_bUseTimes
+	bOld = g_bUseTimes
+	g_bUseTimes = bool(bUseTimes)
+	return bOld
+
+if os.environ.get('MAGSCREEN_USE_TIMES', '0') not in ('', '0'): set_use_times(True)
+
+def sample_gaps(vTime, rPeriod=None, rTol=0.25):
+	"""Find sample intervals that are far from the expected sampling period
+
+	Args:
+	vTime (ndarray, indexable, or semcsv.Variable)
+		The sample times in seconds
+
+	rPeriod (float)
+		The expected sampling period.  If None, the median sample interval is
+		used, which is not pulled upward by dropouts the way the mean is.
+
+	rTol (float)
+		Intervals outside of (1 - rTol, 1 + rTol) sampling periods are
+		reported.  Non-increasing times are always reported.
+
+	Returns: Gaps
+		A named tuple with the fields:
+
+		index    - Array of the indexes of the points that end a bad interval
+		interval - Array of the bad intervals in seconds
+		period   - The sampling period used for the check
+		missing  - Array of the estimated number of dropped samples in each
+		           bad interval (0 for short intervals)
+	"""
+	if isinstance(vTime, semcsv.Variable):
+		vTime = vTime.data
+	aTime = np.asarray(vTime, dtype=np.float64)
+
+	aDiff = np.diff(aTime)
+	if rPeriod is None:
+		rPeriod = np.median(aDiff) if len(aDiff) > 0 else 0.0
+
+	aBad = (aDiff <= 0) | (aDiff <= rPeriod*(1 - rTol)) | (aDiff >= rPeriod*(1 + rTol))
+	aIdx = np.flatnonzero(aBad)
+	aInterval = aDiff[aIdx]
+	if rPeriod > 0:
+		aMissing = np.maximum(np.rint(aInterval / rPeriod) - 1, 0).astype(int)
+	else:
+		aMissing = np.zeros(len(aIdx), dtype=int)
+
+	return Gaps(aIdx + 1, aInterval, rPeriod, aMissing)
+
+
+# Frequency grid oversampling for irregular sampling spectra
+LOMB_OVERSAMPLE = 4
+
+@profiling.timed('calc.spectrum_irregular')
+def spectrum_irregular(vTime, vData, nOver=LOMB_OVERSAMPLE):
+	"""Get the spectrum of an irregularly sampled signal.
+
+	Uses the Lomb-Scargle periodogram evaluated at the actual sample times so
+	that jitter and short dropouts do not need to be rejected.  The output is
+	scaled to match spectrum(), i.e. a sinusoid of amplitude A gives a peak
+	of A/sqrt(2).
+
+	Args:
+	vTime (ndarray, indexable, or semcsv.Variable)
+		The sample times in seconds.  Duplicate times are allowed.
+
+	vData (ndarray, indexable, or semcsv.Variable)
+		The time series data from which the spectrum should be derived.
+
+	nOver (int)
+		Frequency grid points per 1/T, where T is the total duration of the
+		time series.  The default keeps the peak scalloping loss small.
+
+	Returns: (frequencies, amplitudes)
+		frequencies - An array of frequencies in Hz, from 0 up to the Nyquist
+			frequency of the average sampling rate.
+
+		amplitudes - An array of values containing the square root of the power
+	"""
+	if isinstance(vTime, semcsv.Variable):
+		if vTime.units != 's':
+			raise ValueError("Unit conversion from %s to seconds is not implemented."%vTime.units)
+		vTime = vTime.data
+	if isinstance(vData, semcsv.Variable):
+		vData = vData.data
+
+	aTime = np.asarray(vTime, dtype=np.float64)
+	aData = np.asarray(vData, dtype=np.float64)
+
+	# Drop fill values, there is no reason to keep them without a fixed grid
+	aGood = np.isfinite(aTime) & np.isfinite(aData)
+	aTime = aTime[aGood]
+	aData = aData[aGood]
+
+	N = len(aTime)
+	rDur = aTime[-1] - aTime[0]
+	if (N < 2) or (rDur <= 0):
+		raise ValueError("At least two distinct sample times are required")
+
+	rNyquist = 0.5 * (N - 1) / rDur
+	aXf = np.arange(0, rNyquist, 1.0/(nOver*rDur))
+
+	from scipy import signal
+
+	aYf = np.zeros(len(aXf))
+	aData = aData - aData.mean()
+	aYf[1:] = np.sqrt(2.0 * signal.lombscargle(aTime, aData, 2*pi*aXf[1:]) / N)
+
+	return (aXf, aYf)
+
+
+@profiling.timed('calc.spectrum')
+def spectrum(vTime, vData, nSegLen=None):
 	"""Get the spectrum of a signal, ignoring the sampling period.
 	
 	Side Note: Though we don't return real frequency values we probably
@@ -39,10 +174,17 @@ def spectrum(vTime, vData):
 	Args:
 	vTime (float, indexable, or semcsv.Variable)
 		Either a real number representing the sampling frequency, or a 
-		Variable object with the sample times
+		Variable object with the sample times.  If the sample times are
+		irregular the result is computed by spectrum_irregular() instead.
 
 	vData (ndarray, indexable, or semcsv.Variable)
-		The time series data from which the PSD should be derived.
+		The time series data from which the PSD should be derived.  Floating
+		point arrays are used as is, so float32 data gives float32
+		amplitudes, anything else is converted to the semcsv data type.
+
+	nSegLen (int)
+		The Welch segment length, g_nSegLen if None.  Shorter signals are
+		taken as a single segment.  See planner.py for choosing a length.
 
 	Returns: (frequencies, amplitudes)
 		frequencies - An array of values containing frequency components as if
@@ -64,28 +206,172 @@ def spectrum(vTime, vData):
 
 		# Check for missing points, individual samples must be within 0.25
 		# average sampling periods
-		rHi = rPeriod * 1.25
-		rLo = rPeriod * 0.75
-		for i in range(len(vTime)-1):
-			rDiff = (vTime[i+1] - vTime[i])
-			if (rDiff < 0) or (rLo >= rDiff) or (rDiff >= rHi):
+		gaps = sample_gaps(vTime, rPeriod)
+		if len(gaps.index) > 0:
+			if np.any(gaps.interval < 0):
+				i = gaps.index[np.argmax(gaps.interval < 0)]
 				raise ValueError(
-					"Sampling period for point %d is %.2e, expected %.2e to %.2e"%(
-					i+1, rDiff, rLo, rHi
-				))
+					"Sample time for point %d is before the previous point"%i
+				)
+			perr("WARN:  %d sample intervals are outside %.2e to %.2e, %s\n"%(
+				len(gaps.index), rPeriod*0.75, rPeriod*1.25,
+				"using the irregular sampling spectrum."
+			))
+			return spectrum_irregular(vTime, vData)
 
 		rFreq = 1/rPeriod
 
 	if isinstance(vData, semcsv.Variable):
 		vData = vData.data
+	vData = np.asarray(vData)
+	if vData.dtype.kind != 'f': vData = vData.astype(semcsv.get_dtype())
 		
-	nSegLen = 256
+	from scipy import signal
+
+	if nSegLen is None: nSegLen = g_nSegLen
 	if len(vData) < nSegLen: nSegLen = len(vData)
 	(aXf, aYf) = signal.welch(vData, rFreq, window='flattop', nperseg=nSegLen, scaling='spectrum')
 	aYf = np.sqrt(aYf)
 
 	return (aXf, aYf)
 
+class WelchAccumulator:
+	"""Accumulate a Welch spectrum one chunk of samples at a time.
+
+	This produces the same output as spectrum() given a fixed sampling rate,
+	but samples are fed in pieces from a streaming source, such as
+	semcsv.read_chunks() or slices of a numpy.memmap.  Only the partial
+	segment at the end of each chunk is kept between calls, so memory use
+	does not grow with the length of the capture.
+
+	Example:
+		acc = WelchAccumulator(10.0)
+		for i in range(0, len(aMemMap), 4096):
+			acc.add(aMemMap[i:i+4096])
+		(aXf, aYf) = acc.result()
+	"""
+
+	def __init__(self, rFreq, nSegLen=g_nSegLen):
+		"""
+		Args:
+			rFreq (float): The sampling rate in Hz
+			nSegLen (int): Welch segment length, overlap is half of this
+		"""
+		from scipy import signal
+
+		self.rFreq = rFreq
+		self.nSegLen = nSegLen
+		self.nStep = nSegLen - nSegLen//2
+		self.aWin = signal.get_window('flattop', nSegLen)
+		self.aBuf = None     # Samples not yet used in a full segment
+		self.aSum = None     # Running sum of segment power spectra
+		self.nSegs = 0
+
+	def add(self, aChunk):
+		"""Add samples to the accumulation
+
+		Args:
+			aChunk (array-like): The next samples in time.  May be a 1-D array,
+				or an [N, K] array to accumulate K components at once.
+		"""
+		aChunk = np.asarray(aChunk)
+		if self.aBuf is None:
+			self.aBuf = aChunk.copy()
+		else:
+			self.aBuf = np.concatenate((self.aBuf, aChunk), axis=0)
+
+		nSegs = 0
+		if len(self.aBuf) >= self.nSegLen:
+			nSegs = (len(self.aBuf) - self.nSegLen) // self.nStep + 1
+		if nSegs == 0: return
+
+		# [nSegs, nSegLen, ...] copy of just the segments in this chunk
+		aIdx = (np.arange(nSegs)*self.nStep)[:,None] + np.arange(self.nSegLen)
+		aSegs = self.aBuf[aIdx]
+		aSegs = aSegs - aSegs.mean(axis=1, keepdims=True)
+		# Keep float32 chunks in float32, the window would promote them
+		aWin = self.aWin.astype(aSegs.dtype, copy=False)
+		aWin = aWin.reshape((-1,) + (1,)*(aSegs.ndim - 2))
+
+		aPow = np.abs(np.fft.rfft(aSegs * aWin, axis=1))**2
+		aPow = aPow.sum(axis=0)
+		if self.aSum is None: self.aSum = aPow
+		else: self.aSum += aPow
+		self.nSegs += nSegs
+
+		self.aBuf = self.aBuf[nSegs*self.nStep:].copy()
+
+	def result(self):
+		"""Get the spectrum of all samples added so far
+
+		Returns: (frequencies, amplitudes)
+			Same as for spectrum().  If fewer than nSegLen samples were added
+			the spectrum of a single shorter segment is returned, again to
+			match spectrum().
+		"""
+		if self.nSegs == 0:
+			if (self.aBuf is None) or (len(self.aBuf) == 0):
+				raise ValueError("No data values have been added")
+			from scipy import signal
+			(aXf, aYf) = signal.welch(
+				self.aBuf, self.rFreq, window='flattop', nperseg=len(self.aBuf),
+				scaling='spectrum', axis=0
+			)
+			return (aXf, np.sqrt(aYf))
+
+		aPow = self.aSum / (self.nSegs * float(self.aWin.sum())**2)
+
+		# One sided spectrum, double everything but DC and Nyquist
+		if self.nSegLen % 2: aPow[1:] *= 2
+		else: aPow[1:-1] *= 2
+
+		aXf = np.fft.rfftfreq(self.nSegLen, 1.0/self.rFreq)
+		return (aXf, np.sqrt(aPow))
+
+
+def spectrum_stream(rFreq, iChunks, nSegLen=g_nSegLen):
+	"""Get the spectrum of a signal delivered in chunks
+
+	Args:
+		rFreq (float): The sampling rate in Hz
+		iChunks (iterable): Yields arrays of samples in time order
+		nSegLen (int): Welch segment length
+
+	Returns: (frequencies, amplitudes)
+		Same as spectrum(rFreq, data, nSegLen) for the concatenated data.
+	"""
+	acc = WelchAccumulator(rFreq, nSegLen)
+	for aChunk in iChunks:
+		acc.add(aChunk)
+	return acc.result()
+
+
+def file_spectra(sFile, tComp=('Bx','By','Bz'), nRows=4096):
+	"""Get component spectra for each dataset in a file without loading
+	the whole file.
+
+	Args:
+		sFile (str): A semantic CSV file, as written by tlvmr.write_mag_vecs
+		tComp (tuple): The variables for which spectra are needed
+		nRows (int): Number of rows read at a time
+
+	Returns: list[(frequencies, amplitudes)]
+		One entry per dataset.  The amplitudes are an [F, len(tComp)] array.
+	"""
+	lAcc = None
+	for (dProps, lDs) in semcsv.read_chunks(sFile, nRows):
+		if lAcc is None:
+			lAcc = [
+				WelchAccumulator(ds.require('rate'), ds.nperseg or g_nSegLen) for ds in lDs
+			]
+
+		for i in range(len(lDs)):
+			if len(lDs[i].vars[tComp[0]].data) == 0: continue
+			lAcc[i].add( np.column_stack([lDs[i].vars[s].data for s in tComp]) )
+
+	if lAcc is None: return []
+	return [ acc.result() for acc in lAcc ]
+
 # ########################################################################## #
 
 def moment_from_bvec(r_meters, mag_Tesla, angleZ, angleX):
@@ -115,6 +401,7 @@ def moment_from_bvec(r_meters, mag_Tesla, angleZ, angleX):
 	Returns:
 		The magnetic dipole moment in [N m T**−1]
 	"""
+	from scipy.constants import mu_0
 	return (
 		( 4 * pi * r_meters**3 * mag_Tesla ) / 
 		( mu_0*np.sqrt( (3*np.cos(angleZ)*np.sin(angleZ)*np.cos(angleX))**2 
@@ -219,10 +506,100 @@ def bmag_from_moment(distance, moment):
 	Fixme: How is an angle not involved here?  Does this assume a moment in 
 	       the Z axis and the distance is in the x-y plane?
 	"""
+	from scipy.constants import mu_0
 	return ((mu_0 * moment) / (2*pi * distance**3))
 
 
-def dipole_from_rotation(lDsRaw):
+# ########################################################################## #
+# Ambient field rejection #
+
+def split_reference(lDs):
+	"""Separate far field reference sensor datasets from the near sensors
+
+	Datasets with a 'Role' property of 'reference' are reference sensors, all
+	others (including files written before the Role property existed) are
+	treated as near sensors.
+
+	Returns: (near_datasets, reference_dataset)
+		The reference dataset is None if there isn't one.  If more than one
+		reference is present only the first is returned.
+	"""
+	lNear = []
+	dsRef = None
+	for ds in lDs:
+		if ('Role' in ds.props) and (ds.props['Role'][0] == 'reference'):
+			if dsRef is None: dsRef = ds
+		else:
+			lNear.append(ds)
+	return (lNear, dsRef)
+
+
+@profiling.timed('calc.reject_ambient')
+def reject_ambient(lDsNear, dsRef, sMode='regress'):
+	"""Remove the ambient field seen by a far field reference sensor from a set
+	of near field sensors.
+
+	The reference data are interpolated onto each near sensor's Offset times.
+	Then either the reference variation is subtracted directly, or it is
+	regressed out of all three near components at once with a single least
+	squares solve.  Regression allows for differences in sensor orientation
+	and gain, subtraction assumes the sensors are aligned.
+
+	Args:
+		lDsNear (list[semcsv.Dataset]): Near sensor datasets
+		dsRef (semcsv.Dataset): The reference sensor dataset
+		sMode (str): Either 'subtract' or 'regress'
+
+	Returns (list[semcsv.Dataset]):
+		New datasets with cleaned Bx, By, Bz variables.  The input datasets are
+		not modified.  An 'Ambient' property records the mode and the
+		reference UART.
+	"""
+	if sMode not in ('subtract','regress'):
+		raise ValueError("Unknown ambient rejection mode '%s'"%sMode)
+
+	tComp = ('Bx','By','Bz')
+	aRefTime = dsRef.vars['Offset'].data
+	aRef = np.column_stack([ dsRef.vars[s].data for s in tComp ])
+	if len(aRefTime) < 2:
+		raise ValueError("Reference sensor has too few samples")
+
+	sRef = dsRef.props['UART'][2] if 'UART' in dsRef.props else '?'
+
+	lOut = []
+	for ds in lDsNear:
+		aTime = ds.vars['Offset'].data
+		aNear = np.column_stack([ ds.vars[s].data for s in tComp ])
+
+		# Time align, then remove the reference mean so only variations are
+		# taken out of the near sensor
+		aAmb = np.column_stack([
+			np.interp(aTime, aRefTime, aRef[:,i]) for i in range(3)
+		])
+		aAmb -= aAmb.mean(axis=0)
+
+		if sMode == 'subtract':
+			aClean = aNear - aAmb
+		else:
+			aDesign = np.column_stack((aAmb, np.ones(len(aTime))))
+			(aCoef, _res, _rank, _sv) = np.linalg.lstsq(aDesign, aNear, rcond=None)
+			aClean = aNear - aAmb @ aCoef[:3]
+
+		dProps = dict(ds.props)
+		dProps['Ambient'] = [sMode, sRef]
+		dVars = dict(ds.vars)
+		aClean = np.ascontiguousarray(aClean.T)   # One row per component
+		for i in range(3):
+			dVars[tComp[i]] = semcsv.Variable(aClean[i], ds.vars[tComp[i]].units)
+
+		lOut.append(semcsv.Dataset(dProps, dVars))
+
+	return lOut
+
+# ########################################################################## #
+
+@profiling.timed('calc.dipole_from_rotation')
+def dipole_from_rotation(lDsRaw, bUseTimes=None, sRefMode='regress'):
 	"""Calculate the dipole moment of an object slowly spinning in a magnetic
 	field.
 
@@ -248,7 +625,20 @@ def dipole_from_rotation(lDsRaw):
 		Offset_cm - Three component offsets from the external sensor
 		            casing to the center of each magnetometer, in centimeters.
 
-		More datasets are preferred, but a least two are required.
+		Nperseg - Optional, the Welch segment length for the spectra.  If
+		          missing g_nSegLen is used, see planner.py.
+
+		More datasets are preferred, but a least two are required.  Datasets
+		with a Role property of 'reference' are not used in the fit.
+
+	bUseTimes (bool): If True, spectra are computed from the actual Offset
+		sample times with spectrum_irregular() instead of from the nominal
+		'Rate' property.  This tolerates sampling jitter and short dropouts.
+		If None, the set_use_times() setting is used.
+
+	sRefMode (str): How a far field reference sensor, if present, is used to
+		reject the ambient field.  One of 'regress', 'subtract' or None to
+		ignore the reference.  See reject_ambient().
 
 	Returns:
 		(dist, rate, Zangle, Bdipole, moment, merror, Xangle)
@@ -266,6 +656,8 @@ def dipole_from_rotation(lDsRaw):
 		   the assumptions built into this calculation may not be correct.
 	"""
 
+	if bUseTimes is None: bUseTimes = g_bUseTimes
+
 	iX = 0
 	iY = 1
 	iZ = 2
@@ -281,6 +673,10 @@ def dipole_from_rotation(lDsRaw):
 	lXangle = []
 	lDipole = []  # Dipole in units of [N m T**-1]
 
+	(lDsRaw, dsRef) = split_reference(lDsRaw)
+	if (dsRef is not None) and sRefMode:
+		lDsRaw = reject_ambient(lDsRaw, dsRef, sRefMode)
+
 	for dataset in lDsRaw:
 
 		# Make sure all the component arrays are the same length
@@ -292,10 +688,18 @@ def dipole_from_rotation(lDsRaw):
 		lFreq = [None]*3
 		lAmp = [None]*3
 
-		for i in range(3):
-			(lFreq[i], lAmp[i]) = spectrum(
-				float(dataset.props['Rate'][0]), dataset.vars[tComp[i]]
-			)
+		if bUseTimes:
+			for i in range(3):
+				(lFreq[i], lAmp[i]) = spectrum_irregular(
+					dataset.vars['Offset'], dataset.vars[tComp[i]]
+				)
+			nBinTol = LOMB_OVERSAMPLE  # Grid is finer than the resolution
+		else:
+			for i in range(3):
+				(lFreq[i], lAmp[i]) = spectrum(
+					dataset.require('rate'), dataset.vars[tComp[i]], dataset.nperseg
+				)
+			nBinTol = 1
 
 		lMax = [ np.argmax(amp) for amp in lAmp ]
 		#perr("INFO:  %s, max freq %s\n"%(dataset.props['UART'][2], lMax))
@@ -304,7 +708,7 @@ def dipole_from_rotation(lDsRaw):
 		_temp = ('x','y','z')
 		for i in range(1,3):
 			freq_0 = lFreq[iX][lMax[iX]]
-			if abs(lMax[i] - lMax[iX]) > 1:
+			if abs(lMax[i] - lMax[iX]) > nBinTol:
 				
 				freq_N = lFreq[i][lMax[i]]
 
@@ -315,8 +719,8 @@ def dipole_from_rotation(lDsRaw):
 
 		lRate.append( (lFreq[0][lMax[0]] + lFreq[1][lMax[1]] + lFreq[2][lMax[2]])/3.0 )
 		
-		rDist_m = float(dataset.props['Distance'][0]) * 0.01
-		if dataset.props['Distance'][1] != '[cm]':
+		rDist_m = dataset.require('distance') * 0.01
+		if dataset.distance_units != '[cm]':
 			raise ValueError(
 				"General unit handling not implemented, 'Distance' property is " +\
 				"expected in units of centimeters [cm]."
@@ -324,9 +728,12 @@ def dipole_from_rotation(lDsRaw):
 
 		# Normalize B components to front face of sensor, since we can measure
 		# that in the real world with a ruler.
-		lOffset_m = [ float(sItem)*0.01 for sItem in dataset.props['Offset_cm'] ]
+		lOffset_m = dataset.require('offset_cm') * 0.01
 		
-		Bmax_nT = [ _dipole_adjust( lAmp[i][lMax[i]], rDist_m, lOffset_m[i]) for i in range(3) ]
+		# Scalars from here on are float64 whatever the data type of the spectra
+		Bmax_nT = [
+			_dipole_adjust(float(lAmp[i][lMax[i]]), rDist_m, lOffset_m[i]) for i in range(3)
+		]
 
 		lDist.append(rDist_m)
 		lZangle.append(_angleZ(Bmax_nT))
@@ -369,12 +776,17 @@ def dipole_from_rotation(lDsRaw):
 	#dist_err_calc = ( ((3/2)*(((1.256*10**-6)*(m))/(2*3.14*aDist_m**4)))**2 * (dist_err)**2 )**.5
 	#tot_err = (( dist_err_calc**2 + VMR_err**2 )**.5)*1e9 #independent error combined
 
+	from scipy.optimize import curve_fit
 	rMomentFit, mCovariance = curve_fit(bmag_from_moment, aDist_m, aBmax_T)
 
 	# estimated covariance of the moment fit, aka one standard deviation.
 	rMomentErr = np.sqrt(np.diag(mCovariance)) 
 
-	return (aDist_m, aRot_Hz, aAngle_radz, aAngle_radx, aBmax_T, rMomentFit, rMomentErr)
+	# One parameter fit, return scalars as documented above
+	return (
+		aDist_m, aRot_Hz, aAngle_radz, aAngle_radx, aBmax_T, rMomentFit[0],
+		rMomentErr[0]
+	)
 
 # ########################################################################## #
 # Stray Field #
@@ -406,3 +818,40 @@ def stray_field_1m(rMoment, rError):
 		nStatus = CAUTION
 
 	return (Bstray*1e9, BstrayErr*1.9, nStatus)
+
+# ########################################################################## #
+# Complete analysis #
+
+# Change this whenever dipole_from_rotation() or stray_field_1m() are changed
+# in a way that alters their output.  Stored results made by another version
+# are recomputed, see magscreen.results.
+g_sAlgorithm = 'dipole_from_rotation/1'
+
+def algorithm():
+	"""Get the name of the analysis in use, including the set_use_times()
+	setting, as saved with stored results"""
+	return g_sAlgorithm + ('+times' if g_bUseTimes else '')
+
+Analysis = namedtuple('Analysis', [
+	'dist', 'rate', 'Zangle', 'Xangle', 'Bdipole', 'moment', 'merror',
+	'Bstray', 'BstrayErr', 'status'
+])
+
+@profiling.timed('calc.analyze')
+def analyze(lDs):
+	"""Run the dipole fit and stray field calculation for one test
+
+	Args:
+		lDs (list[semcsv.Dataset]): The datasets for one test, see
+			dipole_from_rotation()
+
+	Returns (Analysis): The arrays and scalars from dipole_from_rotation(),
+		followed by the stray field and its error from stray_field_1m().
+		status is one of FAIL, CAUTION or PASS.
+	"""
+	(dist, rate, Zangle, Xangle, Bdipole, moment, merror) = dipole_from_rotation(lDs)
+	(Bstray, BstrayErr, iStatus) = stray_field_1m(moment, merror)
+	return Analysis(
+		dist, rate, Zangle, Xangle, Bdipole, float(moment), float(merror),
+		float(Bstray), float(BstrayErr), iStatus
+	)
@@ -0,0 +1,187 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-sensor magnetometer calibration
+
+Calibrations are kept in a plain CSV file with one header row and one row
+per sensor, for example:
+
+  "UART","Sensor","M11","M12","M13","M21","M22","M23","M31","M32","M33","Bias_x","Bias_y","Bias_z","Offset_x","Offset_y","Offset_z"
+  "DT04H6OF","N179",1.002,0.001,0,-0.001,0.998,0,0,0.002,1.001,12.5,-3.1,0.4,1.025,0.0,0.475
+
+UART is the USB UART serial number and Sensor is the VMR identity, the
+fourth word of the 'Sensor' property, e.g. N179.  Either may be left empty
+to match any value.  The most specific row wins.  M is a 3x3 gain and
+orthogonality matrix, Bias is subtracted before applying M (nT), and
+Offset gives the internal magnetometer position behind the front face of
+the sensor (cm).  Corrected vectors are:
+
+  B_cal = M (B_raw - Bias)
+
+Sensors without a calibration row get the nominal Twinleaf VMR values,
+an identity matrix, zero bias and offsets of 1.025, 0.0, 0.475 cm.
+"""
+
+import os
+import sys
+import csv
+from collections import namedtuple
+import numpy as np
+
+perr = sys.stderr.write  # shorten a long function name
+
+Calibration = namedtuple('Calibration', ['source','matrix','bias','offset_cm'])
+
+NOMINAL = Calibration(
+	'nominal', np.eye(3), np.zeros(3), np.array([1.025, 0.0, 0.475])
+)
+
+_lMatCols = ['M11','M12','M13','M21','M22','M23','M31','M32','M33']
+_lBiasCols = ['Bias_x','Bias_y','Bias_z']
+_lOffCols = ['Offset_x','Offset_y','Offset_z']
+
+# Loaded registries keyed by (abs path, mtime, size), and lookups keyed by
+# (abs path, uart serial, sensor id)
+_g_dRegistries = {}
+_g_dLookups = {}
+
+# ########################################################################## #
+
+def sensor_id(sSensor):
+	"""Get the short VMR identity from a Sensor property string
+
+	Args:
+		sSensor (str): A device description such as
+			'Twinleaf VMR R12 N179 [2021-08-30/065a10]'
+
+	Returns (str): The serial part of the description, 'N179' for the
+		example above, or an empty string if it can't be found.
+	"""
+	lWords = sSensor.split()
+	if len(lWords) >= 4: return lWords[3]
+	return ''
+
+
+def load(sFile):
+	"""Load a calibration registry file.
+
+	Registries are cached, loading the same unchanged file again just returns
+	the cached copy.
+
+	Args:
+		sFile (str): The calibration CSV file to read
+
+	Returns (dict):
+		A dictionary of Calibration tuples keyed by (uart_serial, sensor_id)
+	"""
+	sAbs = os.path.abspath(sFile)
+	st = os.stat(sAbs)
+	tKey = (sAbs, st.st_mtime, st.st_size)
+	if tKey in _g_dRegistries:
+		return _g_dRegistries[tKey]
+
+	sSource = os.path.basename(sAbs)
+	dReg = {}
+	with open(sAbs, 'r', newline='') as fIn:
+		rdr = csv.DictReader(fIn)
+		for dRow in rdr:
+			try:
+				aMat = np.array([float(dRow[s]) for s in _lMatCols]).reshape((3,3))
+				aBias = np.array([float(dRow[s]) for s in _lBiasCols])
+				aOff = np.array([float(dRow[s]) for s in _lOffCols])
+			except (KeyError, TypeError, ValueError) as exc:
+				raise ValueError("%s, line %d: Bad calibration row, %s"%(
+					sFile, rdr.line_num, exc
+				))
+			tId = (dRow.get('UART','').strip(), dRow.get('Sensor','').strip())
+			dReg[tId] = Calibration(
+				'%s:%s/%s'%(sSource, tId[0] or '*', tId[1] or '*'), aMat, aBias, aOff
+			)
+
+	# Drop cached versions of an older copy of this file
+	for tOld in [t for t in _g_dRegistries if t[0] == sAbs]:
+		del _g_dRegistries[tOld]
+	for tOld in [t for t in _g_dLookups if t[0] == sAbs]:
+		del _g_dLookups[tOld]
+
+	_g_dRegistries[tKey] = dReg
+	return dReg
+
+
+def lookup(sSerial, sSensor, sFile=None):
+	"""Find the calibration for a sensor
+
+	Args:
+		sSerial (str): The UART serial number, may be a leading portion of
+			the full serial number as given on the command line.
+
+		sSensor (str): The Sensor property or device description.
+
+		sFile (str): The calibration registry file, if None the nominal
+			calibration is returned.
+
+	Returns (Calibration): The most specific match, or NOMINAL
+	"""
+	if not sFile: return NOMINAL
+
+	dReg = load(sFile)
+	sId = sensor_id(sSensor)
+	tKey = (os.path.abspath(sFile), sSerial, sId)
+	if tKey in _g_dLookups:
+		return _g_dLookups[tKey]
+
+	cal = NOMINAL
+	for tTry in ((sSerial, sId), (sSerial, ''), ('', sId), ('', '')):
+		if tTry in dReg:
+			cal = dReg[tTry]
+			break
+
+	if cal is NOMINAL:
+		perr("WARN:  No calibration for UART %s, sensor %s in %s, using nominal values\n"%(
+			sSerial, sId, sFile
+		))
+
+	_g_dLookups[tKey] = cal
+	return cal
+
+
+def apply(cal, aVecs):
+	"""Apply a calibration to a block of vectors
+
+	Args:
+		cal (Calibration): The calibration to apply
+		aVecs (ndarray): An [N, 3] array of raw vectors in nT
+
+	Returns (ndarray): An [N, 3] array of corrected vectors
+	"""
+	if cal is NOMINAL: return aVecs
+	return (aVecs - cal.bias) @ cal.matrix.T
+
+
+def to_props(cal):
+	"""Get the property rows that record a calibration in a raw data file
+
+	Returns (list): A list of (key, [value, value, value]) tuples
+	"""
+	return [
+		('Offset_cm', ['%.3f'%r for r in cal.offset_cm]),
+		('Calibration', [cal.source]),
+		('Cal_Mx', ['%.6f'%r for r in cal.matrix[0]]),
+		('Cal_My', ['%.6f'%r for r in cal.matrix[1]]),
+		('Cal_Mz', ['%.6f'%r for r in cal.matrix[2]]),
+		('Cal_bias', ['%.3f'%r for r in cal.bias])
+	]
@@ -16,7 +16,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import glob
 import argparse
+import hashlib
 import threading
 import sys
 import string
@@ -24,6 +27,10 @@ import time
 
 perr = sys.stderr.write  # shorten a long function names
 
+# The version of this software, need to be able to set this via the release
+# process somehow.  Written to output files and used to tell if they are stale.
+g_sVersion = "magscreen-0.3"
+
 # Fix dubious help text output ############################################# #
 
 class BreakFormatter(argparse.HelpFormatter):
@@ -92,3 +99,73 @@ def safe_filename(sName):
 
 	return "".join(lOut)
 
+
+def process_pool(nWorkers=1):
+	"""Start a process pool that is safe to create while other threads run
+
+	Forked workers copy whatever locks the sensor and writer threads hold at
+	that moment, so workers are started by a fork server instead where
+	possible.  Python 3.6 can't choose the start method per pool, there the
+	pool should be started before any threads.
+
+	Args:
+		nWorkers (int): The number of worker processes
+
+	Returns (concurrent.futures.ProcessPoolExecutor):
+	"""
+	import multiprocessing
+	from concurrent.futures import ProcessPoolExecutor
+
+	if sys.version_info < (3, 7): return ProcessPoolExecutor(max_workers=nWorkers)
+
+	lMethods = multiprocessing.get_all_start_methods()
+	sMethod = 'forkserver' if 'forkserver' in lMethods else 'spawn'
+	return ProcessPoolExecutor(
+		max_workers=nWorkers, mp_context=multiprocessing.get_context(sMethod)
+	)
+
+
+def file_hash(sFile):
+	"""Get the SHA-256 hash of a file as a hex string"""
+	h = hashlib.sha256()
+	with open(sFile, 'rb') as fIn:
+		for xBlock in iter(lambda: fIn.read(1 << 20), b''):
+			h.update(xBlock)
+	return h.hexdigest()
+
+
+def is_raw_data(sFile):
+	"""Does a CSV file look like raw screening data?  Summary files and other
+	spreadsheets found in an archive are skipped."""
+	try:
+		with open(sFile, 'rb') as fIn:
+			return fIn.read(16).startswith(b'"G","Title"')
+	except OSError:
+		return False
+
+
+def expand_inputs(lArgs):
+	"""Turn a list of files, directories and glob patterns into a sorted list
+	of CSV files.  Directories are searched recursively.  Files found in
+	directories or by patterns are only kept if they are raw data, so that
+	summary files in an archive are skipped.  Files named directly are
+	always kept."""
+	lFiles = []
+	for sArg in lArgs:
+		if os.path.isdir(sArg):
+			for (sDir, lSubDirs, lNames) in os.walk(sArg):
+				lSubDirs.sort()
+				for sName in lNames:
+					sFile = os.path.join(sDir, sName)
+					if sName.lower().endswith('.csv') and is_raw_data(sFile):
+						lFiles.append(sFile)
+		elif os.path.isfile(sArg):
+			lFiles.append(sArg)
+		else:
+			# Windows shells don't expand globs, so do it here
+			lFiles += [
+				s for s in glob.glob(sArg, recursive=True)
+				if os.path.isfile(s) and is_raw_data(s)
+			]
+
+	return sorted(set(lFiles))
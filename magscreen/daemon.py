@@ -0,0 +1,444 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Long running screening service that keeps the sensors connected between parts.
+
+Each run of mag_screen finds the UART ports, sets the data rate, connects
+to the sensors and reads their descriptions before any data are taken.  On
+a busy bench that adds several seconds to every part.  This program does
+all of that once, then waits for jobs on a local TCP socket.
+
+Jobs and replies are single lines of JSON.  A job looks like:
+
+  {"part": "screwdriver", "message": "Handle only", "duration": 20}
+
+only "part" is required, the duration defaults to the -t value given when
+the daemon was started, or the planned duration with --plan.  The reply is sent after the data are collected,
+written, plotted and summarized:
+
+  {"status": "ok", "part": "screwdriver", "file": "./screwdriver2022_...csv",
+   "moment": 0.0175, "field_1m_nT": 3.49, "result": "PASSED"}
+
+or {"status": "error", "error": "..."}.  Two other requests are understood,
+{"cmd": "status"} and {"cmd": "shutdown"}.  Jobs are run one at a time in
+the order received, there is only one set of sensors.
+
+With --rigs the daemon drives several fixtures, see rigs.py.  Jobs then
+name their fixture, {"part": "screwdriver", "rig": "bench2"}, and replies
+include it.  Each client connection is served by its own thread, so jobs
+for different rigs run at the same time, while jobs for the same rig still
+run one at a time.  The status reply lists each rig.
+
+The same program can send a job to a running daemon, see --send.
+"""
+import sys
+import os
+import argparse
+import signal
+import json
+import time
+import select
+import socket
+import socketserver
+
+import magscreen.common as common
+import magscreen.profiling as profiling
+import magscreen.metrics as metrics
+import magscreen.screen as screen
+import magscreen.rigs as rigs
+
+perr = sys.stderr.write  # shorten a long function name
+
+g_nPortDef = 7531
+
+# Set by the signal handler, the serve loop checks it between requests
+g_bQuit = False
+
+# Seconds between quit flag checks while waiting for a request, and the
+# longest request line accepted
+g_rPoll = 0.5
+g_nMaxLine = 1 << 20
+
+def setQuit(sig, frame):
+	"""Signal handler, stop any acquisition in progress and exit"""
+	global g_bQuit
+	g_bQuit = True
+	screen.setQuit(sig, frame)
+
+# ############################################################################ #
+
+class Bench:
+	"""The warm sensors of one rig and the options used to process each part
+
+	Args:
+		rig (screen.Rig): The rig, its sensors are opened by connect()
+		host (rigs.Host): PDF workers and processing turns shared with any
+			other rigs
+		bDisplay (bool): Print progress dots while collecting
+	"""
+
+	def __init__(self, rig, host, bDisplay=True):
+		self.rig = rig
+		self.opts = rig.opts
+		self.host = host
+		self.bDisplay = bDisplay
+		self.nJobs = 0
+		self.rStart = time.time()
+
+	def connect(self):
+		"""Open the sensors if they aren't open already
+
+		Returns (bool): True if the sensors are ready
+		"""
+		return self.rig.open()
+
+	def status(self):
+		"""Get a dictionary describing the daemon state"""
+		lSensors = []
+		for vmr in (self.rig.lCollectors or []):
+			lSensors.append({
+				'uart':vmr.serialno, 'port':vmr.port, 'sensor':vmr.dev_info,
+				'distance_cm':vmr.dist, 'role':vmr.role
+			})
+		dStatus = {
+			'status':'ok', 'version':common.g_sVersion, 'jobs':self.nJobs,
+			'uptime':round(time.time() - self.rStart, 1), 'rate':self.opts.sRate,
+			'sensors':lSensors
+		}
+		if self.rig.sName: dStatus['rig'] = self.rig.sName
+		return dStatus
+
+	@profiling.timed('job')
+	def run_job(self, dJob):
+		"""Collect and process data for one part, jobs for the same rig wait
+		for each other
+
+		Args:
+			dJob (dict): The job request, see the module description
+
+		Returns (dict): The reply to send back
+		"""
+		sPart = dJob.get('part')
+		if not isinstance(sPart, str) or len(sPart.strip()) == 0:
+			return {'status':'error', 'error':'A non-empty "part" is required'}
+
+		sMsg = dJob.get('message')
+		if (sMsg is not None) and not isinstance(sMsg, str):
+			return {'status':'error', 'error':'"message" must be a string'}
+
+		try:
+			nDuration = int(dJob.get('duration', self.opts.sDuration))
+		except (TypeError, ValueError):
+			return {'status':'error', 'error':'"duration" must be an integer'}
+		if nDuration < 1 or nDuration > 60*60:
+			return {'status':'error', 'error':'Duration must be between 1 second and 1 hour'}
+
+		with self.rig.lock:
+			return self._run(sPart, sMsg, nDuration)
+
+	def _run(self, sPart, sMsg, nDuration):
+		"""Run a checked job, called with the rig locked"""
+		sRig = self.rig.sName
+		if not self.connect():
+			screen.count_run('error', sRig)
+			return {'status':'error', 'error':'Could not open all sensors'}
+
+		if sRig: perr("INFO:  Job for part %s on rig %s, %d seconds\n"%(sPart, sRig, nDuration))
+		else: perr("INFO:  Job for part %s, %d seconds\n"%(sPart, nDuration))
+		if not self.rig.acquire(nDuration, self.bDisplay):
+			perr('WARN:  Data collection terminated, no output written\n')
+			screen.count_run('interrupted', sRig)
+			return {'status':'error', 'error':'Data collection interrupted'}
+
+		# A sensor that went quiet was probably unplugged, reconnect next time
+		lEmpty = [vmr.serialno for vmr in self.rig.lCollectors if len(vmr) == 0]
+		if lEmpty:
+			self.rig.close()
+			screen.count_run('error', sRig)
+			return {'status':'error', 'error':'No data from UART %s'%', '.join(lEmpty)}
+
+		dTest = self.rig.test_properties(sPart, sMsg)
+		try:
+			(sFile, tResult) = self.host.process(self.rig, dTest)
+		except (OSError, ValueError, RuntimeError) as exc:
+			perr("ERROR: %s\n"%exc)
+			screen.count_run('error', sRig)
+			return {'status':'error', 'error':str(exc)}
+
+		self.nJobs += 1
+		screen.count_run('ok', sRig)
+		dReply = {
+			'status':'ok', 'part':sPart, 'file':sFile, 'moment':float(tResult[0]),
+			'field_1m_nT':float(tResult[1]), 'result':tResult[2]
+		}
+		if sRig: dReply['rig'] = sRig
+		return dReply
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+	"""Read JSON requests, one per line, and answer each in turn
+
+	An idle client connection doesn't keep the daemon from exiting, the quit
+	flag is checked every g_rPoll seconds while waiting for a request.
+	"""
+
+	def _read_line(self):
+		"""Get the next request line, or None if the client disconnected or
+		the daemon is quitting"""
+		while b'\n' not in self.xBuf:
+			if g_bQuit: return None
+			if len(self.xBuf) > g_nMaxLine: return None
+			(lReady, lOut, lErr) = select.select([self.connection], [], [], g_rPoll)
+			if not lReady: continue
+			xData = self.connection.recv(65536)
+			if not xData:
+				(xLine, self.xBuf) = (self.xBuf, b'')   # Last line may lack a newline
+				return xLine or None
+			self.xBuf += xData
+
+		(xLine, self.xBuf) = self.xBuf.split(b'\n', 1)
+		return xLine + b'\n'
+
+	def handle(self):
+		global g_bQuit
+		self.xBuf = b''
+		while True:
+			xLine = self._read_line()
+			if xLine is None: return
+			if len(xLine.strip()) == 0: continue
+			try:
+				dReq = json.loads(xLine.decode('utf-8'))
+				if not isinstance(dReq, dict): raise ValueError("not an object")
+			except ValueError as exc:
+				self._reply({'status':'error', 'error':'Bad request, %s'%exc})
+				continue
+
+			sCmd = dReq.get('cmd', 'job')
+			if sCmd == 'job':
+				bench = self.server.find_bench(dReq.get('rig'))
+				if bench is None:
+					sRigs = ', '.join(self.server.rig_names())
+					if dReq.get('rig') is None: sErr = 'A "rig" is required, one of %s'%sRigs
+					else: sErr = 'Unknown rig %s, expected one of %s'%(dReq.get('rig'), sRigs)
+					self._reply({'status':'error', 'error':sErr})
+					continue
+				self._reply(bench.run_job(dReq))
+				metrics.write()   # After the reply, so the client doesn't wait
+			elif sCmd == 'status':
+				self._reply(self.server.status())
+			elif sCmd == 'shutdown':
+				g_bQuit = True
+				self._reply({'status':'ok'})
+				return
+			else:
+				self._reply({'status':'error', 'error':'Unknown command %s'%sCmd})
+
+			if g_bQuit: return
+
+	def _reply(self, dReply):
+		self.wfile.write(json.dumps(dReply).encode('utf-8') + b'\n')
+		self.wfile.flush()
+
+
+class JobServer(socketserver.TCPServer):
+	"""Serves one connection at a time, later clients wait in the listen
+	queue until the current one disconnects."""
+	allow_reuse_address = True
+
+	def __init__(self, tAddr, lBenches):
+		self.lBenches = lBenches
+		socketserver.TCPServer.__init__(self, tAddr, JobHandler)
+
+	def find_bench(self, sRig):
+		"""Get the bench for a rig name, the rig may be omitted if there is
+		only one.  Returns None if there is no such rig."""
+		if (sRig is None) and (len(self.lBenches) == 1): return self.lBenches[0]
+		for bench in self.lBenches:
+			if (sRig is not None) and (bench.rig.sName == sRig): return bench
+		return None
+
+	def rig_names(self):
+		return [bench.rig.sName for bench in self.lBenches if bench.rig.sName]
+
+	def status(self):
+		"""Get the daemon state, with a list of rigs if there are several"""
+		if len(self.lBenches) == 1: return self.lBenches[0].status()
+		return {
+			'status':'ok', 'version':common.g_sVersion,
+			'rigs':[bench.status() for bench in self.lBenches]
+		}
+
+
+class RigJobServer(socketserver.ThreadingMixIn, JobServer):
+	"""Serves each connection in its own thread, so that jobs for different
+	rigs run at the same time.  Jobs for the same rig wait for each other.
+	On exit, jobs in progress are allowed to finish."""
+	daemon_threads = False
+
+# ############################################################################ #
+
+def send(dJob, nPort=g_nPortDef, sHost='127.0.0.1'):
+	"""Send one request to a running daemon and wait for the reply
+
+	Args:
+		dJob (dict): The request, see the module description
+		nPort (int): The daemon's TCP port
+		sHost (str): The daemon's host, normally the local machine
+
+	Returns (dict): The decoded reply
+	"""
+	with socket.create_connection((sHost, nPort)) as sock:
+		sock.sendall(json.dumps(dJob).encode('utf-8') + b'\n')
+		fIn = sock.makefile('rb')
+		xLine = fIn.readline()
+	if not xLine:
+		raise OSError("No reply from daemon on %s:%d"%(sHost, nPort))
+	return json.loads(xLine.decode('utf-8'))
+
+
+def main():
+	"""Program entry point, run with -h for usage information.
+
+	Returns:
+		A standard integer success or fail code suitable for return to
+		the calling shell. 0 = success, non-zero = various error conditions
+	"""
+	psr = argparse.ArgumentParser(formatter_class=common.BreakFormatter)
+	psr.description = '''\
+		Keep 2 to N twinleaf VMR sensors connected and screen parts as jobs
+		arrive on a local TCP socket.  Output files are the same as for
+		mag_screen.  With --send, pass one job to a running daemon instead.'''
+	psr.epilog = '''\
+	Author: chris-piker@uiowa.edu, cole-dorman@uiowa.edu\v
+	Source: https://research-git.uiowa.edu/space-physics/utilities/python/vangse
+	'''
+
+	screen.add_rig_args(psr)
+
+	sDef = os.environ.get('MAGSCREEN_PORT', '%d'%g_nPortDef)
+	psr.add_argument(
+		'-P', '--port', dest='nPort', metavar='PORT', type=int, default=int(sDef),
+		help="The local TCP port for jobs.  Defaults to the MAGSCREEN_PORT "+\
+		"environment variable if set, otherwise %d."%g_nPortDef
+	)
+
+	psr.add_argument(
+		'--send', dest='sPart', metavar='PART', type=str, default=None,
+		help="Don't start a daemon, send a job for PART to the one already "+\
+		"running and print the reply.  The -m value, and -t if given, are "+\
+		"passed along."
+	)
+
+	psr.add_argument(
+		'-m', '--message', dest="sMsg", metavar='"Short msg"', type=str, default=None,
+		help="With --send, a one line message to save with the test data."
+	)
+
+	psr.add_argument(
+		'--rigs', dest='sRigFile', metavar='FILE', default=None,
+		help="Keep several screening fixtures connected, as described in the "+\
+		"rig file FILE, see etc/rigs.ini.  Jobs for different rigs run at the "+\
+		"same time.  The options above are defaults for every rig."
+	)
+
+	psr.add_argument(
+		'--rig', dest='sRig', metavar='NAME', type=str, default=None,
+		help="With --send, the rig to screen the part on.  Only needed if the "+\
+		"daemon has several."
+	)
+
+	opts = psr.parse_args()
+
+	if opts.sPart:
+		# Without -t the daemon uses its own duration, which may be planned
+		dJob = {'part':opts.sPart}
+		if opts.sDuration is not None: dJob['duration'] = opts.sDuration
+		if opts.sMsg: dJob['message'] = opts.sMsg
+		if opts.sRig: dJob['rig'] = opts.sRig
+		try:
+			dReply = send(dJob, opts.nPort)
+		except OSError as exc:
+			perr("ERROR: %s\n"%exc)
+			return 16
+		print(json.dumps(dReply, indent=2))
+		return 0 if dReply.get('status') == 'ok' else 17
+
+	signal.signal(signal.SIGINT, setQuit)
+	signal.signal(signal.SIGTERM, setQuit)
+
+	if opts.sRigFile:
+		tRigs = rigs.read(opts.sRigFile, opts)
+		if tRigs is None: return 18
+	else:
+		nRet = screen.check_rig_args(opts)
+		if nRet != 0: return nRet
+		tRigs = (rigs.Host(), [screen.Rig(opts)])
+
+	# The report is written when the daemon exits
+	profiling.enable_from_env('mag_screen_daemon')
+
+	# Metrics are written at start up, after each job and on exit
+	if opts.sMetrics:
+		metrics.enable('mag_screen_daemon', opts.sMetrics)
+		metrics.write()
+	try:
+		return _serve(opts, *tRigs)
+	finally:
+		metrics.write()
+		profiling.finish()
+
+
+def _serve(opts, host, lRigs):
+	"""Open the sensors and answer requests until told to quit"""
+	# Progress dots from several rigs would be mixed together
+	lBenches = [Bench(rig, host, len(lRigs) == 1) for rig in lRigs]
+
+	# PDF workers are started before the sensor threads
+	host.start(lRigs)
+	try:
+		for bench in lBenches:
+			if not bench.connect(): return 15
+
+		try:
+			if len(lBenches) == 1: server = JobServer(('127.0.0.1', opts.nPort), lBenches)
+			else: server = RigJobServer(('127.0.0.1', opts.nPort), lBenches)
+		except OSError as exc:
+			perr("ERROR: Can't listen on port %d, %s\n"%(opts.nPort, exc))
+			return 16
+
+		for bench in lBenches:
+			perr("INFO:  %s%d sensors ready\n"%(
+				'Rig %s, '%bench.rig.sName if bench.rig.sName else '',
+				len(bench.rig.lCollectors)
+			))
+		perr("INFO:  Waiting for jobs on 127.0.0.1:%d\n"%opts.nPort)
+
+		# Poll so that the quit flag is checked even when no clients connect
+		server.timeout = g_rPoll
+		with server:
+			while not g_bQuit:
+				server.handle_request()
+	finally:
+		host.close()
+
+	perr("INFO:  Daemon exiting after %d jobs\n"%sum(bench.nJobs for bench in lBenches))
+	return 0
+
+# Run the main function if this is a top level script
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,428 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Watch folders for new raw data files, then plot and summarize them.
+
+Benches that only capture data can drop their raw CSV files in a shared
+directory, and this program, running on another computer, does the rest of
+what mag_screen would have done: the dipole fit, which is saved next to the
+file (see results.py), the plots, and a line in the summary file.
+
+The watched directories are polled, searched recursively, so nothing is
+needed beyond a local or network file system.  A file is taken to be
+complete when either:
+
+  * a marker file, the data file name plus the --marker suffix, exists, or
+  * with no marker suffix given, its size and modification time have not
+    changed for --settle seconds.
+
+Complete files are processed by a pool of worker processes.  At most
+--queue files are handed to the pool at a time, the rest are picked up by
+later polls, so a large backlog does not fill memory.  Failures are retried
+with a growing delay, up to --retries times.  A file that still fails is not
+tried again until it changes.
+
+What has been done is kept in a state file, so the program can be stopped
+and started again without summarizing a file twice.  A file that was being
+processed when the program was killed is processed again on restart, which
+may give a duplicate summary line.
+"""
+import sys
+import os
+import argparse
+import signal
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import magscreen.common as common
+import magscreen.profiling as profiling
+
+perr = sys.stderr.write  # shorten a long function name
+
+g_nStateVer = 1
+
+# Set by the signal handler, the poll loop checks it
+g_bQuit = False
+
+def setQuit(sig, frame):
+	"""Signal handler, finish the files being processed and exit"""
+	global g_bQuit
+	g_bQuit = True
+
+# ############################################################################ #
+
+def process_file(sFile, sSummary, sFmt='pdf', bDecimate=True):
+	"""Fit, plot and summarize one raw data file, runs in a worker process
+
+	Args:
+		sFile (str): The raw data file
+		sSummary (str): The summary file to append to
+		sFmt (str): Plot format, 'pdf', 'png', or None for no plots
+		bDecimate (bool): Reduce long time series, see plot.raw_plot3()
+
+	Returns (tuple): The (moment, stray field, status) from summary.append()
+	"""
+	import magscreen.semcsv as semcsv
+	import magscreen.results as results
+	import magscreen.summary as summary
+
+	(dProps, lDs) = semcsv.read(sFile)
+	(dProps, ana) = results.get(sFile, dProps, lDs)
+
+	if sFmt:
+		import magscreen.plot as plot
+		sOut = os.path.splitext(sFile)[0] + '.' + sFmt
+		if sFmt == 'png':
+			plot.screen_plot_png(dProps, lDs, sOut, bDecimate=bDecimate, ana=ana)
+		else:
+			plot.screen_plot_pdf(dProps, lDs, sOut, bDecimate=bDecimate, ana=ana)
+
+	return summary.append(sSummary, dProps, lDs, ana)
+
+# ############################################################################ #
+
+class Ingester:
+	"""Finds complete raw data files and feeds them to a worker pool"""
+
+	def __init__(self, lDirs, opts):
+		"""
+		Args:
+			lDirs (list of str): The directories to watch
+			opts: The parsed command line options, see main()
+		"""
+		self.lDirs = lDirs
+		self.opts = opts
+		self.sState = opts.sState
+		self.dState = self.load()    # abs path: entry, see _record()
+		self.dSeen = {}    # abs path: ((size, mtime_ns), first time seen that way)
+		self.dRunning = {} # future: (abs path, (size, mtime_ns))
+		self.pool = None
+		self.dCount = {'done':0, 'failed':0, 'retried':0}
+
+	def load(self):
+		"""Read the state file, a missing or unreadable one gives no state"""
+		if not os.path.isfile(self.sState): return {}
+		try:
+			with open(self.sState) as fIn:
+				dIn = json.load(fIn)
+		except (OSError, ValueError) as exc:
+			perr("WARN:  Ignoring unreadable state file %s, %s\n"%(self.sState, exc))
+			return {}
+		if dIn.get('state_version') != g_nStateVer: return {}
+		return dIn.get('files', {})
+
+	def save(self):
+		"""Write the state file, the new file is renamed into place"""
+		sTmp = '%s.%d.tmp'%(self.sState, os.getpid())
+		with open(sTmp, 'w') as fOut:
+			json.dump(
+				{'state_version':g_nStateVer, 'software':common.g_sVersion,
+				 'files':self.dState}, fOut, indent=1, sort_keys=True
+			)
+		os.replace(sTmp, self.sState)
+
+	# ####################################################################### #
+	# Finding work #
+
+	def _candidates(self):
+		"""Yield (abs path, (size, mtime_ns)) for raw data files in the
+		watched directories"""
+		for sTop in self.lDirs:
+			for (sDir, lSubDirs, lNames) in os.walk(sTop):
+				lSubDirs.sort()
+				for sName in sorted(lNames):
+					if not sName.lower().endswith('.csv'): continue
+					sFile = os.path.abspath(os.path.join(sDir, sName))
+					try:
+						st = os.stat(sFile)
+					except OSError:
+						continue   # Moved away since the directory was read
+					tStat = (st.st_size, st.st_mtime_ns)
+					dEntry = self.dState.get(sFile)
+					if dEntry and (tuple(dEntry['stat']) == tStat) and \
+						(dEntry['status'] in ('done', 'failed')):
+						continue
+					if common.is_raw_data(sFile): yield (sFile, tStat)
+
+	def _is_complete(self, sFile, tStat, rNow):
+		if self.opts.sMarker:
+			return os.path.isfile(sFile + self.opts.sMarker)
+
+		tLast = self.dSeen.get(sFile)
+		if (tLast is None) or (tLast[0] != tStat):
+			self.dSeen[sFile] = (tStat, rNow)
+			return False
+		return (rNow - tLast[1]) >= self.opts.rSettle
+
+	def _is_due(self, sFile, tStat, rNow):
+		"""Is a file new, changed, or waiting for a retry that is now due?"""
+		dEntry = self.dState.get(sFile)
+		if (dEntry is None) or (tuple(dEntry['stat']) != tStat): return True
+		return rNow >= dEntry.get('retry_at', 0)
+
+	def poll(self):
+		"""Start work on complete files, while there is room in the queue
+
+		Returns (int): The number of files started
+		"""
+		rNow = time.time()
+		setRunning = set(s for (s, t) in self.dRunning.values())
+		nStarted = 0
+		for (sFile, tStat) in self._candidates():
+			if len(self.dRunning) >= self.opts.nQueue: break   # Back pressure
+			if sFile in setRunning: continue
+			if not self._is_complete(sFile, tStat, rNow): continue
+			if not self._is_due(sFile, tStat, rNow): continue
+
+			self.dSeen.pop(sFile, None)
+			fut = self.pool.submit(
+				process_file, sFile, self.opts.sSummary, self.opts.sFmt,
+				not self.opts.bFullRes
+			)
+			self.dRunning[fut] = (sFile, tStat)
+			nStarted += 1
+
+		# Forget files that disappeared while settling
+		for sFile in [s for s in self.dSeen if not os.path.exists(s)]:
+			del self.dSeen[sFile]
+
+		return nStarted
+
+	# ####################################################################### #
+	# Finishing work #
+
+	def _record(self, sFile, tStat, exc=None, tResult=None):
+		"""Update the state for a file after a try"""
+		dOld = self.dState.get(sFile)
+		nTries = 1
+		if dOld and (tuple(dOld['stat']) == tStat): nTries = dOld.get('tries', 0) + 1
+
+		dEntry = {'stat':list(tStat), 'tries':nTries, 'time':round(time.time(), 3)}
+		if exc is None:
+			dEntry['status'] = 'done'
+			dEntry['result'] = tResult[2]
+			self.dCount['done'] += 1
+			perr("INFO:  %s: %s, dipole %.3e [N m T^-1], %.3e [nT] @ 1 m\n"%(
+				sFile, tResult[2], tResult[0], tResult[1]
+			))
+		elif nTries <= self.opts.nRetries:
+			dEntry['status'] = 'retry'
+			dEntry['error'] = str(exc)
+			dEntry['retry_at'] = time.time() + self.opts.rBackoff * 2**(nTries - 1)
+			self.dCount['retried'] += 1
+			perr("WARN:  Could not process %s, %s, will retry in %.1f s\n"%(
+				sFile, exc, dEntry['retry_at'] - time.time()
+			))
+		else:
+			dEntry['status'] = 'failed'
+			dEntry['error'] = str(exc)
+			self.dCount['failed'] += 1
+			perr("ERROR: Could not process %s after %d tries, %s\n"%(sFile, nTries, exc))
+
+		self.dState[sFile] = dEntry
+
+	def collect(self, rTimeout):
+		"""Wait up to rTimeout seconds for running files to finish
+
+		Returns (int): The number of files finished
+		"""
+		if not self.dRunning:
+			time.sleep(rTimeout)
+			return 0
+
+		(setDone, setPending) = wait(
+			list(self.dRunning), timeout=rTimeout, return_when=FIRST_COMPLETED
+		)
+		bBroken = False
+		for fut in setDone:
+			(sFile, tStat) = self.dRunning.pop(fut)
+			try:
+				self._record(sFile, tStat, tResult=fut.result())
+			except BrokenProcessPool as exc:
+				bBroken = True
+				self._record(sFile, tStat, exc=exc)
+			except Exception as exc:
+				# Anything a bad file can cause, the retry limit bounds the cost
+				self._record(sFile, tStat, exc=exc)
+
+		if bBroken:
+			perr("WARN:  A worker process died, restarting the pool\n")
+			for (fut, (sFile, tStat)) in list(self.dRunning.items()):
+				self._record(sFile, tStat, exc=RuntimeError("worker process died"))
+			self.dRunning.clear()
+			self.pool.shutdown(wait=False)
+			self.pool = ProcessPoolExecutor(max_workers=self.opts.nJobs)
+
+		if setDone:
+			try:
+				self.save()
+			except OSError as exc:
+				perr("WARN:  Could not save state to %s, %s\n"%(self.sState, exc))
+		return len(setDone)
+
+	def run(self):
+		"""Poll and process files until told to quit, or with --once until
+		there is nothing left to do."""
+		self.pool = ProcessPoolExecutor(max_workers=self.opts.nJobs)
+		try:
+			rNext = 0
+			while not g_bQuit:
+				if time.time() >= rNext:
+					nStarted = self.poll()
+					rNext = time.time() + self.opts.rPoll
+					if self.opts.bOnce and (nStarted == 0) and (not self.dRunning) \
+						and (not self.dSeen) and (not self._retries_waiting()):
+						break
+				self.collect(max(0.05, min(rNext - time.time(), self.opts.rPoll)))
+
+			# Let the files in progress finish, they are summarized already or
+			# about to be
+			while self.dRunning: self.collect(1.0)
+		finally:
+			self.pool.shutdown()
+
+		return self.dCount
+
+	def _retries_waiting(self):
+		"""Are files still waiting for a retry?  Files deleted or moved away
+		while waiting are never found again, so they don't count."""
+		return any(
+			(d['status'] == 'retry') and os.path.exists(s)
+			for (s, d) in self.dState.items()
+		)
+
+# ############################################################################ #
+
+def main():
+	"""Program entry point, run with -h for usage information.
+
+	Returns:
+		A standard integer success or fail code suitable for return to
+		the calling shell. 0 = success, non-zero = various error conditions
+	"""
+	psr = argparse.ArgumentParser(formatter_class=common.BreakFormatter)
+	psr.description = '''\
+		Watch directories for complete raw mag-screening data files, then
+		fit, plot and summarize each one, the same as mag_screen does for
+		data it collects.  Directories are searched recursively.'''
+	psr.epilog = '''\
+	Author: chris-piker@uiowa.edu, cole-dorman@uiowa.edu\v
+	Source: https://research-git.uiowa.edu/space-physics/utilities/python/vangse
+	'''
+
+	psr.add_argument(
+		'-s', '--summary', dest="sSummary", metavar="FILE", type=str,
+		default="ScreenResults.csv", help="The summary file to append results "+\
+		"to.  If no directory is given it is placed in the first watched "+\
+		"directory.  Defaults to %(default)s."
+	)
+	psr.add_argument(
+		'-f', '--format', dest='sFmt', metavar='FORMAT', default='pdf',
+		choices=('pdf', 'png', 'none'), help="Plot format, 'pdf', 'png' or "+\
+		"'none' to skip plotting.  Plots are written next to the data file.  "+\
+		"Defaults to %(default)s."
+	)
+	psr.add_argument(
+		'-j', '--jobs', dest='nJobs', metavar='N', type=int, default=2,
+		help='Number of worker processes, defaults to %(default)s.'
+	)
+	psr.add_argument(
+		'-q', '--queue', dest='nQueue', metavar='N', type=int, default=None,
+		help='Most files to hand to the workers at once, defaults to twice '+\
+		'the number of workers.'
+	)
+	psr.add_argument(
+		'--marker', dest='sMarker', metavar='SUFFIX', default=None,
+		help='A data file is complete when a file with this suffix added to '+\
+		'its name exists, for example .done for part1.csv.done.  By default '+\
+		'files are complete once their size stops changing, see --settle.'
+	)
+	psr.add_argument(
+		'--settle', dest='rSettle', metavar='SEC', type=float, default=10.0,
+		help='Without --marker, a file is complete after its size and '+\
+		'modification time are unchanged for this long.  Defaults to %(default)s.'
+	)
+	psr.add_argument(
+		'--poll', dest='rPoll', metavar='SEC', type=float, default=5.0,
+		help='Seconds between directory scans, defaults to %(default)s.'
+	)
+	psr.add_argument(
+		'--retries', dest='nRetries', metavar='N', type=int, default=3,
+		help='Times to retry a file that fails, defaults to %(default)s.'
+	)
+	psr.add_argument(
+		'--backoff', dest='rBackoff', metavar='SEC', type=float, default=30.0,
+		help='Delay before the first retry, doubled for each one after.  '+\
+		'Defaults to %(default)s.'
+	)
+	psr.add_argument(
+		'--state', dest='sState', metavar='FILE', default=None,
+		help='The file that records which data files are done, defaults to '+\
+		'.mag_screen_ingest.json in the first watched directory.'
+	)
+	psr.add_argument(
+		'--full-res', dest='bFullRes', action='store_true', default=False,
+		help='Plot every time series point, see mag_screen_plot.'
+	)
+	psr.add_argument(
+		'--once', dest='bOnce', action='store_true', default=False,
+		help='Exit when every complete file has been processed and no '+\
+		'retries are waiting, instead of running until interrupted.'
+	)
+	psr.add_argument("lDirs", metavar="DIR", nargs='+', help="Directories to watch.")
+
+	opts = psr.parse_args()
+
+	for sDir in opts.lDirs:
+		if not os.path.isdir(sDir):
+			perr("ERROR: %s is not a directory\n"%sDir)
+			return 3
+	if opts.nJobs < 1:
+		perr("ERROR: At least one worker is needed\n")
+		return 3
+	if opts.nQueue is None: opts.nQueue = 2*opts.nJobs
+	opts.nQueue = max(opts.nQueue, 1)
+	if opts.sFmt == 'none': opts.sFmt = None
+
+	if os.sep not in opts.sSummary:
+		opts.sSummary = os.path.join(opts.lDirs[0], opts.sSummary)
+	opts.sSummary = os.path.abspath(opts.sSummary)
+	if not opts.sState:
+		opts.sState = os.path.join(opts.lDirs[0], '.mag_screen_ingest.json')
+
+	signal.signal(signal.SIGINT, setQuit)
+	signal.signal(signal.SIGTERM, setQuit)
+
+	profiling.enable_from_env('mag_screen_ingest')
+	try:
+		perr("INFO:  Watching %s, summary in %s\n"%(', '.join(opts.lDirs), opts.sSummary))
+		ing = Ingester(opts.lDirs, opts)
+		dCount = ing.run()
+	finally:
+		profiling.finish()
+
+	perr("INFO:  %d files done, %d failed, %d retries\n"%(
+		dCount['done'], dCount['failed'], dCount['retried']
+	))
+	return 5 if dCount['failed'] > 0 else 0
+
+# Run the main function if this is a top level script
+if __name__ == "__main__":
+	sys.exit(main())
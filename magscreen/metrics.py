@@ -0,0 +1,305 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bench monitoring metrics in the Prometheus text format
+
+Counters, gauges and histograms are kept in memory and written to a file
+for the node_exporter textfile collector, so no network service is needed.
+Point mag_screen or mag_screen_daemon at the collector directory with
+--metrics or the MAGSCREEN_METRICS environment variable:
+
+  MAGSCREEN_METRICS=/var/lib/node_exporter/textfile_collector
+
+A directory gets one file per program, PROGRAM.prom, otherwise the value
+is the file name.  Files are replaced atomically so the collector never
+sees a partial write.  Counters and histograms are loaded from the old file
+when metrics are enabled, so totals keep growing across one-shot mag_screen
+runs and daemon restarts.  Every sample carries a program label.
+
+The metrics are listed in g_dDefs.  Rates such as runs per hour are left to
+Prometheus, for example:
+
+  rate(magscreen_runs_total[1h]) * 3600
+  histogram_quantile(0.9, rate(magscreen_stage_seconds_bucket[1d]))
+
+Stage latencies come from the profiling spans, see profiling.add_listener().
+All recording functions do nothing until enable() is called.
+"""
+
+import os
+import re
+import sys
+import threading
+
+import magscreen.profiling as profiling
+
+perr = sys.stderr.write  # shorten a long function name
+
+# Stage times in seconds, from a quick CSV write to a long acquisition
+g_lStageBuckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# name: (type, help text, histogram buckets)
+g_dDefs = {
+	'magscreen_runs_total': ('counter',
+		'Screening runs by outcome, ok, interrupted or error, and by rig if several', None),
+	'magscreen_last_run_timestamp_seconds': ('gauge',
+		'Unix time at which the last screening run ended', None),
+	'magscreen_results_total': ('counter',
+		'Screening results by status, FAILED, CAUTION or PASSED', None),
+	'magscreen_samples_total': ('counter',
+		'Samples received from each sensor, by UART serial number', None),
+	'magscreen_dropped_samples_total': ('counter',
+		'Samples expected from the data rate but not received', None),
+	'magscreen_sample_rate_hz': ('gauge',
+		'Samples per second received from each sensor during the last run', None),
+	'magscreen_stage_seconds': ('histogram',
+		'Wall clock time of each processing stage', g_lStageBuckets),
+}
+
+# The active registry, None when metrics are off
+g_reg = None
+
+# ########################################################################## #
+
+def _fmt_val(rVal):
+	if rVal == float('inf'): return '+Inf'
+	if float(rVal).is_integer() and abs(rVal) < 1e15: return '%d'%rVal
+	return repr(float(rVal))
+
+def _escape(sVal):
+	return sVal.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _unescape(sVal):
+	return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), sVal)
+
+def _fmt_labels(tLabels):
+	if not tLabels: return ''
+	return '{%s}'%','.join('%s="%s"'%(k, _escape(v)) for (k, v) in tLabels)
+
+# metric{labels} value [timestamp]
+g_reSample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)')
+g_reLabel = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+class Registry:
+	"""The metric values for one program"""
+
+	def __init__(self, sProgram, sFile):
+		"""
+		Args:
+			sProgram (str): Added to every sample as the program label
+			sFile (str): The textfile collector file to write
+		"""
+		self.sProgram = sProgram
+		self.sFile = sFile
+		self.lock = threading.Lock()
+		self.lockWrite = threading.Lock()  # Threads share the temporary file name
+
+		# name: {labels tuple: value}, histogram values are
+		# [per bucket counts, sum, count]
+		self.dVals = dict((sName, {}) for sName in g_dDefs)
+
+	def _key(self, sName, dLabels):
+		if sName not in g_dDefs: raise KeyError("Unknown metric %s"%sName)
+		return tuple(sorted((k, str(v)) for (k, v) in dLabels.items()))
+
+	def inc(self, sName, rAmount, dLabels):
+		tKey = self._key(sName, dLabels)
+		with self.lock:
+			dSeries = self.dVals[sName]
+			dSeries[tKey] = dSeries.get(tKey, 0) + rAmount
+
+	def set(self, sName, rVal, dLabels):
+		tKey = self._key(sName, dLabels)
+		with self.lock:
+			self.dVals[sName][tKey] = rVal
+
+	def observe(self, sName, rVal, dLabels):
+		tKey = self._key(sName, dLabels)
+		lBuckets = g_dDefs[sName][2]
+		with self.lock:
+			dSeries = self.dVals[sName]
+			if tKey not in dSeries: dSeries[tKey] = [[0]*(len(lBuckets) + 1), 0.0, 0]
+			lHist = dSeries[tKey]
+			i = 0
+			while (i < len(lBuckets)) and (rVal > lBuckets[i]): i += 1
+			lHist[0][i] += 1      # The last slot is for +Inf
+			lHist[1] += rVal
+			lHist[2] += 1
+
+	def load(self):
+		"""Add the counter and histogram totals from an existing file
+
+		Series from other programs, unknown metrics and histograms with
+		different buckets are ignored.
+
+		Returns (int): The number of samples loaded
+		"""
+		dHist = {}   # (name, labels): {'le':{bound:cumulative}, 'sum':, 'count':}
+		nLoaded = 0
+		with open(self.sFile) as fIn:
+			for sLine in fIn:
+				if sLine.startswith('#'): continue
+				match = g_reSample.match(sLine.strip())
+				if not match: continue
+				(sName, sLabels, sVal) = match.groups()
+				dLabels = dict(
+					(k, _unescape(v)) for (k, v) in g_reLabel.findall(sLabels or '')
+				)
+				if dLabels.pop('program', None) != self.sProgram: continue
+				try:
+					rVal = float(sVal)
+				except ValueError:
+					continue
+
+				if (sName in g_dDefs) and (g_dDefs[sName][0] == 'counter'):
+					self.inc(sName, rVal, dLabels)
+					nLoaded += 1
+					continue
+
+				for sPart in ('_bucket', '_sum', '_count'):
+					if not sName.endswith(sPart): continue
+					sBase = sName[:-len(sPart)]
+					if (sBase not in g_dDefs) or (g_dDefs[sBase][0] != 'histogram'): break
+					sLe = dLabels.pop('le', None)
+					dCur = dHist.setdefault(
+						(sBase, self._key(sBase, dLabels)), {'le':{}, 'sum':0.0, 'count':0}
+					)
+					if sPart == '_bucket' and sLe is not None:
+						dCur['le'][float(sLe)] = rVal
+					elif sPart == '_sum': dCur['sum'] = rVal
+					elif sPart == '_count': dCur['count'] = int(rVal)
+					nLoaded += 1
+					break
+
+		for ((sName, tKey), dCur) in dHist.items():
+			lBounds = g_dDefs[sName][2] + [float('inf')]
+			if sorted(dCur['le'].keys()) != [float(r) for r in lBounds]: continue
+			lCounts = []
+			rPrev = 0
+			for r in lBounds:
+				lCounts.append(int(dCur['le'][float(r)] - rPrev))
+				rPrev = dCur['le'][float(r)]
+			with self.lock:
+				dSeries = self.dVals[sName]
+				if tKey not in dSeries: dSeries[tKey] = [[0]*len(lBounds), 0.0, 0]
+				lHist = dSeries[tKey]
+				lHist[0] = [a + b for (a, b) in zip(lHist[0], lCounts)]
+				lHist[1] += dCur['sum']
+				lHist[2] += dCur['count']
+
+		return nLoaded
+
+	def text(self):
+		"""Get the metrics in the Prometheus text exposition format"""
+		tProg = (('program', self.sProgram),)
+		lOut = []
+		with self.lock:
+			for sName in sorted(g_dDefs):
+				(sType, sHelp, lBuckets) = g_dDefs[sName]
+				dSeries = self.dVals[sName]
+				if not dSeries: continue
+				lOut.append('# HELP %s %s'%(sName, sHelp))
+				lOut.append('# TYPE %s %s'%(sName, sType))
+				for tKey in sorted(dSeries):
+					tLabels = tProg + tKey
+					if sType != 'histogram':
+						lOut.append('%s%s %s'%(sName, _fmt_labels(tLabels), _fmt_val(dSeries[tKey])))
+						continue
+
+					(lCounts, rSum, nCount) = dSeries[tKey]
+					nCum = 0
+					for (rLe, n) in zip(lBuckets + [float('inf')], lCounts):
+						nCum += n
+						lOut.append('%s_bucket%s %d'%(
+							sName, _fmt_labels(tLabels + (('le', _fmt_val(rLe)),)), nCum
+						))
+					lOut.append('%s_sum%s %s'%(sName, _fmt_labels(tLabels), _fmt_val(rSum)))
+					lOut.append('%s_count%s %d'%(sName, _fmt_labels(tLabels), nCount))
+
+		return '\n'.join(lOut) + '\n'
+
+	def write(self):
+		"""Replace the metrics file, the new file is renamed into place"""
+		sDir = os.path.dirname(self.sFile)
+		if len(sDir) > 0: os.makedirs(sDir, exist_ok=True)
+
+		# The collector only reads *.prom, so the temporary file is skipped
+		sTmp = os.path.join(sDir, '.%s.%d.tmp'%(os.path.basename(self.sFile), os.getpid()))
+		with self.lockWrite:
+			try:
+				with open(sTmp, 'w', newline='\n') as fOut:
+					fOut.write(self.text())
+					fOut.flush()
+					os.fsync(fOut.fileno())
+				os.replace(sTmp, self.sFile)
+			finally:
+				if os.path.exists(sTmp): os.remove(sTmp)
+
+# ########################################################################## #
+
+def inc(sName, rAmount=1, **dLabels):
+	"""Add to a counter, labels are given as keywords"""
+	if g_reg is not None: g_reg.inc(sName, rAmount, dLabels)
+
+def set_gauge(sName, rVal, **dLabels):
+	"""Set a gauge value, labels are given as keywords"""
+	if g_reg is not None: g_reg.set(sName, rVal, dLabels)
+
+def observe(sName, rVal, **dLabels):
+	"""Add a value to a histogram, labels are given as keywords"""
+	if g_reg is not None: g_reg.observe(sName, rVal, dLabels)
+
+
+def _on_span(sName, rWall):
+	observe('magscreen_stage_seconds', rWall, stage=sName)
+
+
+def enable(sProgram, sPath):
+	"""Turn on metrics for this process
+
+	Args:
+		sProgram (str): The program name, used for the program label and
+			for the file name if sPath is a directory
+		sPath (str): The metrics file, or the collector directory
+
+	Returns (Registry): The active registry
+	"""
+	global g_reg
+	if g_reg is not None: return g_reg
+
+	if os.path.isdir(sPath): sPath = os.path.join(sPath, '%s.prom'%sProgram)
+
+	reg = Registry(sProgram, sPath)
+	if os.path.isfile(sPath):
+		try:
+			reg.load()
+		except (OSError, ValueError) as exc:
+			perr("WARN:  Could not read old metrics from %s, %s\n"%(sPath, exc))
+
+	g_reg = reg
+	profiling.add_listener(_on_span)
+	return g_reg
+
+
+def write():
+	"""Write the metrics file if metrics are on, errors are only warnings"""
+	if g_reg is None: return
+	try:
+		g_reg.write()
+	except OSError as exc:
+		perr("WARN:  Could not write metrics to %s, %s\n"%(g_reg.sFile, exc))
@@ -0,0 +1,263 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Choose the sample rate, test duration and spectrum segment length
+
+The dipole fit finds the rotation rate as the peak of a Welch spectrum,
+calc.spectrum(), and takes the field amplitude from that peak.  Given the
+expected rotation rate of the turntable this module picks the shortest test
+that meets two targets:
+
+* Frequency resolution:  The bin width, rate/nperseg, must be no larger
+  than the target.  The default target puts the rotation peak 8 bins from
+  zero, clear of the flat top window's main lobe at DC, even if the part
+  turns 25% slower than expected.
+
+* SNR:  The peak amplitude for a part at g_rMoment, as seen by the farthest
+  sensor, over the noise in one bin (ambient noise density g_rNoise), times
+  the square root of the number of segments averaged.
+
+Segment lengths are powers of two.  Since the noise in a bin depends only
+on the bin width, the lowest sample rate that gives the widest allowed bins
+is used, but at least g_nMinRate and 8 samples per turn.  The rate is also
+held to the host's throughput shared among the sensors.  The throughput can
+be given, otherwise it is measured by timing the per-sample work of the
+collector threads, with a large margin for the serial port and packet
+decoding that can't be timed without sensors.
+
+If the targets can't be met within the limits of mag_screen, 1 to 199 Hz
+and 1 s to 1 hour, or the inputs don't make sense, the old fixed defaults
+of 10 Hz, 20 s and 256 point segments are used instead.
+
+The plan is saved with each test: the segment length as the Nperseg property
+of each dataset, which the analysis uses, and a description as the global
+Plan property.
+"""
+
+import sys
+import time
+import math
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+perr = sys.stderr.write  # shorten a long function name
+
+# Defaults and limits
+g_rRotRate = 0.25     # Turns per second, one turn every 4 s, see README.md
+g_rSnr = 10.0
+g_rMoment = 0.005     # [N m T^-1], a tenth of the pass limit in calc.py
+g_rNoise = 1.0        # [nT Hz^-1/2], lab ambient, well above the VMR noise floor
+g_nMinBins = 8        # Rotation peak bin at the default resolution
+g_nMinRate = 4        # [Hz]
+g_nMaxRate = 199      # [Hz], see screen.check_rig_args()
+g_nMaxDuration = 60*60
+g_nPad = 1            # [s], for samples lost while the sensors start
+g_nMinSegLen = 16
+g_nMaxSegLen = 2**16
+g_rEnbw = 3.77        # Equivalent noise bandwidth of the flat top window, bins
+g_rHeadroom = 0.1     # Share of the measured throughput the collectors may use
+
+# Used if no plan can be made, the values before planning was added
+g_nSafeRate = 10
+g_nSafeDuration = 20
+g_nSafeSegLen = 256
+
+Plan = namedtuple('Plan', [
+	'rate', 'duration', 'nperseg', 'segments', 'resolution', 'snr',
+	'rotation', 'throughput', 'fallback'
+])
+
+def measure_throughput(rSeconds=0.2, nThreads=3):
+	"""Estimate the samples per second this host can collect
+
+	Times the per-sample work of tlvmr.VMR.run() in several threads at
+	once, then applies g_rHeadroom for the serial reads and packet decoding
+	done by the sensor library.
+
+	Args:
+		rSeconds (float): How long to run the timing loop
+		nThreads (int): Collector threads to run at once
+
+	Returns (float): Samples per second for all sensors together
+	"""
+	import struct
+	from magscreen.tlvmr import SampleBuffer
+
+	xPkt = struct.pack('<4f', 1.0, 2.0, 3.0, 4.0)
+	lCounts = [0]*nThreads
+	bGo = [True]
+
+	def _work(i):
+		bufTime = SampleBuffer(1, np.float64)
+		bufVecs = SampleBuffer(3, np.float64)
+		rTime0 = time.time()
+		n = 0
+		while bGo[0]:
+			row = list(struct.unpack('<4f', xPkt))
+			bufTime.append(time.time() - rTime0)
+			bufVecs.append((row[0], row[1], row[2]))
+			n += 1
+		lCounts[i] = n
+
+	lThreads = [threading.Thread(target=_work, args=(i,)) for i in range(nThreads)]
+	rStart = time.perf_counter()
+	for th in lThreads: th.start()
+	time.sleep(rSeconds)
+	bGo[0] = False
+	for th in lThreads: th.join()
+	rElapsed = time.perf_counter() - rStart
+
+	return g_rHeadroom * sum(lCounts) / rElapsed
+
+def _segments(nRate, nDuration, nSegLen):
+	"""Welch segments, with half overlap, in a capture.  A short capture is
+	taken as one shorter segment, see calc.spectrum()"""
+	nSamples = nRate * nDuration
+	if nSamples < nSegLen: return 1
+	return (nSamples - nSegLen) // (nSegLen//2) + 1
+
+def _fallback(rRotRate, rThroughput, sWhy):
+	perr("WARN:  No acquisition plan, %s.  Using %d Hz for %d s.\n"%(
+		sWhy, g_nSafeRate, g_nSafeDuration
+	))
+	return Plan(
+		g_nSafeRate, g_nSafeDuration, g_nSafeSegLen,
+		_segments(g_nSafeRate, g_nSafeDuration, g_nSafeSegLen),
+		g_nSafeRate / min(g_nSafeSegLen, g_nSafeRate*g_nSafeDuration), None,
+		rRotRate, rThroughput, sWhy
+	)
+
+def make_plan(rRotRate, nSensors, rFarM, rThroughput, rResolution=None,
+	rSnr=g_rSnr, rMoment=g_rMoment, rNoise=g_rNoise
+):
+	"""Choose the sample rate, duration and segment length for a test
+
+	See the module description for the method.
+
+	Args:
+		rRotRate (float): The expected rotation rate in turns per second
+		nSensors (int): The number of sensors read at once, including any
+			reference sensor
+		rFarM (float): The distance to the farthest near sensor in meters
+		rThroughput (float): The samples per second the host can collect,
+			for all sensors together, see measure_throughput()
+		rResolution (float): The target frequency resolution in Hz.  If
+			None, rRotRate/g_nMinBins.
+		rSnr (float): The target signal to noise ratio
+		rMoment (float): The dipole moment that must meet the SNR target
+		rNoise (float): Ambient noise density in nT Hz^-1/2
+
+	Returns (Plan): rate [Hz], duration [s], nperseg, the number of segments,
+		the resolution [Hz] and the SNR reached for rMoment, and the inputs
+		rotation and throughput.  fallback is None, or if the targets can't
+		be met, the reason, and the other values are the safe defaults.
+	"""
+	try:
+		if not (rRotRate > 0 and rFarM > 0 and rThroughput > 0 and rSnr > 0 and \
+		        rMoment > 0 and rNoise > 0 and nSensors >= 1):
+			return _fallback(rRotRate, rThroughput, "inputs out of range")
+	except TypeError:
+		return _fallback(rRotRate, rThroughput, "inputs missing")
+
+	if rResolution is None: rResolution = rRotRate / g_nMinBins
+	if not (rResolution > 0):
+		return _fallback(rRotRate, rThroughput, "resolution out of range")
+
+	# Peak amplitude [nT] and the number of averaged segments needed for the
+	# SNR at a bin width of dF:  snr = A/sqrt(2) / (noise*sqrt(ENBW*dF)) * sqrt(K)
+	from magscreen.calc import bmag_from_moment
+	rAmp = bmag_from_moment(rFarM, rMoment) * 1e9
+	rNeed = 2.0 * (rSnr*rNoise)**2 * g_rEnbw / rAmp**2   # K/dF must be this or more
+
+	nMinRate = max(g_nMinRate, int(math.ceil(8*rRotRate)))
+	nMaxRate = min(g_nMaxRate, int(rThroughput // nSensors))
+	if nMaxRate < nMinRate:
+		return _fallback(rRotRate, rThroughput,
+			"%.0f samples/s is too slow for %d sensors at %d Hz"%(rThroughput, nSensors, nMinRate)
+		)
+
+	tBest = None
+	nSegLen = g_nMinSegLen
+	while nSegLen <= g_nMaxSegLen:
+		nRate = min(nMaxRate, int(math.floor(nSegLen * rResolution)))
+		if nRate >= nMinRate:
+			rBin = nRate / nSegLen
+			nSegs = max(1, int(math.ceil(rNeed * rBin)))
+			nDuration = int(math.ceil(nSegLen * (nSegs + 1) / (2.0 * nRate))) + g_nPad
+			tKey = (nDuration, nRate)
+			if (tBest is None) or (tKey < tBest[0]):
+				tBest = (tKey, nRate, nDuration, nSegLen, rBin)
+		nSegLen *= 2
+
+	if tBest is None:
+		return _fallback(rRotRate, rThroughput,
+			"%.3g Hz resolution needs more than %d point segments"%(rResolution, g_nMaxSegLen)
+		)
+
+	(tKey, nRate, nDuration, nSegLen, rBin) = tBest
+	if nDuration > g_nMaxDuration:
+		return _fallback(rRotRate, rThroughput,
+			"the targets need %d s, more than %d s"%(nDuration, g_nMaxDuration)
+		)
+
+	nSegs = _segments(nRate, nDuration, nSegLen)
+	rSnrOut = rAmp / math.sqrt(2.0 * g_rEnbw * rBin) / rNoise * math.sqrt(nSegs)
+	return Plan(nRate, nDuration, nSegLen, nSegs, rBin, rSnrOut, rRotRate, rThroughput, None)
+
+def describe(plan):
+	"""Get a one line description of a plan, saved as the Plan property"""
+	sOut = "rate %d Hz, duration %d s, nperseg %d, %d segments, "%(
+		plan.rate, plan.duration, plan.nperseg, plan.segments
+	)
+	sOut += "resolution %.4g Hz, "%plan.resolution
+	if plan.rotation is not None: sOut += "rotation %.4g Hz, "%plan.rotation
+	if plan.snr is not None: sOut += "SNR %.3g, "%plan.snr
+	if plan.throughput is not None: sOut += "throughput %.0f samples/s"%plan.throughput
+	else: sOut += "throughput unknown"
+	if plan.fallback: sOut += ", fallback: %s"%plan.fallback
+	return sOut
+
+def apply(opts, rThroughput=None):
+	"""Plan a test from checked rig options, see screen.add_rig_args()
+
+	The rate and duration options are replaced by the planned values and
+	two options are added: nSegLen, the segment length to save with the data
+	and plan, the Plan.
+
+	Args:
+		opts: Options with lDist set, see screen.check_rig_args()
+		rThroughput (float): Samples per second available to this rig, if
+			None the --throughput option is used, and if that isn't given the
+			host is measured
+
+	Returns (Plan): The plan, also saved in opts
+	"""
+	nSensors = len(opts.lDist) + (1 if opts.sRefUart else 0)
+	if rThroughput is None: rThroughput = opts.rThroughput
+	if rThroughput is None: rThroughput = measure_throughput()
+
+	plan = make_plan(
+		opts.rRotRate, nSensors, max(opts.lDist) * 0.01, rThroughput,
+		opts.rResolution, opts.rSnr
+	)
+	opts.sRate = plan.rate
+	opts.sDuration = plan.duration
+	opts.nSegLen = plan.nperseg
+	opts.plan = plan
+	return plan
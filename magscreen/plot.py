@@ -22,19 +22,23 @@ import sys
 import datetime
 import math
 import os.path
+import time
+import threading
 from os.path import dirname as dname
+from math import pi
 import numpy as np
-import scipy.stats as stats
-from scipy.constants import pi
-
-# Plot stuff
-from matplotlib.figure import Figure
 
+# Plot stuff, matplotlib is imported by the page templates when first needed
+# so that batch runs which skip every file never load it.
 
 # Our stuff
 from magscreen.common import BreakFormatter
+from magscreen.common import g_sVersion
+import magscreen.common as common
 import magscreen.semcsv as semcsv
 import magscreen.calc as calc
+import magscreen.results as results
+import magscreen.profiling as profiling
 
 perr = sys.stderr.write  # shorten a long function name
 
@@ -42,7 +46,8 @@ perr = sys.stderr.write  # shorten a long function name
 # Raw Data plots #
 
 def _markMaxAmp(oAxis, aX, aY, sPre, sColor, iRow):
-	"""Helper for raw_plot8, mark the max amplitude values
+	"""Helper for raw_plot3, mark the max amplitude values, returns the
+	annotation.
 
 	Try to be smart about axis angles, if the Y point is above my text then use
 	an up angle, otherwise a down angle.  This is not a good general function,
@@ -71,7 +76,7 @@ def _markMaxAmp(oAxis, aX, aY, sPre, sColor, iRow):
 
 	if lMaxPos[1] > rTextPos: nAngleB = -60
 	else: nAngleB = 60
-	oAxis.annotate(
+	return oAxis.annotate(
 		"%s_max=%.1f"%(sPre, aY[j]), xy=(aX[j], aY[j]), ha='right', va='top', 
 		xycoords='data', textcoords='axes fraction', xytext=(0.98, rTextPos),
 		fontsize=8, arrowprops={
@@ -81,7 +86,209 @@ def _markMaxAmp(oAxis, aX, aY, sPre, sColor, iRow):
 	)
 
 
-def raw_plot3(dProps, lDs, tFigSz=(7.5, 10)):
+def decimate_minmax(aX, aY, nBuckets):
+	"""Reduce a time series for plotting while keeping its envelope
+
+	The series is split into nBuckets runs of consecutive points and only the
+	minimum and maximum point from each run are kept, in time order.  Peaks
+	and dropouts stay visible, unlike simple striding.
+
+	Args:
+		aX (ndarray): The X values, typically time
+		aY (ndarray): The Y values
+		nBuckets (int): The number of buckets, about the pixel width of the
+			plot area.
+
+	Returns: (ndarray, ndarray)
+		The reduced X and Y arrays, at most 2*nBuckets + 2 points long.  If
+		the inputs are already that short they are returned unchanged.
+	"""
+	N = len(aY)
+	if (nBuckets < 1) or (N <= 2*nBuckets + 2):
+		return (aX, aY)
+
+	nPer = N // nBuckets
+	nMain = nPer * nBuckets
+	aBlk = aY[:nMain].reshape((nBuckets, nPer))
+	aBase = np.arange(nBuckets) * nPer
+	lIdx = [
+		[0, N - 1], aBase + np.argmin(aBlk, axis=1), aBase + np.argmax(aBlk, axis=1)
+	]
+	if nMain < N:  # Left over points are one more bucket
+		lIdx.append([nMain + np.argmin(aY[nMain:]), nMain + np.argmax(aY[nMain:])])
+
+	aIdx = np.unique(np.concatenate(lIdx))  # sorted as well
+	return (aX[aIdx], aY[aIdx])
+
+
+class RawPageTemplate:
+	"""A reusable raw data page for up to three sensors.
+
+	Building a figure with subplots, shared axes, titles and grids costs more
+	than drawing a few lines into it.  This object builds the layout once;
+	render() then swaps in the line data, limits, text and max amplitude
+	annotations for each new set of datasets.  The result looks the same as
+	a newly built page.
+
+	Each render() reuses the same figure object, so save or copy the figure
+	before rendering the next page.
+	"""
+	lColor = ['blue','orange','green']
+	lComp  = ['Bx',  'By',    'Bz']
+
+	def __init__(self, tFigSz=(7.5, 10)):
+		from matplotlib.figure import Figure
+		self.fig = Figure(figsize=tFigSz)
+
+		# Set X & Y axis ranges the same for all plots in a column.  By default this
+		# disables the tick labels for common axes.  Sometimes this is not desired
+		# lets manually turn them back on with Axes.tick_params() later on...
+		self.llAx = self.fig.subplots(nrows=3, ncols=2, sharex='col', sharey='col')
+
+		self.fig.subplots_adjust(wspace=0.4, hspace=0.4, left=0.17)
+
+		self.title = self.fig.suptitle('')
+
+		self.llTime = []   # Lines for each row, one per component
+		self.llFreq = []
+		self.lSensor = []  # Sensor label text on the right of each row
+		self.lAnnots = []  # Max amplitude annotations, replaced each time
+
+		for iRow in range(3):
+			(axTime, axFreq) = self.llAx[iRow]
+			self.llTime.append([
+				axTime.plot([], [], "-", color="tab:%s"%s, visible=False)[0]
+				for s in self.lColor
+			])
+			self.llFreq.append([
+				axFreq.plot([], [], "-", color="tab:%s"%s, visible=False)[0]
+				for s in self.lColor
+			])
+
+			# Denote the sensor on the right, more room there.
+			bbox = axFreq.get_position()
+			self.lSensor.append(axFreq.text(bbox.xmax + 0.03, (bbox.ymin + bbox.ymax)/2,
+				'', horizontalalignment='center', verticalalignment='center',
+				rotation='vertical', transform=self.fig.transFigure, fontsize=9,
+				visible=False
+			))
+
+	def _rescale(self, iCol):
+		"""Recompute limits for a column of shared axes from visible lines"""
+		for ax in self.llAx[:, iCol]:
+			ax.relim(visible_only=True)
+		for ax in self.llAx[:, iCol]:
+			ax.autoscale()
+
+	@profiling.timed('plot.raw_page')
+	def render(self, dProps, lDs, bDecimate=True):
+		"""Draw datasets into the page, see raw_plot3() for the arguments
+
+		Returns: figure
+		"""
+		self.title.set_text('Mag Screen Raw Data for:\n%s\non %s'%(
+			dProps['Part'][0], dProps['Timestamp'][0]
+		))
+
+		for ann in self.lAnnots: ann.remove()
+		self.lAnnots = []
+
+		# Blank all rows first.  Rows are then filled in one at a time, with
+		# the limits at each step the same as when building a page from
+		# scratch, since the annotation arrows depend on them.
+		for iRow in range(3):
+			for line in self.llTime[iRow] + self.llFreq[iRow]:
+				line.set_data([], [])
+				line.set_visible(False)
+			self.lSensor[iRow].set_visible(False)
+			for ax in self.llAx[iRow]:
+				ax.grid(False)
+				ax.set_title('')
+				ax.set_xlabel('')
+				ax.set_ylabel('')
+				ax.tick_params(labelbottom=(iRow == 2))
+
+		iRow = 0
+		while (iRow < len(lDs)) and (iRow < 3):
+			ds = lDs[iRow]
+
+			sDistUnits = ds.distance_units
+			if sDistUnits != '[cm]': 
+				raise ValueError("Expect [cm] for distance units, not '%s'"%sDistUnits)
+
+			(axTime, axFreq) = self.llAx[iRow]
+			axTime.grid(True)
+			axFreq.grid(True)                         
+			axTime.tick_params(labelbottom=True) # were auto-turned off by 
+			axFreq.tick_params(labelbottom=True) # subplots() call above
+
+			# One bucket per pixel gives about 2x the pixel width in points
+			nBuckets = 0
+			if bDecimate:
+				nBuckets = int(axTime.get_window_extent().width)
+
+			# Loop over components from a single sensor make time series and freq
+			# plot.  Save the frequency data for later annotation.  We need to
+			# plot everything first or the plot limits are not determined!
+			lXf = [None]*3
+			lYf = [None]*3
+			for i in range(3):
+				sComp = self.lComp[i]
+				aX = ds.vars['Offset'].data
+				aY = ds.vars[sComp].data
+				if nBuckets and (len(aY) > 4*nBuckets):
+					(aX, aY) = decimate_minmax(aX, aY, nBuckets)
+				sUnit = ds.vars[sComp].units
+
+				line = self.llTime[iRow][i]
+				line.set_data(aX, aY)
+				line.set_label("%s [%s]"%(sComp, sUnit))
+				line.set_visible(True)
+
+				(aXf, aYf) = calc.spectrum(ds.require('rate'), ds.vars[sComp], ds.nperseg)
+
+				line = self.llFreq[iRow][i]
+				line.set_data(aXf, aYf)
+				line.set_label("%s Spectra [%s]"%(sComp, sUnit))
+				line.set_visible(True)
+
+				lXf[i] = aXf
+				lYf[i] = aYf
+
+			self._rescale(0)
+			self._rescale(1)
+
+			lSensor = ds.props['Sensor'][0].split()
+			self.lSensor[iRow].set_text(
+				'VMR %s on UART %s'%(lSensor[3], ds.props['UART'][2])
+			)
+			self.lSensor[iRow].set_visible(True)
+
+			# Totally useless statement with knock-on effect to work around a 
+			# matplotlib bug: Transforms have gone stale.  
+			# Really? this wasted 1.5 hours!
+			axFreq.viewLim
+			for i in range(3):
+				self.lAnnots.append(
+					_markMaxAmp(axFreq, lXf[i], lYf[i], self.lComp[i], self.lColor[i], i)
+				)
+
+			axTime.set_xlabel('Time Offset [s]')
+			axTime.set_ylabel('Magnetic Intensity [nT]')
+
+			sTitle = 'At %s %s'%(ds.props['Distance'][0],ds.props['Distance'][1])
+
+			axTime.set_title(sTitle)
+			axFreq.set_xlabel('Frequency [Hz]')
+			axFreq.set_ylabel('Periodic Amplitude [%s]'%(ds.vars['Bx'].units))  # assume same units
+			axFreq.set_title(sTitle)
+
+			iRow += 1 # Next distance, plot it on next row
+
+		return self.fig
+
+
+def raw_plot3(dProps, lDs, tFigSz=(7.5, 10), bDecimate=True):
 	"""Plot the raw data from up to three different mag screening datasets
 	(one from each sensor)
 
@@ -93,109 +300,125 @@ def raw_plot3(dProps, lDs, tFigSz=(7.5, 10)):
 
 		tFigSz (2-tuple): The width and heigh in inches for the plot area
 
+		bDecimate (bool): If True, time series with more points than about
+			four times the plot width in pixels are reduced with
+			decimate_minmax() before plotting.  Spectra use all the data.
+
 	Returns: figure
 		A matplotlib figure object, that contains up to 6 subplots.  Suitable
 		for output as a pdf or png.  
 	"""
+	return RawPageTemplate(tFigSz).render(dProps, lDs, bDecimate)
 
-	fig = Figure(figsize=tFigSz)
-
-	# Set X & Y axis ranges the same for all plots in a column.  By default this
-	# disables the tick labels for common axes.  Sometimes this is not desired
-	# lets manually turn them back on with Axes.tick_params() later on...
-	llAx = fig.subplots(nrows=3, ncols=2, sharex='col', sharey='col')
+# ############################################################################ #
+# Stray field plot #
 
-	fig.subplots_adjust(wspace=0.4, hspace=0.4, left=0.17)
+class DipolePageTemplate:
+	"""A reusable dipole fit page, see RawPageTemplate for the idea.
 
-	fig.suptitle('Mag Screen Raw Data for:\n%s\non %s'%(
-		dProps['Part'][0], dProps['Timestamp'][0]
-	))
+	The error bars are the one item that is rebuilt on each render, matplotlib
+	has no way to update an errorbar container in place.
+	"""
 
-	if len(lDs) == 0:  # Should I just return none here?
-		return fig
+	def __init__(self, tFigSz=(7.5, 10)):
+		from matplotlib.figure import Figure
+		self.fig = Figure(figsize=tFigSz)
+		fig = self.fig
+
+		self.axDipole = fig.add_axes((0.15, 0.5, 0.75, 0.4))
+		self.errbar = None
+		self.lineFit = self.axDipole.plot([], [], 'r-', label='Best Fit Dipole')[0]
+		self.axDipole.grid(True)
+		self.axDipole.set_xlabel('Sensor Distance [cm]')
+		self.axDipole.set_ylabel('Axial Dipole Magnitude [nT]')
+
+		bbox = self.axDipole.get_position()
+		self.notes = self.axDipole.text(bbox.xmin, bbox.ymin - 0.1, '',
+			horizontalalignment='left', verticalalignment='center',
+			transform=fig.transFigure, fontsize=10
+		)
 
-	iDs = 0
-	iRow = 0
-	lColor = ['blue','orange','green']
-	lComp  = ['Bx',  'By',    'Bz']
-	while (iDs < len(lDs)) and (iRow < 3):
-		ds = lDs[iDs]
-
-		float(ds.props['Distance'][0])  # Save distance
-				
-		sDistUnits = ds.props['Distance'][1]
-		if sDistUnits != '[cm]': 
-			raise ValueError("Expect [cm] for distance units, not '%s'"%sDistUnits)
-
-		axTime = llAx[iRow, 0]
-		axFreq = llAx[iRow, 1]
-		axTime.grid(True)
-		axFreq.grid(True)                         
-		axTime.tick_params(labelbottom=True) # were auto-turned off by 
-		axFreq.tick_params(labelbottom=True) # subplots() call above
-
-		# Loop over components from a single sensor make time series and freq plot
-		# Save the frequency data for later annotation.  We need to plot everything
-		# first or the plot limits are not determined!
-		lXf = [None]*3
-		lYf = [None]*3
-		for i in range(3):
-			#perr("plot dist: %s, component: %s\n"%(self.lDist[iDs], lComp[i]))
-			aX = ds.vars['Offset'].data
-			aY = ds.vars[lComp[i]].data
-			sUnit = ds.vars[lComp[i]].units
-			sComp = lComp[i]
-			axTime.plot(
-				aX, aY, "-", label="%s [%s]"%(sComp, sUnit), color="tab:%s"%lColor[i]
-			)
-					
-			(aXf, aYf) = calc.spectrum(float(ds.props['Rate'][0]), ds.vars[sComp])
-					
-			axFreq.plot(aXf, aYf, 
-				"-", label="%s Spectra [%s]"%(sComp, sUnit), color="tab:%s"%lColor[i]
-			)
-			lXf[i] = aXf
-			lYf[i] = aYf
-
-		axFreq.autoscale()
-				
-		# Denote the sensor on the right, more room there.
-		lSensor = ds.props['Sensor'][0].split()
-		bbox = axFreq.get_position()
-		axFreq.text(bbox.xmax + 0.03, (bbox.ymin + bbox.ymax)/2,
-			'VMR %s on UART %s'%(lSensor[3], ds.props['UART'][2]),
-			horizontalalignment='center', verticalalignment='center',
-			rotation='vertical', transform=fig.transFigure, fontsize=9
+		self.axRate = fig.add_axes((0.15, 0.1, 0.3, 0.2))
+		self.lineRate = self.axRate.plot([], [], 'o')[0]
+		self.axRate.set_title('1/2 Peak Field Variation Rate\n(Object Rotation Rate)', fontsize=8)
+		self.axRate.set_ylabel('[Hz]', fontsize=8)
+		self.axRate.set_xlabel('Sensor Distance [cm]', fontsize=8)
+		self.axRate.grid(True)
+
+		self.axAngle = fig.add_axes((0.6, 0.1, 0.3, 0.2), ylim=(0,180))
+		self.lineZ = self.axAngle.plot([], [], 'o', color='green' , label = 'Z axis')[0]
+		self.lineX = self.axAngle.plot([], [], 'o', color='orange', label = 'X axis')[0]
+		self.axAngle.set_title('Angle between dipole axis and X & Z axis', fontsize=8)
+		self.axAngle.set_ylabel('[degrees]', fontsize=8)
+		self.axAngle.set_xlabel('Sensor Distance [cm]', fontsize=8)
+		self.axAngle.legend()
+		self.axAngle.grid(True)
+
+	@profiling.timed('plot.dipole_page')
+	def render(self, dProps, lDs, ana=None):
+		"""Draw datasets into the page, see dipole_plot() for the arguments
+
+		Returns: figure
+		"""
+		axDipole = self.axDipole
+
+		if ana is None: ana = calc.analyze(lDs)
+		(dist, rate, Zangle, Xangle, Bdipole, moment, merror) = ana[:7]
+
+		aFitDist = np.linspace(dist[0], dist[-1], num=30)
+		aFitPts = calc.bmag_from_moment(aFitDist,moment)
+
+		#error of 4 nT from the Twinleaf VMRs
+		VMR_err = 4e-9 #Tesla
+		'''	
+		error of .05 centimeters, since distance in magnetic field calculation as 1/r^3, 
+		error function of sqrt(dB/dr^2 * error_r^2)
+		'''
+		dist_err = .0005 #meters
+		dist_err_calc = ( ((3/2)*(((1.256*10**-6)*(moment))/(2*3.14*dist**4)))**2 * (dist_err)**2 )**.5
+
+		tot_err = (( dist_err_calc**2 + VMR_err**2 )**.5)*1e9 #independent error combined
+
+		# Error bars go under the fit line, so re-add the line after them
+		if self.errbar is not None: self.errbar.remove()
+		self.lineFit.remove()
+		self.errbar = axDipole.errorbar(
+			dist*100, Bdipole*1e9, yerr=tot_err, fmt='bo', capsize=3, label='Calculated Dipole'
 		)
+		self.lineFit.set_data(aFitDist*100, aFitPts*1e9)
+		axDipole.add_line(self.lineFit)
+		axDipole.relim()
+		axDipole.autoscale()
 
-		# Totally useless statement with knock-on effect to work around a 
-		# matplotlib bug: Transforms have gone stale.  
-		# Really? this wasted 1.5 hours!
-		axFreq.viewLim
-		for i in range(3):
-			_markMaxAmp(axFreq, lXf[i], lYf[i], lComp[i], lColor[i], i)
+		(Bstray, BstrayErr, iStatus) = ana[7:]
 
-		axTime.set_xlabel('Time Offset [s]')
-		axTime.set_ylabel('Magnetic Intensity [nT]')
+		axDipole.set_title(
+			 'Mag Screen for: %s\nResult: %s'%(dProps['Part'][0],calc.status_text[iStatus])
+		)
+		axDipole.legend()
 
-		sTitle = 'At %s %s'%(ds.props['Distance'][0],ds.props['Distance'][1])
+		# Calculate a couple other items put them on the plot
+		lNotes = [
+			'Timestamp:            %s'%(dProps['Timestamp'][0]),
+			#'chi-squared = %0.3f'%chi_sq, 'p-value = %0.3f'%p_val,
+			'Dipole Moment:    %.2e ± %0.2e [N m T^-1]'%(moment, merror),
+			'Stray Field @ 1m: %0.2e ± %0.2e [nT]'%(Bstray, BstrayErr)
+		]
+		self.notes.set_text('\n'.join(lNotes))
 
-		axTime.set_title(sTitle)
-		axFreq.set_xlabel('Frequency [Hz]')
-		axFreq.set_ylabel('Periodic Amplitude [%s]'%(ds.vars['Bx'].units))  # assume same units
-		axFreq.set_title(sTitle)
+		self.lineRate.set_data(dist*100, rate/2.0)
+		self.axRate.relim()
+		self.axRate.autoscale()
 
-		# Now for the ledgend
-		
-		iDs += 1  # Next distance please
-		iRow += 1 # Plot it on next row
+		self.lineZ.set_data(dist*100, Zangle*180/pi)
+		self.lineX.set_data(dist*100, Xangle*180/pi)
+		self.axAngle.relim()
+		self.axAngle.autoscale(axis='x')
 
-	return fig
+		return self.fig
 
-# ############################################################################ #
-# Stray field plot #
 
-def dipole_plot(dProps, lDs, tFigSz=(7.5, 10)):
+def dipole_plot(dProps, lDs, tFigSz=(7.5, 10), ana=None):
 	"""Calculate and plot the expected stray field at 1-meter
 
 	Args:
@@ -205,83 +428,38 @@ def dipole_plot(dProps, lDs, tFigSz=(7.5, 10)):
 			set around the rotating object an various distances
 
 		tFigSz (2-tuple): The (width, height) of the figure to generate in inches
-	"""
-
-	fig = Figure(figsize=tFigSz)
-	axDipole = fig.add_axes((0.15, 0.5, 0.75, 0.4))
-
-	(dist, rate, Zangle, Xangle, Bdipole, moment, merror) = calc.dipole_from_rotation(lDs)
-
-	# Using the fitted moment value, provide the field magnitude at 1 meter.
-	Bstray_T    = calc.bmag_from_moment(1, moment)
-	BstrayErr_T = 0.5 * calc.bmag_from_moment(1, merror)
-
-	aFitDist = np.linspace(dist[0], dist[-1], num=30)
-	aFitPts = calc.bmag_from_moment(aFitDist,moment)
-
-	#error of 4 nT from the Twinleaf VMRs
-	VMR_err = 4e-9 #Tesla
-	'''	
-	error of .05 centimeters, since distance in magnetic field calculation as 1/r^3, 
-	error function of sqrt(dB/dr^2 * error_r^2)
-	'''
-	dist_err = .0005 #meters
-	dist_err_calc = ( ((3/2)*(((1.256*10**-6)*(moment))/(2*3.14*dist**4)))**2 * (dist_err)**2 )**.5
-
-	tot_err = (( dist_err_calc**2 + VMR_err**2 )**.5)*1e9 #independent error combined
-
-	axDipole.errorbar(dist*100, Bdipole*1e9, yerr=tot_err, fmt='bo', capsize=3, label='Calculated Dipole')
-	axDipole.plot(aFitDist*100, aFitPts*1e9, 'r-', label='Best Fit Dipole')
-	axDipole.set_title(
-		'Magnetic Screening Dipole Field\n%s\non %s'%(
-		dProps['Part'][0], dProps['Timestamp'][0]
-	))
-	axDipole.grid(True)
-
-	axDipole.set_xlabel('Sensor Distance [cm]')
-	axDipole.set_ylabel('Axial Dipole Magnitude [nT]')
-
-	(Bstray, BstrayErr, iStatus) = calc.stray_field_1m(moment, merror)
-
-	axDipole.set_title(
-		 'Mag Screen for: %s\nResult: %s'%(dProps['Part'][0],calc.status_text[iStatus])
-	)
-	axDipole.legend()
-
-	# Calculate a couple other items put them on the plot
-	lNotes = [
-		'Timestamp:            %s'%(dProps['Timestamp'][0]),
-		#'chi-squared = %0.3f'%chi_sq, 'p-value = %0.3f'%p_val,
-		'Dipole Moment:    %.2e ± %0.2e [N m T^-1]'%(moment, merror),
-		'Stray Field @ 1m: %0.2e ± %0.2e [nT]'%(Bstray, BstrayErr)
-	]
-
-	bbox = axDipole.get_position()
-	axDipole.text(bbox.xmin, bbox.ymin - 0.1, '\n'.join(lNotes),
-		horizontalalignment='left', verticalalignment='center',
-		transform=fig.transFigure, fontsize=10
-	)
 
-	axRate = fig.add_axes((0.15, 0.1, 0.3, 0.2))
+		ana (calc.Analysis): The fit results if already known, for example
+			from results.get(), otherwise the fit is run here
+	"""
+	return DipolePageTemplate(tFigSz).render(dProps, lDs, ana)
 
-	axRate.plot(dist*100, rate/2.0, 'o')
-	axRate.set_title('1/2 Peak Field Variation Rate\n(Object Rotation Rate)', fontsize=8)
-	axRate.set_ylabel('[Hz]', fontsize=8)
-	axRate.set_xlabel('Sensor Distance [cm]', fontsize=8)
-	axRate.grid(True)
+# Page templates kept between calls, keyed by (kind, figure size)
+# Per thread, rigs on one host post process their tests in separate threads
+_g_local = threading.local()
 
-	axAngle = fig.add_axes((0.6, 0.1, 0.3, 0.2), ylim=(0,180))
+def page_template(sKind, tFigSz=(7.5, 10)):
+	"""Get a cached page template, building it on first use
 
-	axAngle.plot(dist*100, Zangle*180/pi, 'o', color='green' , label = 'Z axis')
-	axAngle.plot(dist*100, Xangle*180/pi, 'o', color='orange', label = 'X axis')
+	Args:
+		sKind (str): Either 'raw' or 'dipole'
+		tFigSz (2-tuple): The (width, height) of the page in inches
 
-	axAngle.set_title('Angle between dipole axis and X & Z axis', fontsize=8)
-	axAngle.set_ylabel('[degrees]', fontsize=8)
-	axAngle.set_xlabel('Sensor Distance [cm]', fontsize=8)
-	axAngle.legend()
-	axAngle.grid(True)
+	Returns (RawPageTemplate|DipolePageTemplate):
+		The same object is returned each time for a given kind, size and
+		thread.  Since the template figure is redrawn on each render, finish
+		with one page before rendering the next.
+	"""
+	dTemplates = getattr(_g_local, 'dTemplates', None)
+	if dTemplates is None:
+		dTemplates = _g_local.dTemplates = {}
 
-	return fig
+	tKey = (sKind, tuple(tFigSz))
+	if tKey not in dTemplates:
+		if sKind == 'raw': dTemplates[tKey] = RawPageTemplate(tFigSz)
+		elif sKind == 'dipole': dTemplates[tKey] = DipolePageTemplate(tFigSz)
+		else: raise ValueError("Unknown page template '%s'"%sKind)
+	return dTemplates[tKey]
 
 # ############################################################################ #
 # Plot figure generator #
@@ -290,10 +468,21 @@ class Plotter:
 	"""Generate 1 - N plot pages from magnetic screening data.
 	This is a generator object intended for use in a loop.  The first N pages
 	are all the raw sensor plots.  The last one is always the fit.
+
+	If reuse is True pages are drawn into cached templates, see
+	page_template(), and each figure is only valid until the next page of
+	the same kind is requested.  That is fine for writing pages out one at a
+	time, but collect them into a list with reuse=False.
+
+	A known analysis for the fit page may be given, see dipole_plot().
 	"""
-	def __init__(self, dProps, lDs, figsize=None):
+	def __init__(self, dProps, lDs, figsize=None, decimate=True, reuse=False,
+		analysis=None):
 		self.dProps = dProps
 		self.lDs = lDs
+		self.analysis = analysis
+		self.bDecimate = decimate
+		self.bReuse = reuse
 		self.iPage = 0
 		if figsize:
 			self.tFigSize = figsize
@@ -316,15 +505,54 @@ class Plotter:
 		if self.iPage >= self.nPages:
 			raise StopIteration()
 
-		# Raw plot, or fit plot?
-		if self.iPage < (self.nPages - 1):
-			fig = raw_plot3(self.dProps, self.lDs[self.iPage*3 : self.iPage*3+3])
-		else:
-			fig = dipole_plot(self.dProps, self.lDs)
-			
+		fig = self.page(self.iPage)
 		self.iPage += 1
 		return fig
 
+	def page_data(self, iPage):
+		"""Get the datasets needed to draw a single page"""
+		if iPage < (self.nPages - 1):
+			return self.lDs[iPage*3 : iPage*3+3]
+		return self.lDs
+
+	def page(self, iPage):
+		"""Get the figure for a single page, in any order"""
+		if (iPage < 0) or (iPage >= self.nPages):
+			raise IndexError("Page %d is out of range 0 to %d"%(iPage, self.nPages - 1))
+
+		# Raw plot, or fit plot?
+		if iPage < (self.nPages - 1):
+			if self.bReuse:
+				return page_template('raw', self.tFigSize).render(
+					self.dProps, self.page_data(iPage), self.bDecimate
+				)
+			return raw_plot3(
+				self.dProps, self.page_data(iPage), self.tFigSize, self.bDecimate
+			)
+		else:
+			if self.bReuse:
+				return page_template('dipole', self.tFigSize).render(
+					self.dProps, self.page_data(iPage), self.analysis
+				)
+			return dipole_plot(
+				self.dProps, self.page_data(iPage), self.tFigSize, self.analysis
+			)
+
+# ########################################################################## #
+# Parallel page rendering #
+
+def _png_worker(dProps, lDs, bFit, tFigSize, bDecimate, sFile, dMeta, ana=None):
+	"""Process pool work unit, build one page and write it as a PNG file.
+	Workers keep their page templates between pages since each one is written
+	out before the next task starts.
+	"""
+	import matplotlib.backends.backend_agg as backend
+	if bFit: fig = page_template('dipole', tFigSize).render(dProps, lDs, ana)
+	else: fig = page_template('raw', tFigSize).render(dProps, lDs, bDecimate)
+	canvas = backend.FigureCanvas(fig)
+	canvas.print_png(sFile, metadata=dMeta)
+	return sFile
+
 # ########################################################################## #
 # Plot file generators #
 
@@ -334,7 +562,19 @@ def _to_time(sISO):
 	"""
 	return datetime.datetime(int(sISO[:4]), int(sISO[5:7]), int(sISO[8:10]))
 
-def screen_plot_png(dProps, lDs, sOutFile):
+@profiling.timed('plot.png')
+def screen_plot_png(dProps, lDs, sOutFile, nWorkers=1, bDecimate=True, ana=None):
+	"""Write numbered PNG files, one for each plot page
+
+	Args:
+		dProps (dict): Global properties that apply to all given datasets
+		lDs (list[semcsv.Dataset]): The datasets to plot
+		sOutFile (str): The output file name, page numbers are inserted before
+			the extension, i.e. name.png becomes name.p1.png, name.p2.png, etc.
+		nWorkers (int): The number of processes used to render pages
+		bDecimate (bool): Reduce long time series, see raw_plot3()
+		ana (calc.Analysis): Known fit results, see dipole_plot()
+	"""
 	
 	import matplotlib.backends.backend_agg as backend
 
@@ -342,7 +582,7 @@ def screen_plot_png(dProps, lDs, sOutFile):
 	if len(sDir) > 0:
 		os.makedirs(sDir, 0o755, exist_ok=True)
 	
-	dMeta = {'Software': 'magscreen 0.3'}
+	dMeta = {'Software': g_sVersion}
 	if 'Title' in dProps: dMeta['Title'] = dProps['Title'][0]
 	if 'User' in dProps: dMeta['Author'] = dProps['User'][0]
 	if 'Note' in dProps: dMeta['Description'] = dProps['Note'][0]
@@ -354,26 +594,119 @@ def screen_plot_png(dProps, lDs, sOutFile):
 			lSource.append(ds.props['Sensor'][0])
 		dMeta['Source'] = ', '.join(lSource)
 
-	i = 1
-	for fig in Plotter(dProps, lDs):
-		canvas = backend.FigureCanvas(fig)
-		sFile = "%s.p%d.png"%(sOutFile[:-4], i)
-		perr("INFO:  Writing %s\n"%sFile)
-		canvas.print_png(sFile, metadata=dMeta)
-		i += 1
+	pltr = Plotter(dProps, lDs, decimate=bDecimate, reuse=True, analysis=ana)
+	if (nWorkers <= 1) or (pltr.nPages <= 1):
+		i = 1
+		for fig in pltr:
+			canvas = backend.FigureCanvas(fig)
+			sFile = "%s.p%d.png"%(sOutFile[:-4], i)
+			perr("INFO:  Writing %s\n"%sFile)
+			canvas.print_png(sFile, metadata=dMeta)
+			i += 1
+		return
+
+	# PNG pages are independent files, so workers can write them directly
+	from concurrent.futures import ProcessPoolExecutor
+	with ProcessPoolExecutor(max_workers=min(nWorkers, pltr.nPages)) as pool:
+		lFut = [
+			pool.submit(_png_worker, dProps, pltr.page_data(i),
+				i == (pltr.nPages - 1), pltr.tFigSize, pltr.bDecimate,
+				"%s.p%d.png"%(sOutFile[:-4], i+1), dMeta, ana
+			)
+			for i in range(pltr.nPages)
+		]
+		for fut in lFut:
+			perr("INFO:  Wrote %s\n"%fut.result())
+
+# Lowest preview resolution, below this the page text can't be read
+g_nPreviewMinDpi = 25
+
+# Resolution for the next preview, lowered when one runs over its budget
+_g_nPreviewDpi = None
+
+@profiling.timed('plot.preview')
+def screen_plot_preview(dProps, lDs, sOutFile, nDpi=50, rBudget=3.0, ana=None):
+	"""Write just the dipole fit page as a small PNG, for a quick look at the
+	test result on the bench.
+
+	Args:
+		dProps (dict): Global properties that apply to all given datasets
+		lDs (list[semcsv.Dataset]): The datasets to plot
+		sOutFile (str): The output PNG file name
+		nDpi (int): Output resolution, low values keep rendering fast
+		rBudget (float): Latency budget in seconds.  If a preview takes longer
+			than this, later ones are drawn at a lower resolution, down to
+			g_nPreviewMinDpi, until they fit.  Once they take less than half
+			the budget the resolution is raised again, up to nDpi.
+		ana (calc.Analysis): Known fit results, see dipole_plot()
+
+	Returns (float): The time taken in seconds
+	"""
+	global _g_nPreviewDpi
+	import matplotlib.backends.backend_agg as backend
+
+	rStart = time.time()
 
-def screen_plot_pdf(dProps, lDs, sOutFile):
+	sDir = dname(sOutFile)
+	if len(sDir) > 0:
+		os.makedirs(sDir, 0o755, exist_ok=True)
+
+	dMeta = {'Software': g_sVersion}
+	if 'Title' in dProps: dMeta['Title'] = dProps['Title'][0]
+	if 'Timestamp' in dProps: dMeta['Creation Time'] = dProps['Timestamp'][0]
+
+	nUse = nDpi if _g_nPreviewDpi is None else min(nDpi, _g_nPreviewDpi)
+
+	fig = page_template('dipole').render(dProps, lDs, ana)
+	nDpiSave = fig.get_dpi()
+	fig.set_dpi(nUse)
+	canvas = backend.FigureCanvas(fig)
+	perr("INFO:  Writing %s\n"%sOutFile)
+	canvas.print_png(sOutFile, metadata=dMeta)
+	fig.set_dpi(nDpiSave)
+
+	rElapsed = time.time() - rStart
+	if rElapsed > rBudget:
+		nNext = max(g_nPreviewMinDpi, int(nUse * rBudget / rElapsed))
+		if nNext < nUse:
+			perr("WARN:  Preview took %.1f s, over the %.1f s budget, using %d dpi "\
+				"from now on\n"%(rElapsed, rBudget, nNext))
+		else:
+			perr("WARN:  Preview took %.1f s, over the %.1f s budget even at %d "\
+				"dpi\n"%(rElapsed, rBudget, nUse))
+		_g_nPreviewDpi = nNext
+	elif (rElapsed < 0.5*rBudget) and (nUse < nDpi):
+		_g_nPreviewDpi = min(nDpi, 2*nUse)
+
+	return rElapsed
+
+@profiling.timed('plot.pdf')
+def screen_plot_pdf(dProps, lDs, sOutFile, bDecimate=True, ana=None):
+	"""Write all plot pages to a single PDF file
+
+	Pages are always drawn in this process.  Most of the time goes to drawing
+	them in PdfPages.savefig(), and matplotlib can't merge PDF files drawn
+	elsewhere, so worker processes wouldn't save anything.  Only PNG output
+	is rendered in parallel, see screen_plot_png().
+
+	Args:
+		dProps (dict): Global properties that apply to all given datasets
+		lDs (list[semcsv.Dataset]): The datasets to plot
+		sOutFile (str): The output file name
+		bDecimate (bool): Reduce long time series, see raw_plot3()
+		ana (calc.Analysis): Known fit results, see dipole_plot()
+	"""
 
 	import matplotlib.backends.backend_pdf as backend
 
 	sDir = dname(sOutFile)
-	if not os.path.isdir(sDir):
+	if (len(sDir) > 0) and not os.path.isdir(sDir):
 		os.makedirs(sDir, 0o755, exist_ok=True)
 
 	perr("INFO:  Writing %s\n"%sOutFile)
 	with backend.PdfPages(sOutFile, keep_empty=False) as pdf:
 
-		for fig in Plotter(dProps, lDs):
+		for fig in Plotter(dProps, lDs, decimate=bDecimate, reuse=True, analysis=ana):
 			pdf.savefig(fig)
 
 		dPdf = pdf.infodict()
@@ -382,18 +715,118 @@ def screen_plot_pdf(dProps, lDs, sOutFile):
 		if 'User' in dProps: dPdf['Author'] = dProps['User'][0]
 		if 'Note' in dProps: dPdf['Subject'] = dProps['Note'][0]
 		dPdf['Keywords'] = 'Magnetic Cleanliness Stray-Field dipole raw-data'
+		dPdf['Creator'] = g_sVersion
 		if 'Timestamp' in dProps: 
 			dPdf['CreationDate'] = _to_time(dProps['Timestamp'][0])
 			dPdf['ModDate'] = datetime.datetime.today()
 
 
+# ########################################################################## #
+# Batch plotting #
+
+def _pdf_version(sFile):
+	"""Get the Creator entry from a PDF info dictionary, or None"""
+	with open(sFile, 'rb') as fIn:
+		fIn.seek(0, os.SEEK_END)
+		fIn.seek(max(0, fIn.tell() - 8192))  # Info dict is written last
+		xTail = fIn.read()
+	match = re.search(rb'/Creator \((.*?)\)', xTail)
+	if match: return match.group(1).decode('latin-1')
+	return None
+
+def _png_version(sFile):
+	"""Get the Software text entry from a PNG file, or None"""
+	with open(sFile, 'rb') as fIn:
+		if fIn.read(8) != b'\x89PNG\r\n\x1a\n': return None
+		while True:
+			xHdr = fIn.read(8)
+			if len(xHdr) < 8: return None
+			nLen = int.from_bytes(xHdr[:4], 'big')
+			sType = xHdr[4:]
+			if sType == b'IDAT': return None  # Text chunks come first
+			xData = fIn.read(nLen)
+			fIn.seek(4, os.SEEK_CUR)  # CRC
+			if sType in (b'tEXt', b'iTXt'):
+				(xKey, _, xVal) = xData.partition(b'\x00')
+				if xKey == b'Software':
+					if sType == b'iTXt': xVal = xVal[2:].split(b'\x00', 2)[-1]
+					return xVal.decode('latin-1')
+
+def is_current(sIn, sOut, sExt):
+	"""Is a plot output file newer than its input and made by this software
+	version?
+
+	Args:
+		sIn (str): The raw data CSV file
+		sOut (str): The output file, for PNG output the page 1 file name is
+			derived from this the same way as in screen_plot_png()
+		sExt (str): Either '.pdf' or '.png'
+	"""
+	if sExt == '.png': sOut = "%s.p1.png"%sOut[:-4]
+	if not os.path.isfile(sOut): return False
+	if os.path.getmtime(sOut) < os.path.getmtime(sIn): return False
+
+	try:
+		if sExt == '.png': sVer = _png_version(sOut)
+		else: sVer = _pdf_version(sOut)
+	except OSError:
+		return False
+
+	return sVer == g_sVersion
+
+@profiling.timed('plot.plot_file')
+def plot_file(sIn, sOut=None, sFmt=None, nWorkers=1, bDecimate=True, bForce=False):
+	"""Read one raw data file and write its plots
+
+	Args:
+		sIn (str): The input CSV file
+		sOut (str): The output file, defaults to the input with a .pdf suffix
+		sFmt (str): 'pdf' or 'png', or None to use the output file extension
+		nWorkers (int): The number of processes used to render PNG pages,
+			PDF pages are always drawn in this process
+		bDecimate (bool): Reduce long time series, see raw_plot3()
+		bForce (bool): Write the output even if it is already current
+
+	Returns (str): One of 'plotted' or 'skipped'
+	"""
+	if not sOut:
+		sOut = re.sub(r'.csv', r'.pdf', sIn, flags=re.IGNORECASE)
+
+	sExt = sOut.lower()[-4:]
+	if sFmt: sExt = '.'+sFmt.lower()
+	if sExt not in ('.pdf', '.png'):
+		raise ValueError("Unknown output type '%s'"%sExt)
+
+	if (not bForce) and is_current(sIn, sOut, sExt):
+		return 'skipped'
+
+	(dProps, lDs) = semcsv.read(sIn)
+
+	perr('INFO:  Loaded %d global props, %d datasets, and %d variables from %s\n'%(
+		len(dProps), len(lDs), sum( [len(ds.vars) for ds in lDs]), sIn
+	))
+
+	# Use the stored fit if there is a current one
+	ana = None
+	if len(lDs) > 0: ana = results.get(sIn, dProps, lDs)[1]
+
+	if sExt == '.pdf':
+		screen_plot_pdf(dProps, lDs, sOut, bDecimate, ana)
+	else:
+		screen_plot_png(dProps, lDs, sOut, nWorkers, bDecimate, ana)
+
+	return 'plotted'
+
 # ########################################################################## #
 def main():
 
 	psr = argparse.ArgumentParser(formatter_class=BreakFormatter)
 	psr.description = '''\
-	Read a single set of mag-screen data as generated by tlvmr.write_mag_vecs
-	and generate raw data and projected stray field plots.
+	Read sets of mag-screen data as generated by tlvmr.write_mag_vecs
+	and generate raw data and projected stray field plots.  Inputs may be
+	files, directories (searched recursively for *.csv files) or glob
+	patterns.  Outputs that are newer than their input and were written by
+	this software version are skipped.
 	'''
 	psr.epilog = 'Authors: chris-piker@uiowa.edu, cole-dorman@uiowa.edu'
 
@@ -401,7 +834,7 @@ def main():
 		help='Set a specific output filename.  An absolute path may be given '+\
 		'in which  case directories are created as needed.  By default the '+\
 		'output filename is the same as the input file with the suffix '+\
-		'changed to .pdf'
+		'changed to .pdf.  Only valid for a single input file.'
 	)
 
 	psr.add_argument('-f','--format',dest='sFmt',metavar='FORMAT',default=None,
@@ -410,34 +843,84 @@ def main():
 		"(without the quotes)."
 	)
 
-	psr.add_argument("sIn", metavar="CSV_FILE", help="The input filename. Should be a CSV file.")
-
-	opts = psr.parse_args()
-
-	if not opts.sIn.lower().endswith('.csv'):
-		perr("ERROR: Expected a csv file for input")
-
-	if not opts.sOut: 
-		opts.sOut = re.sub(r'.csv', r'.pdf', opts.sIn, flags=re.IGNORECASE)
+	psr.add_argument('-j','--jobs',dest='nJobs',metavar='N',type=int,default=1,
+		help='Use N worker processes.  For a single file, PNG pages are '+\
+		'rendered in parallel, PDF pages are not.  Otherwise whole files are '+\
+		'plotted in parallel.  Defaults to 1, which '+\
+		'does everything in the main process.'
+	)
 
-	(dProps, lDs) = semcsv.read(opts.sIn)
+	psr.add_argument('--full-res',dest='bFullRes',action='store_true',
+		default=False, help='Plot every time series point.  By default long '+\
+		'time series are reduced to about twice the plot width in pixels '+\
+		'using min/max bucketing, which keeps peaks visible.'
+	)
 
-	perr('INFO:  Loaded %d global props, %d datasets, and %d variables from %s\n'%(
-		len(dProps), len(lDs), sum( [len(ds.vars) for ds in lDs]), opts.sIn
-	))
-	
-	sExt = opts.sOut.lower()[-4:]
+	psr.add_argument('--force',dest='bForce',action='store_true',default=False,
+		help='Regenerate plots even if the outputs are already current.'
+	)
 
-	if opts.sFmt:
-		sExt = '.'+opts.sFmt.lower()
+	psr.add_argument("lIn", metavar="CSV_FILE", nargs='+',
+		help="Input files, directories or glob patterns."
+	)
 
-	if sExt == '.pdf':
-		screen_plot_pdf(dProps, lDs, opts.sOut)
-	elif sExt == '.png':
-		screen_plot_png(dProps, lDs, opts.sOut)
-	else:
-		perr("ERROR: Unknown output type '%s'\n"%sExt)
+	opts = psr.parse_args()
 
+	lFiles = common.expand_inputs(opts.lIn)
+	if len(lFiles) == 0:
+		perr("ERROR: No input files found in %s\n"%', '.join(opts.lIn))
+		return 3
+
+	if opts.sOut and (len(lFiles) > 1):
+		perr("ERROR: --out can only be used with a single input file\n")
+		return 3
+
+	for sFile in lFiles:
+		if not sFile.lower().endswith('.csv'):
+			perr("WARN:  Expected a csv file for input, got %s\n"%sFile)
+
+	profiling.enable_from_env('mag_screen_plot')
+	try:
+		rStart = time.time()
+		dCount = {'plotted':0, 'skipped':0, 'failed':0}
+		bDecimate = not opts.bFullRes
+
+		if (len(lFiles) == 1) or (opts.nJobs <= 1):
+			for sFile in lFiles:
+				try:
+					sRes = plot_file(sFile, opts.sOut, opts.sFmt, opts.nJobs, bDecimate, opts.bForce)
+				except (semcsv.ParseError, KeyError, IndexError, ValueError, OSError,
+					RuntimeError) as exc:
+					perr("ERROR: Could not plot %s, %s\n"%(sFile, exc))
+					sRes = 'failed'
+				dCount[sRes] += 1
+		else:
+			# One file per worker, each worker keeps its imports between files
+			from concurrent.futures import ProcessPoolExecutor
+			with ProcessPoolExecutor(max_workers=opts.nJobs) as pool:
+				lFut = [
+					pool.submit(plot_file, sFile, None, opts.sFmt, 1, bDecimate, opts.bForce)
+					for sFile in lFiles
+				]
+				for (sFile, fut) in zip(lFiles, lFut):
+					try:
+						sRes = fut.result()
+					except (semcsv.ParseError, KeyError, IndexError, ValueError, OSError,
+						RuntimeError) as exc:
+						perr("ERROR: Could not plot %s, %s\n"%(sFile, exc))
+						sRes = 'failed'
+					dCount[sRes] += 1
+
+		rElapsed = time.time() - rStart
+		nDone = dCount['plotted'] + dCount['skipped'] + dCount['failed']
+		perr("INFO:  %d plotted, %d skipped, %d failed in %.1f s (%.2f files/s)\n"%(
+			dCount['plotted'], dCount['skipped'], dCount['failed'], rElapsed,
+			nDone / rElapsed if rElapsed > 0 else 0.0
+		))
+	finally:
+		profiling.finish()
+
+	if dCount['failed'] > 0: return 5
 	return 0
 
 
@@ -0,0 +1,347 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Optional timing of the processing stages
+
+Named spans record wall clock time, CPU time of the running thread and
+peak traced memory.  Functions are marked with the timed() decorator, and
+smaller blocks with the span() context manager:
+
+  @profiling.timed('calc.spectrum')
+  def spectrum(vTime, vData): ...
+
+  with profiling.span('acquire'):
+    ...
+
+Both cost one global lookup when profiling is off, which is the default.
+It is turned on by enable(), by mag_screen --profile, or for any of the
+programs by setting MAGSCREEN_PROFILE to a report file name (or to 1 for
+an automatic name).  At exit a JSON report is written with every span in
+start order and totals for each span name.
+
+If a hot stage is named, by --profile-hot or MAGSCREEN_PROFILE_HOT, the
+first span with that name is also run under cProfile and the statistics
+are saved next to the report as REPORT.STAGE.pstats, readable with:
+
+  python -m pstats REPORT.STAGE.pstats
+
+Other modules may also ask to be told the wall clock time of every span,
+see add_listener().  When only listeners are registered spans are timed
+with a single clock call at each end and nothing else is recorded.
+
+Memory figures come from tracemalloc, which tracks numpy arrays as well as
+python objects, but not memory used by other processes such as the PDF
+renderer.  The peak is process wide, so spans that overlap in different
+threads share it.  Tracing memory slows python code down two or three times,
+and imports about five times.  Set MAGSCREEN_PROFILE_MEM=0 to skip memory
+figures and get times close to those of a normal run.
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+import functools
+
+perr = sys.stderr.write  # shorten a long function name
+
+# The active profiler, None when profiling is off
+g_prof = None
+
+# Functions called as fn(sName, rWall) when any span ends
+g_lListeners = []
+
+if hasattr(time, 'thread_time'):
+	_cpu_time = time.thread_time
+else:
+	_cpu_time = time.process_time   # Python 3.6, includes all threads
+
+# ########################################################################## #
+
+class _NullSpan:
+	"""Does nothing, returned by span() when profiling is off"""
+	def __enter__(self): return self
+	def __exit__(self, *args): return False
+
+_g_null = _NullSpan()
+
+
+def _notify(sName, rWall):
+	for fn in g_lListeners:
+		fn(sName, rWall)
+
+
+class _WallSpan:
+	"""Times a span for the listeners only, used when the profiler is off"""
+	def __init__(self, sName):
+		self.sName = sName
+
+	def __enter__(self):
+		self.rStart = time.perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		_notify(self.sName, time.perf_counter() - self.rStart)
+		return False
+
+
+class _Span:
+	def __init__(self, prof, sName):
+		self.prof = prof
+		self.sName = sName
+
+	def __enter__(self):
+		self.prof._begin(self)
+		return self
+
+	def __exit__(self, *args):
+		self.prof._end(self)
+		return False
+
+
+class Profiler:
+	"""Collects spans for one run of a program"""
+
+	def __init__(self, sProgram, sReport, sHot=None, bMemory=True):
+		"""
+		Args:
+			sProgram (str): The program name, saved in the report
+			sReport (str): The JSON report file to write on finish()
+			sHot (str): Name of a span to run under cProfile, or None
+			bMemory (bool): Record peak memory for each span
+		"""
+
+		self.sProgram = sProgram
+		self.sReport = sReport
+		self.sHot = sHot
+		self.cprof = None
+		self.bHotDone = False
+		self.lSpans = []
+		self.lock = threading.Lock()
+		self.local = threading.local()   # Per thread stack of open spans
+		self.rWall0 = time.time()
+		self.rPerf0 = time.perf_counter()
+
+		self.tracemalloc = None
+		if bMemory:
+			import tracemalloc
+			self.tracemalloc = tracemalloc
+			if not tracemalloc.is_tracing(): tracemalloc.start()
+
+	def _memory(self):
+		"""Get the (current, peak) traced memory, zeros if not tracing"""
+		if self.tracemalloc: return self.tracemalloc.get_traced_memory()
+		return (0, 0)
+
+	def _stack(self):
+		if not hasattr(self.local, 'stack'): self.local.stack = []
+		return self.local.stack
+
+	def _begin(self, sp):
+		lStack = self._stack()
+
+		# Fold the memory peak so far into the enclosing span before resetting
+		(nCur, nPeak) = self._memory()
+		if lStack: lStack[-1].nPeak = max(lStack[-1].nPeak, nPeak)
+		if hasattr(self.tracemalloc, 'reset_peak'): self.tracemalloc.reset_peak()
+
+		sp.nDepth = len(lStack)
+		sp.sThread = threading.current_thread().name
+		sp.nMem0 = nCur
+		sp.nPeak = nCur
+		lStack.append(sp)
+
+		# cProfile only sees the thread that enables it
+		if (sp.sName == self.sHot) and (self.cprof is None) and \
+		   (threading.current_thread() is threading.main_thread()):
+			import cProfile
+			self.cprof = cProfile.Profile()
+			sp.bHot = True
+			self.cprof.enable()
+		else:
+			sp.bHot = False
+
+		sp.rStart = time.perf_counter()
+		sp.rCpu0 = _cpu_time()
+
+	def _end(self, sp):
+		rWall = time.perf_counter() - sp.rStart
+		rCpu = _cpu_time() - sp.rCpu0
+
+		if sp.bHot:
+			self.cprof.disable()
+			self.bHotDone = True
+
+		(nCur, nPeak) = self._memory()
+		sp.nPeak = max(sp.nPeak, nPeak)
+
+		lStack = self._stack()
+		if lStack and (lStack[-1] is sp): lStack.pop()
+		if lStack: lStack[-1].nPeak = max(lStack[-1].nPeak, sp.nPeak)
+
+		dSpan = {
+			'name':sp.sName, 'thread':sp.sThread, 'depth':sp.nDepth,
+			'start':round(sp.rStart - self.rPerf0, 6), 'wall':round(rWall, 6),
+			'cpu':round(rCpu, 6)
+		}
+		if self.tracemalloc:
+			dSpan['peak_kb'] = round((sp.nPeak - sp.nMem0)/1024.0, 1)
+			dSpan['net_kb'] = round((nCur - sp.nMem0)/1024.0, 1)
+
+		with self.lock:
+			self.lSpans.append(dSpan)
+
+		_notify(sp.sName, rWall)
+
+	def span(self, sName):
+		return _Span(self, sName)
+
+	def report(self):
+		"""Get the report as a dictionary"""
+		with self.lock:
+			lSpans = sorted(self.lSpans, key=lambda d: d['start'])
+
+		dTotals = {}
+		for dSp in lSpans:
+			if dSp['name'] not in dTotals:
+				dTotals[dSp['name']] = {'count':0, 'wall':0.0, 'cpu':0.0}
+			dTot = dTotals[dSp['name']]
+			dTot['count'] += 1
+			dTot['wall'] = round(dTot['wall'] + dSp['wall'], 6)
+			dTot['cpu'] = round(dTot['cpu'] + dSp['cpu'], 6)
+			if 'peak_kb' in dSp:
+				dTot['peak_kb'] = max(dTot.get('peak_kb', 0.0), dSp['peak_kb'])
+
+		dRep = {
+			'program':self.sProgram,
+			'argv':sys.argv,
+			'pid':os.getpid(),
+			'started':time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.rWall0)),
+			'wall':round(time.perf_counter() - self.rPerf0, 6),
+			'cpu':round(time.process_time(), 6),
+			'totals':dTotals,
+			'spans':lSpans
+		}
+		if self.tracemalloc:
+			dRep['traced_peak_kb'] = round(self._memory()[1]/1024.0, 1)
+		try:
+			import resource
+			dRep['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		except ImportError:
+			pass   # Not available on Windows
+
+		if self.cprof and self.bHotDone:
+			dRep['hot_stage'] = {'name':self.sHot, 'pstats':self.sReport + '.%s.pstats'%self.sHot}
+		return dRep
+
+	def write(self):
+		"""Write the JSON report, and the hot stage statistics if collected"""
+		dRep = self.report()
+		sDir = os.path.dirname(self.sReport)
+		if len(sDir) > 0: os.makedirs(sDir, exist_ok=True)
+		with open(self.sReport, 'w') as fOut:
+			json.dump(dRep, fOut, indent=1)
+		perr("INFO:  Profile report written to %s\n"%self.sReport)
+
+		if 'hot_stage' in dRep:
+			self.cprof.dump_stats(dRep['hot_stage']['pstats'])
+			perr("INFO:  Profile of stage %s written to %s\n"%(
+				self.sHot, dRep['hot_stage']['pstats']
+			))
+
+# ########################################################################## #
+
+def span(sName):
+	"""Get a context manager that times a block of code as a named span"""
+	if g_prof is None:
+		if not g_lListeners: return _g_null
+		return _WallSpan(sName)
+	return g_prof.span(sName)
+
+
+def timed(sName):
+	"""Decorator that times every call of a function as a named span"""
+	def decorate(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			if (g_prof is None) and not g_lListeners: return func(*args, **kwargs)
+			with span(sName):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorate
+
+
+def add_listener(fn):
+	"""Call fn(sName, rWall) with the name and wall clock time in seconds of
+	every span as it ends, whether or not profiling is on.  Listeners may be
+	called from any thread.
+	"""
+	if fn not in g_lListeners: g_lListeners.append(fn)
+
+
+def enable(sProgram, sReport=None, sHot=None, bMemory=None):
+	"""Turn on profiling for this process
+
+	Args:
+		sProgram (str): The program name, used for the default report name
+		sReport (str): The JSON report file, defaults to
+			PROGRAM_YYYYmmddTHHMMSS.profile.json in the current directory
+		sHot (str): A span name to also run under cProfile
+		bMemory (bool): Record peak memory for each span.  If None, memory
+			is recorded unless MAGSCREEN_PROFILE_MEM is 0.
+
+	Returns (Profiler): The active profiler
+	"""
+	global g_prof
+	if g_prof is not None: return g_prof
+
+	if bMemory is None:
+		sMem = os.environ.get('MAGSCREEN_PROFILE_MEM', '1').strip().lower()
+		bMemory = sMem not in ('0','no','false','off')
+
+	if not sReport:
+		sReport = '%s_%s.profile.json'%(sProgram, time.strftime('%Y%m%dT%H%M%S'))
+
+	g_prof = Profiler(sProgram, sReport, sHot, bMemory)
+	return g_prof
+
+
+def enable_from_env(sProgram):
+	"""Turn on profiling if the MAGSCREEN_PROFILE environment variable is set
+
+	The variable gives the report file name, or 1 for an automatic name.
+	MAGSCREEN_PROFILE_HOT may name a stage to run under cProfile.
+
+	Returns (Profiler): The active profiler, or None
+	"""
+	sVal = os.environ.get('MAGSCREEN_PROFILE', '').strip()
+	if (not sVal) or (sVal.lower() in ('0','no','false','off')): return None
+	if sVal.lower() in ('1','yes','true','on'): sVal = None
+	return enable(sProgram, sVal, os.environ.get('MAGSCREEN_PROFILE_HOT') or None)
+
+
+def finish():
+	"""Write the report if profiling is on, and turn profiling off"""
+	global g_prof
+	if g_prof is None: return
+	prof = g_prof
+	g_prof = None
+	try:
+		prof.write()
+	except OSError as exc:
+		perr("WARN:  Could not write profile report, %s\n"%exc)
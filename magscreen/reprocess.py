@@ -0,0 +1,291 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Re-summarize an archive of raw data files after the analysis changes
+
+A JSON manifest kept next to the output summary records, for each raw data
+file, its size, modification time and SHA-256 hash, the software version
+that analyzed it and the resulting summary row.  On later runs only files
+that are new, have changed or were analyzed by a different software version
+are fit again, in a pool of worker processes.  A complete new summary file
+is then written with the rows sorted by test time and file name, so that
+the output does not depend on the order in which workers finish.
+
+Run as:  mag_screen_sum reprocess -o NEW_SUMMARY.csv ARCHIVE_DIR ...
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import magscreen.common as common
+import magscreen.profiling as profiling
+
+perr = sys.stderr.write  # shorten a long function name
+
+g_nManifestVer = 1
+
+# Save the manifest after this many files, so that an interrupted run can
+# pick up where it left off
+g_nSaveEvery = 200
+
+def manifest_path(sSummary):
+	"""Get the default manifest file name for an output summary"""
+	return os.path.splitext(sSummary)[0] + '.manifest.json'
+
+def load_manifest(sFile):
+	"""Read a manifest, a missing or unreadable file gives an empty one
+
+	Returns (dict): File entries keyed by absolute path
+	"""
+	if not os.path.isfile(sFile): return {}
+	try:
+		with open(sFile) as fIn:
+			dMan = json.load(fIn)
+	except (OSError, ValueError) as exc:
+		perr("WARN:  Ignoring unreadable manifest %s, %s\n"%(sFile, exc))
+		return {}
+	if dMan.get('manifest_version') != g_nManifestVer: return {}
+	return dMan.get('files', {})
+
+def save_manifest(sFile, dFiles):
+	"""Write a manifest, the new file is renamed into place"""
+	sDir = os.path.dirname(sFile)
+	if len(sDir) > 0: os.makedirs(sDir, exist_ok=True)
+	sTmp = '%s.%d.tmp'%(sFile, os.getpid())
+	with open(sTmp, 'w') as fOut:
+		json.dump(
+			{'manifest_version':g_nManifestVer, 'software':common.g_sVersion,
+			 'files':dFiles}, fOut, indent=1, sort_keys=True
+		)
+	os.replace(sTmp, sFile)
+
+def is_current(dEntry, dStat):
+	"""Is a manifest entry still good for a file?
+
+	Args:
+		dEntry (dict): The manifest entry, or None
+		dStat (dict): The file's current 'size' and 'mtime_ns'
+	"""
+	import magscreen.calc as calc
+	return (dEntry is not None) and (dEntry.get('version') == common.g_sVersion) \
+		and (dEntry.get('algorithm', calc.g_sAlgorithm) == calc.algorithm()) \
+		and (dEntry.get('size') == dStat['size']) \
+		and (dEntry.get('mtime_ns') == dStat['mtime_ns'])
+
+# ########################################################################## #
+
+def analyze_file(sFile, dOld=None):
+	"""Fit one raw data file, runs in a worker process
+
+	Args:
+		sFile (str): The raw data file
+		dOld (dict): The manifest entry from last time, or None.  If the
+			file contents still match the recorded hash and the entry is from
+			this software version and algorithm the old result is reused.  Otherwise the
+			file's stored analysis is used if it is current, see results.py.
+
+	Returns (dict): The new manifest entry.  Keys are hash, version,
+		algorithm, status, which is 'ok' or 'failed', and either row or
+		error.  If the file couldn't be read there is no hash, see
+		reprocess().
+	"""
+	import magscreen.semcsv as semcsv
+	import magscreen.summary as summary
+	import magscreen.calc as calc
+
+	dEntry = {'version':common.g_sVersion, 'algorithm':calc.algorithm()}
+	try:
+		sHash = common.file_hash(sFile)
+	except OSError as exc:
+		return dict(dEntry, status='failed', error=str(exc))
+
+	if dOld and (sHash == dOld.get('hash')) and (dOld.get('version') == common.g_sVersion) \
+		and (dOld.get('algorithm', calc.g_sAlgorithm) == dEntry['algorithm']):
+		return dict(dOld)   # Only the time stamp changed
+
+	dEntry['hash'] = sHash
+	try:
+		import magscreen.results as results
+
+		# The fit is only run if the file's stored result is missing or is
+		# from a different version of the algorithm
+		(dProps, ana) = results.get(sFile)
+
+		# The software column names the version that did the analysis
+		dRow = dict(dProps)
+		dRow['Version'] = [common.g_sVersion]
+		for sKey in ('Part', 'Timestamp', 'User'):
+			if sKey not in dRow: dRow[sKey] = ['']
+		dEntry['row'] = list(summary.make_row(
+			dRow, ana.moment, ana.Bstray, calc.status_text[ana.status]
+		))
+		dEntry['status'] = 'ok'
+
+	except (semcsv.ParseError, KeyError, IndexError, ValueError, RuntimeError,
+		OSError) as exc:
+		dEntry['status'] = 'failed'
+		dEntry['error'] = str(exc)
+
+	return dEntry
+
+
+@profiling.timed('reprocess')
+def reprocess(lInputs, sSummary, sManifest=None, nJobs=1, bForce=False):
+	"""Re-summarize an archive of raw data files
+
+	Args:
+		lInputs (list of str): Files, directories or glob patterns
+		sSummary (str): The summary file to write, replaced if it exists
+		sManifest (str): The manifest file, see manifest_path() for the default
+		nJobs (int): Number of worker processes
+		bForce (bool): Analyze every file even if the manifest entry is current
+
+	Returns (dict): Counts of files 'analyzed', 'reused' and 'failed'.  Files
+		that failed before and have not changed are counted as failed.
+	"""
+	import magscreen.summary as summary
+	import magscreen.sumindex as sumindex
+
+	if not sManifest: sManifest = manifest_path(sSummary)
+	dOldMan = load_manifest(sManifest)
+
+	lFiles = [
+		os.path.abspath(s) for s in common.expand_inputs(lInputs) if common.is_raw_data(s)
+	]
+	sSumAbs = os.path.abspath(sSummary)
+	lFiles = [s for s in lFiles if s != sSumAbs]
+
+	# Decide what needs work from the file system alone
+	dMan = {}
+	lTodo = []
+	for sFile in lFiles:
+		try:
+			st = os.stat(sFile)
+		except OSError:
+			continue   # Moved away since the directory was read
+		dStat = {'size':st.st_size, 'mtime_ns':st.st_mtime_ns}
+		dOld = dOldMan.get(sFile)
+		if (not bForce) and is_current(dOld, dStat):
+			dMan[sFile] = dOld
+		else:
+			lTodo.append((sFile, dStat, dOld))
+
+	nOldFail = len([d for d in dMan.values() if d.get('status') == 'failed'])
+	dCount = {
+		'analyzed':0, 'reused':len(dMan) - nOldFail, 'failed':nOldFail
+	}
+	perr("INFO:  %d raw data files, %d to analyze\n"%(len(lFiles), len(lTodo)))
+
+	def _done(sFile, dStat, dEntry):
+		dEntry.update(dStat)
+		# Read errors, such as permissions, may be fixed without touching the
+		# file, so those files aren't remembered and are tried again next run
+		if 'hash' in dEntry: dMan[sFile] = dEntry
+		dCount['failed' if dEntry['status'] == 'failed' else 'analyzed'] += 1
+		if dEntry['status'] == 'failed':
+			perr("ERROR: Could not analyze %s, %s\n"%(sFile, dEntry['error']))
+		if (dCount['analyzed'] + dCount['failed']) % g_nSaveEvery == 0:
+			save_manifest(sManifest, dict(dOldMan, **dMan))
+
+	if (nJobs <= 1) or (len(lTodo) <= 1):
+		for (sFile, dStat, dOld) in lTodo:
+			_done(sFile, dStat, analyze_file(sFile, dOld))
+	else:
+		from concurrent.futures import ProcessPoolExecutor, as_completed
+		with ProcessPoolExecutor(max_workers=nJobs) as pool:
+			dFut = dict(
+				(pool.submit(analyze_file, sFile, dOld), (sFile, dStat))
+				for (sFile, dStat, dOld) in lTodo
+			)
+			for fut in as_completed(dFut):
+				(sFile, dStat) = dFut[fut]
+				_done(sFile, dStat, fut.result())
+
+	save_manifest(sManifest, dMan)   # Files no longer in the archive drop out
+
+	# Deterministic output, independent of worker completion order
+	def _key(tItem):
+		rTime = sumindex.parse_time(tItem[1]['row'][1])
+		return (rTime if rTime is not None else float('inf'), tItem[0])
+
+	lOk = sorted(
+		[(s, d) for (s, d) in dMan.items() if d.get('status') == 'ok'], key=_key
+	)
+
+	sDir = os.path.dirname(sSummary)
+	if len(sDir) > 0: os.makedirs(sDir, exist_ok=True)
+	sTmp = '%s.%d.tmp'%(sSummary, os.getpid())
+	with open(sTmp, 'w', newline='') as fOut:
+		fOut.write(summary.g_sHeader)
+		for (sFile, dEntry) in lOk:
+			fOut.write(summary.format_row(dEntry['row']))
+	os.replace(sTmp, sSummary)
+	summary.update_index(sSummary, bFull=True)
+
+	return dCount
+
+# ########################################################################## #
+
+def main(lArgs):
+	psr = argparse.ArgumentParser(
+		prog='mag_screen_sum reprocess', formatter_class=common.BreakFormatter
+	)
+	psr.description = \
+	"""Analyze every raw data file in an archive and write a new summary
+	file.  A manifest of file hashes, software versions and results is kept
+	so that later runs only analyze files that are new, changed, or were
+	analyzed by a different software version."""
+
+	psr.add_argument('-o', '--out', dest='sOut', metavar='SUMMARY_FILE',
+		required=True, help='The summary file to write.  It is replaced, '+\
+		'not appended to.'
+	)
+	psr.add_argument('-M', '--manifest', dest='sManifest', metavar='FILE',
+		default=None, help='The manifest file, defaults to SUMMARY_FILE '+\
+		'with a .manifest.json extension.'
+	)
+	psr.add_argument('-j', '--jobs', dest='nJobs', metavar='N', type=int,
+		default=os.cpu_count() or 1, help='Use N worker processes, defaults '+\
+		'to the number of CPUs.'
+	)
+	psr.add_argument('--force', dest='bForce', action='store_true', default=False,
+		help='Analyze every file, ignoring the manifest.'
+	)
+	psr.add_argument("lIn", metavar="ARCHIVE", nargs='+',
+		help="Raw data files, directories (searched recursively) or glob patterns."
+	)
+
+	opts = psr.parse_args(lArgs)
+
+	profiling.enable_from_env('mag_screen_sum')
+	try:
+		rStart = time.time()
+		dCount = reprocess(opts.lIn, opts.sOut, opts.sManifest, opts.nJobs, opts.bForce)
+	except OSError as exc:
+		perr("ERROR: %s\n"%exc)
+		return 4
+	finally:
+		profiling.finish()
+
+	perr("INFO:  %d analyzed, %d reused, %d failed in %.1f s, summary written to %s\n"%(
+		dCount['analyzed'], dCount['reused'], dCount['failed'], time.time() - rStart,
+		opts.sOut
+	))
+	return 5 if dCount['failed'] > 0 else 0
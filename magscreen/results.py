@@ -0,0 +1,161 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Analysis results stored next to raw data files
+
+The dipole fit for a raw data file is saved in a small JSON file with the
+same name and a .result.json extension, part1_2022_07_01T10_00_00.result.json
+for part1_2022_07_01T10_00_00.csv.  Along with the fit it records the
+global properties of the test and the size, modification time and SHA-256
+hash of the raw data file.
+
+Programs that need the fit, mag_screen_plot, mag_screen_sum and the
+reprocess command, call get(), which uses the stored result if it was made
+by the current analysis algorithm, calc.algorithm(), and the raw data file
+has not changed.  Otherwise the fit is run again and the result file is
+replaced.  Raw data files themselves are never modified.
+"""
+
+import os
+import sys
+import json
+
+import numpy as np
+
+import magscreen.calc as calc
+import magscreen.common as common
+from magscreen.common import g_sVersion
+
+perr = sys.stderr.write  # shorten a long function name
+
+g_nFormat = 1
+
+# Analysis fields that are arrays, one value per sensor
+g_lArrays = ['dist', 'rate', 'Zangle', 'Xangle', 'Bdipole']
+
+def sidecar_path(sFile):
+	"""Get the result file name for a raw data file"""
+	return os.path.splitext(sFile)[0] + '.result.json'
+
+def save(sFile, dProps, ana):
+	"""Write the result file for a raw data file
+
+	The raw data file must be completely written first, its size and hash
+	are saved to tie the result to it.
+
+	Args:
+		sFile (str): The raw data file
+		dProps (dict): The global properties of the test
+		ana (calc.Analysis): The results, see calc.analyze()
+
+	Returns (str): The result file name
+	"""
+	st = os.stat(sFile)
+	dResult = dict(
+		(sKey, np.asarray(getattr(ana, sKey), dtype=float).tolist()) for sKey in g_lArrays
+	)
+	for sKey in ('moment', 'merror', 'Bstray', 'BstrayErr'):
+		dResult[sKey] = float(getattr(ana, sKey))
+	dResult['status'] = calc.status_text[ana.status]
+
+	dOut = {
+		'format':g_nFormat, 'algorithm':calc.algorithm(), 'software':g_sVersion,
+		'size':st.st_size, 'mtime_ns':st.st_mtime_ns, 'sha256':common.file_hash(sFile),
+		'props':dProps, 'result':dResult
+	}
+
+	sOut = sidecar_path(sFile)
+	sTmp = '%s.%d.tmp'%(sOut, os.getpid())
+	with open(sTmp, 'w') as fOut:
+		json.dump(dOut, fOut, indent=1, sort_keys=True)
+	os.replace(sTmp, sOut)
+	return sOut
+
+def load(sFile):
+	"""Read the result file for a raw data file, if it is still good
+
+	A result is good if it was made by the current analysis algorithm and
+	the raw data file has the recorded size and either the recorded
+	modification time or, for files that were copied, the recorded hash.
+
+	Args:
+		sFile (str): The raw data file
+
+	Returns (dProps, ana): The global properties of the test and a
+		calc.Analysis, or None if there is no good result
+	"""
+	sSide = sidecar_path(sFile)
+	if not os.path.isfile(sSide): return None
+	try:
+		with open(sSide) as fIn:
+			dIn = json.load(fIn)
+		st = os.stat(sFile)
+	except (OSError, ValueError) as exc:
+		perr("WARN:  Ignoring unreadable result file %s, %s\n"%(sSide, exc))
+		return None
+
+	if (dIn.get('format') != g_nFormat) or (dIn.get('algorithm') != calc.algorithm()):
+		return None
+	if dIn.get('size') != st.st_size: return None
+	if dIn.get('mtime_ns') != st.st_mtime_ns:
+		try:
+			if dIn.get('sha256') != common.file_hash(sFile): return None
+		except OSError:
+			return None
+
+	try:
+		dRes = dIn['result']
+		ana = calc.Analysis(
+			*[np.array(dRes[sKey], dtype=float) for sKey in g_lArrays],
+			moment=dRes['moment'], merror=dRes['merror'], Bstray=dRes['Bstray'],
+			BstrayErr=dRes['BstrayErr'], status=calc.status_text.index(dRes['status'])
+		)
+		return (dIn['props'], ana)
+	except (KeyError, TypeError, ValueError) as exc:
+		perr("WARN:  Ignoring bad result file %s, %s\n"%(sSide, exc))
+		return None
+
+def get(sFile, dProps=None, lDs=None, bSave=True):
+	"""Get the analysis of a raw data file, from its result file if possible
+
+	Args:
+		sFile (str): The raw data file
+		dProps (dict): The file's global properties, if already read
+		lDs (list[semcsv.Dataset]): The file's datasets, if already read.  If
+			None and there is no good result file, the raw data file is read.
+		bSave (bool): Write a new result file if the fit is run.  Failures to
+			write it, say on a read-only archive, are only warnings.
+
+	Returns (dProps, ana): The global properties of the test and a
+		calc.Analysis
+	"""
+	tStored = load(sFile)
+	if tStored is not None:
+		return (tStored[0] if dProps is None else dProps, tStored[1])
+
+	if lDs is None:
+		import magscreen.semcsv as semcsv
+		(dProps, lDs) = semcsv.read(sFile)
+
+	ana = calc.analyze(lDs)
+	if bSave:
+		try:
+			save(sFile, dProps, ana)
+		except OSError as exc:
+			perr("WARN:  Could not save analysis results for %s, %s\n"%(sFile, exc))
+
+	return (dProps, ana)
@@ -0,0 +1,390 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Several screening fixtures driven from one host
+
+A rig file describes each fixture, or rig, on the host: its sensors, their
+distances and where its output goes.  It is an INI file with one [rig NAME]
+section per fixture and an optional [host] section for the resources the
+rigs share, for example:
+
+  [host]
+  max_rate = 150    # Samples per second from all sensors on all rigs
+  workers = 1       # Rigs that may process their results at once
+
+  [rig bench1]
+  uarts = DT04H6OF,DT04H6OX,DT04H6NY
+  radius = 9,11,15
+  out_dir = /data/screening/bench1
+
+  [rig bench2]
+  uarts = DT04H6M8,DT04H6OY
+  radius = 10,15
+  freq = 20
+  out_dir = /data/screening/bench2
+
+Rig keys are the long mag_screen option names with _ in place of -: freq,
+time, radius, uarts, ref_uart, ref_radius, calib, out_dir, summary,
+preview, defer_pdf, plan, resolution and snr.  Keys that are not given take their value from the [DEFAULT]
+section, if any, then from the command line.  See etc/rigs.ini.
+
+The rigs share the host fairly:
+
+* USB: A UART may only be used by one rig.  If max_rate is given and the
+  rigs ask for more than that in total, rates are lowered so that each
+  sensor gets an equal share.  Rigs asking for less than their share keep
+  their rate and what they leave is split among the others.  Rigs that
+  plan their tests, see planner.py, plan with their share of the host's
+  throughput, by sensor count, and plan again if max_rate lowers their rate.
+
+* CPU: All rigs collect at once, but only `workers` rigs fit, summarize
+  and plot their data at a time, the others wait their turn.  PDFs are
+  rendered by one pool of `workers` processes, started before any sensor
+  threads.
+
+Each test is written to its rig's output directory and summary file, and
+the rig name is saved with the test data as the Rig property.  Rigs may
+share a summary file.
+"""
+import sys
+import os
+import copy
+import threading
+import configparser
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import magscreen.common as common
+import magscreen.screen as screen
+
+perr = sys.stderr.write  # shorten a long function name
+
+# Rig file key: (option name, type), see screen.add_rig_args()
+g_dKeys = {
+	'freq':('sRate', int), 'time':('sDuration', int), 'radius':('sRadii', str),
+	'uarts':('sUarts', str), 'ref_uart':('sRefUart', str),
+	'ref_radius':('nRefRadius', int), 'calib':('sCalFile', str),
+	'out_dir':('sOutDir', str), 'summary':('sSummary', str),
+	'preview':('bPreview', bool), 'defer_pdf':('bDeferPdf', bool),
+	'plan':('rRotRate', float), 'resolution':('rResolution', float),
+	'snr':('rSnr', float)
+}
+
+# ############################################################################ #
+
+class Host:
+	"""Processing resources shared by the rigs on a host
+
+	Args:
+		nWorkers (int): The number of rigs that may process results at once,
+			also the number of PDF rendering processes
+	"""
+	def __init__(self, nWorkers=1):
+		self.nWorkers = nWorkers
+		self.semWork = threading.BoundedSemaphore(nWorkers)
+		self.pool = None
+
+	def start(self, lRigs):
+		"""Start the PDF workers, if any rig renders PDFs
+
+		Call this before any sensors are opened, so that the worker processes
+		are not forked while sensor threads are running.
+		"""
+		for rig in lRigs:
+			if not (rig.opts.bPreview or rig.opts.bDeferPdf): break
+		else:
+			return
+
+		self.pool = ProcessPoolExecutor(max_workers=self.nWorkers)
+		for fut in [self.pool.submit(os.getpid) for i in range(self.nWorkers)]:
+			fut.result()
+
+	def close(self):
+		"""Stop the PDF workers, if any"""
+		if self.pool: self.pool.shutdown()
+		self.pool = None
+
+	def process(self, rig, dTest):
+		"""Write the data, plots and summary line for a test on one rig
+
+		Waits while the allowed number of other rigs are processing, then
+		runs screen.post_process().
+
+		Args:
+			rig (screen.Rig): A rig holding data from Rig.acquire()
+			dTest (dict): Test properties, see Rig.test_properties()
+
+		Returns (sFile, tResult): See screen.post_process()
+		"""
+		with self.semWork:
+			try:
+				return screen.post_process(rig.lCollectors, dTest, rig.opts, self.pool)
+			except BrokenProcessPool:
+				# Sensor threads are running now, so the new workers must not be
+				# forked from this process, see common.process_pool()
+				if self.pool: self.pool.shutdown(wait=False)
+				self.pool = common.process_pool(self.nWorkers)
+				raise
+
+# ############################################################################ #
+
+def _count(opts):
+	"""Get the number of sensors given in unchecked rig options"""
+	return len(opts.sRadii.split(',')) + (1 if opts.sRefUart else 0)
+
+def _sensors(rig):
+	"""Get the UART serial numbers used by a rig with checked options"""
+	return rig.opts.lSerial + ([rig.opts.sRefUart] if rig.opts.sRefUart else [])
+
+def share_rate(lRigs, nMaxRate):
+	"""Lower rig sample rates so that all sensors together stay within a
+	total rate
+
+	The total is shared equally by sensor.  Rigs asking for less than an
+	equal share keep their rate, what they leave is split among the others.
+
+	Args:
+		lRigs (list[screen.Rig]): Rigs with checked options, the sRate option
+			is changed as needed
+		nMaxRate (int): Samples per second from all sensors on all rigs
+
+	Returns (bool): False if the total is too small for 1 Hz per sensor,
+		an error is printed
+	"""
+	nSensors = sum(len(_sensors(rig)) for rig in lRigs)
+	nLeft = nMaxRate
+	for rig in sorted(lRigs, key=lambda rig: rig.opts.sRate):
+		n = len(_sensors(rig))
+		nRate = min(rig.opts.sRate, nLeft // nSensors)
+		if nRate < 1:
+			perr("ERROR: max_rate %d is too low for %d sensors at 1 Hz\n"%(
+				nMaxRate, sum(len(_sensors(rig)) for rig in lRigs)
+			))
+			return False
+		if nRate < rig.opts.sRate:
+			perr("INFO:  Rig %s sample rate lowered from %d to %d Hz, max_rate is %d\n"%(
+				rig.sName, rig.opts.sRate, nRate, nMaxRate
+			))
+			rig.opts.sRate = nRate
+			if rig.opts.plan is not None:
+				import magscreen.planner as planner
+				planner.apply(rig.opts, nRate*n)
+				nRate = rig.opts.sRate
+		nLeft -= nRate*n
+		nSensors -= n
+	return True
+
+def read(sFile, opts):
+	"""Read a rig file, see the module description
+
+	Args:
+		sFile (str): The rig file name
+		opts: Unchecked options from screen.add_rig_args(), these are the
+			defaults for each rig
+
+	Returns (Host, list[screen.Rig]): The shared resources and the rigs in
+		file order, with checked options, or None if the file has errors.
+		Errors are printed.
+	"""
+	cfg = configparser.ConfigParser(
+		inline_comment_prefixes=('#',';'), interpolation=None
+	)
+	try:
+		with open(sFile) as fIn:
+			cfg.read_file(fIn)
+	except (OSError, configparser.Error) as exc:
+		perr("ERROR: Can't read rig file %s, %s\n"%(sFile, exc))
+		return None
+
+	lRigs = []
+	for sSect in cfg.sections():
+		if sSect == 'host': continue
+		lWords = sSect.split()
+		if (len(lWords) != 2) or (lWords[0] != 'rig'):
+			perr("ERROR: Unknown section [%s] in %s, expected [host] or [rig NAME]\n"%(
+				sSect, sFile
+			))
+			return None
+
+		sName = lWords[1]
+		if common.safe_filename(sName) != sName:
+			perr("ERROR: Rig name '%s' in %s may only use letters, digits and _-.,\n"%(
+				sName, sFile
+			))
+			return None
+		if sName in [rig.sName for rig in lRigs]:
+			perr("ERROR: Rig %s is defined twice in %s\n"%(sName, sFile))
+			return None
+
+		optsRig = copy.copy(opts)
+		try:
+			for sKey in cfg.options(sSect):
+				if sKey not in g_dKeys:
+					raise ValueError("unknown key '%s'"%sKey)
+				(sDest, cType) = g_dKeys[sKey]
+				if cType is bool: xVal = cfg.getboolean(sSect, sKey)
+				else: xVal = cType(cfg.get(sSect, sKey))
+				setattr(optsRig, sDest, xVal)
+		except ValueError as exc:
+			perr("ERROR: Rig %s in %s, %s\n"%(sName, sFile, exc))
+			return None
+
+		lRigs.append(screen.Rig(optsRig, sName))
+
+	if len(lRigs) == 0:
+		perr("ERROR: No [rig NAME] sections in %s\n"%sFile)
+		return None
+
+	# Rigs that plan their tests share the host's throughput by sensor count.
+	# The host is measured once, not once per rig.
+	if [rig for rig in lRigs if rig.opts.rRotRate is not None]:
+		import magscreen.planner as planner
+		rHost = opts.rThroughput
+		if rHost is None: rHost = planner.measure_throughput()
+		nTotal = sum(_count(rig.opts) for rig in lRigs)
+		for rig in lRigs:
+			rig.opts.rThroughput = rHost * _count(rig.opts) / nTotal
+
+	for rig in lRigs:
+		if screen.check_rig_args(rig.opts) != 0:
+			perr("ERROR: Bad options for rig %s in %s\n"%(rig.sName, sFile))
+			return None
+
+	# A UART can only be read by one rig
+	dUsed = {}
+	for rig in lRigs:
+		for sSerial in _sensors(rig):
+			if sSerial in dUsed:
+				perr("ERROR: UART %s is used by rigs %s and %s in %s\n"%(
+					sSerial, dUsed[sSerial], rig.sName, sFile
+				))
+				return None
+			dUsed[sSerial] = rig.sName
+
+	nWorkers = 1
+	nMaxRate = None
+	if cfg.has_section('host'):
+		try:
+			for sKey in cfg.options('host'):
+				if sKey in cfg.defaults(): continue
+				if sKey == 'workers': nWorkers = cfg.getint('host', sKey)
+				elif sKey == 'max_rate': nMaxRate = cfg.getint('host', sKey)
+				else: raise ValueError("unknown key '%s'"%sKey)
+		except ValueError as exc:
+			perr("ERROR: Section [host] in %s, %s\n"%(sFile, exc))
+			return None
+		if nWorkers < 1:
+			perr("ERROR: Section [host] in %s, workers must be at least 1\n"%sFile)
+			return None
+
+	if (nMaxRate is not None) and not share_rate(lRigs, nMaxRate):
+		return None
+
+	return (Host(nWorkers), lRigs)
+
+def assign_parts(lParts, lRigs):
+	"""Match parts given as RIG=PART to rigs
+
+	Args:
+		lParts (list[str]): RIG=PART strings.  If there is only one rig,
+			a plain PART may be given.
+		lRigs (list[screen.Rig]): The rigs from read()
+
+	Returns (list[(screen.Rig, str)]): The rigs to run and their parts, or
+		None if a rig is unknown or given twice.  Errors are printed.
+	"""
+	dRigs = dict((rig.sName, rig) for rig in lRigs)
+	lOut = []
+	for sArg in lParts:
+		if ('=' not in sArg) and (len(lRigs) == 1):
+			(sRig, sPart) = (lRigs[0].sName, sArg)
+		else:
+			(sRig, _, sPart) = sArg.partition('=')
+		if sRig not in dRigs:
+			perr("ERROR: Unknown rig in '%s', expected one of %s\n"%(
+				sArg, ', '.join(sorted(dRigs))
+			))
+			return None
+		if len(sPart.strip()) == 0:
+			perr("ERROR: No part given for rig %s\n"%sRig)
+			return None
+		if sRig in [rig.sName for (rig, s) in lOut]:
+			perr("ERROR: More than one part given for rig %s\n"%sRig)
+			return None
+		lOut.append((dRigs[sRig], sPart))
+	return lOut
+
+# ############################################################################ #
+
+def _run_one(host, rig, dTest, dRet):
+	"""Collect and process one test on one rig, the exit code is put in dRet"""
+	nRet = None
+	try:
+		perr("INFO:  Rig %s collecting ~%d seconds of data for %s\n"%(
+			rig.sName, rig.opts.sDuration, dTest['Part']
+		))
+		if not rig.acquire(rig.opts.sDuration, bDisplay=False):
+			perr('WARN:  Rig %s data collection terminated, no output written\n'%rig.sName)
+			nRet = 4
+			return
+
+		host.process(rig, dTest)
+		nRet = 0
+	finally:
+		# nRet is None if an exception is on the way out
+		screen.count_run({0:'ok', 4:'interrupted'}.get(nRet, 'error'), rig.sName)
+		dRet[rig.sName] = 1 if nRet is None else nRet
+
+def run(host, lJobs):
+	"""Collect and process one test on each of several rigs at once
+
+	All sensors are opened before any data are taken.  Use CTRL+C, or
+	SIGTERM if the screen.setQuit() handler is installed, to stop all rigs.
+
+	Args:
+		host (Host): The shared resources
+		lJobs (list[(screen.Rig, dict)]): The rigs to run and the test
+			properties for each, see Rig.test_properties()
+
+	Returns (int): 0 if all tests succeeded, otherwise the exit code of the
+		first that did not, in job order
+	"""
+	host.start([rig for (rig, dTest) in lJobs])
+	try:
+		for (rig, dTest) in lJobs:
+			if not rig.open(): return 15
+
+		perr("MSG:   Use CTRL+C to quit early\n")
+		dRet = {}
+		lThreads = []
+		for (rig, dTest) in lJobs:
+			th = threading.Thread(
+				target=_run_one, args=(host, rig, dTest, dRet), name='rig-%s'%rig.sName
+			)
+			th.start()
+			lThreads.append(th)
+
+		# Join with a timeout so that signals are handled promptly
+		for th in lThreads:
+			while th.is_alive(): th.join(0.5)
+	finally:
+		host.close()
+
+	for (rig, dTest) in lJobs:
+		if dRet.get(rig.sName, 1) != 0: return dRet.get(rig.sName, 1)
+	return 0
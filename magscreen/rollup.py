@@ -0,0 +1,418 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Grouped pass rates, moment distributions and drift from a summary file
+
+The summary is read as a stream, so memory use depends on the number of
+groups, not the number of rows.  Rows can be grouped by part family (the
+part name up to a separator), technician, bench host and time window.  For
+each group the pass, caution and fail counts are kept along with running
+moment statistics, a histogram of log10(moment) for quantiles and the
+sums needed for a least squares trend of moment against time, which shows
+drift on a bench.
+
+The aggregates are saved in a cache next to the summary file, with the
+same name and a .rollup.json extension, along with the position reached in
+the summary.  Later runs with the same grouping only read the rows appended
+since then.  Host names are only kept in the SQLite index, see sumindex, so
+grouping by host reads from the index instead of the CSV file.
+
+Run as:  mag_screen_sum rollup --by prefix,host --window month ScreenResults.csv
+"""
+
+import os
+import sys
+import json
+import math
+import datetime
+import argparse
+
+import magscreen.common as common
+
+perr = sys.stderr.write  # shorten a long function name
+
+g_nCacheVer = 1
+
+g_lDims = ['prefix', 'tech', 'host', 'window']
+g_lWindows = ['day', 'week', 'month', 'year']
+
+# Histogram bins per decade of moment, quantiles are good to about 6%
+g_nBinsPerDecade = 20
+
+# ########################################################################## #
+
+class Aggregate:
+	"""Running statistics for one group of summary rows"""
+
+	def __init__(self):
+		self.nRows = 0
+		self.dResults = {}     # Result text: count
+		self.nMoments = 0      # Rows with a usable moment
+		self.rMean = 0.0       # Welford running mean and sum of squares
+		self.rM2 = 0.0
+		self.rMin = None
+		self.rMax = None
+		self.dHist = {}        # log10 bin: count, for moments > 0
+		self.rT0 = None        # Trend sums, times are in days since rT0
+		self.lTrend = [0, 0.0, 0.0, 0.0, 0.0]   # n, St, Stt, Sm, Stm
+
+	def add(self, sResult, rMoment, rTime):
+		self.nRows += 1
+		self.dResults[sResult] = self.dResults.get(sResult, 0) + 1
+		if (rMoment is None) or math.isnan(rMoment): return
+
+		self.nMoments += 1
+		rDelta = rMoment - self.rMean
+		self.rMean += rDelta / self.nMoments
+		self.rM2 += rDelta * (rMoment - self.rMean)
+		self.rMin = rMoment if self.rMin is None else min(self.rMin, rMoment)
+		self.rMax = rMoment if self.rMax is None else max(self.rMax, rMoment)
+
+		if rMoment > 0:
+			sBin = '%d'%math.floor(math.log10(rMoment)*g_nBinsPerDecade)
+			self.dHist[sBin] = self.dHist.get(sBin, 0) + 1
+
+		if rTime is not None:
+			if self.rT0 is None: self.rT0 = rTime
+			t = (rTime - self.rT0) / 86400.0
+			l = self.lTrend
+			l[0] += 1
+			l[1] += t
+			l[2] += t*t
+			l[3] += rMoment
+			l[4] += t*rMoment
+
+	def quantile(self, rFrac):
+		"""Get a moment quantile from the histogram, or None"""
+		nTotal = sum(self.dHist.values())
+		if nTotal == 0: return None
+		nSeen = 0
+		for nBin in sorted(int(s) for s in self.dHist):
+			nSeen += self.dHist['%d'%nBin]
+			if nSeen >= rFrac*nTotal:
+				rVal = 10**((nBin + 0.5)/g_nBinsPerDecade)
+				return min(max(rVal, self.rMin), self.rMax)   # Bin centers can overshoot
+		return None
+
+	def std(self):
+		if self.nMoments < 2: return None
+		return math.sqrt(self.rM2 / (self.nMoments - 1))
+
+	def trend(self):
+		"""Get the least squares moment change per 30 days, or None"""
+		(n, St, Stt, Sm, Stm) = self.lTrend
+		rDen = n*Stt - St*St
+		if (n < 3) or (rDen <= 0): return None
+		return 30 * (n*Stm - St*Sm) / rDen
+
+	def to_json(self):
+		return self.__dict__
+
+	@staticmethod
+	def from_json(dVals):
+		agg = Aggregate()
+		agg.__dict__.update(dVals)
+		return agg
+
+# ########################################################################## #
+
+def part_prefix(sPart, sSep='-', nChars=None):
+	"""Get the family of a part, the name up to the first separator or the
+	first nChars characters"""
+	if nChars: return sPart[:nChars]
+	if sSep and (sSep in sPart): return sPart.split(sSep, 1)[0]
+	return sPart
+
+def time_window(sTimestamp, sWindow):
+	"""Get a time window label from a summary time stamp.  The date as written
+	on the bench is used, not the UTC date.
+
+	Returns (str): YYYY-MM-DD, YYYY-Www, YYYY-MM or YYYY, or '' if the time
+		stamp can't be read
+	"""
+	try:
+		dt = datetime.date(int(sTimestamp[:4]), int(sTimestamp[5:7]), int(sTimestamp[8:10]))
+	except ValueError:
+		return ''
+	if sWindow == 'day': return dt.isoformat()
+	if sWindow == 'week': return '%04d-W%02d'%dt.isocalendar()[:2]
+	if sWindow == 'month': return dt.isoformat()[:7]
+	return dt.isoformat()[:4]
+
+
+class Rollup:
+	"""Grouped aggregates for a summary file and the read position reached"""
+
+	def __init__(self, lBy, sWindow='month', sSep='-', nChars=None):
+		"""
+		Args:
+			lBy (list of str): Grouping dimensions, from g_lDims
+			sWindow (str): Time window size when grouping by window
+			sSep (str): Part family separator for the prefix dimension
+			nChars (int): Use this many leading characters as the part family
+				instead of splitting on sSep
+		"""
+		for s in lBy:
+			if s not in g_lDims: raise ValueError("Unknown grouping '%s'"%s)
+		if sWindow not in g_lWindows: raise ValueError("Unknown window '%s'"%sWindow)
+
+		self.lBy = lBy
+		self.sWindow = sWindow
+		self.sSep = sSep
+		self.nChars = nChars
+		self.dGroups = {}
+		self.sSource = 'index' if 'host' in lBy else 'csv'
+		self.nPos = 0          # CSV byte offset, or last index row id
+		self.sMark = None      # Check that the data before nPos hasn't changed
+
+	def config(self):
+		"""Get a string that identifies the grouping, used as the cache key"""
+		return 'by=%s;window=%s;sep=%s;chars=%s'%(
+			','.join(self.lBy), self.sWindow, self.sSep, self.nChars
+		)
+
+	def add(self, row, rTime):
+		"""Add one row, see sumindex.g_lCols"""
+		dDim = {
+			'prefix':lambda: part_prefix(row[0], self.sSep, self.nChars),
+			'tech':lambda: row[2], 'host':lambda: row[7] or '',
+			'window':lambda: time_window(row[1], self.sWindow)
+		}
+		sKey = '\t'.join(dDim[s]() for s in self.lBy)
+		if sKey not in self.dGroups: self.dGroups[sKey] = Aggregate()
+		self.dGroups[sKey].add(row[6], row[4], rTime)
+
+	def to_json(self):
+		return {
+			'source':self.sSource, 'pos':self.nPos, 'mark':self.sMark,
+			'groups':dict((k, v.to_json()) for (k, v) in self.dGroups.items())
+		}
+
+	def load(self, dVals):
+		self.nPos = dVals['pos']
+		self.sMark = dVals['mark']
+		self.dGroups = dict(
+			(k, Aggregate.from_json(v)) for (k, v) in dVals['groups'].items()
+		)
+
+	def reset(self):
+		self.dGroups = {}
+		self.nPos = 0
+		self.sMark = None
+
+	# Reading new rows #
+
+	def _csv_mark(self, sCsv, nPos):
+		"""The line just before a CSV file offset"""
+		if nPos == 0: return None
+		with open(sCsv, 'rb') as fIn:
+			fIn.seek(max(0, nPos - 256))
+			return fIn.read(nPos - max(0, nPos - 256)).decode('utf-8', 'replace')
+
+	def _update_csv(self, sCsv):
+		import magscreen.sumindex as sumindex
+
+		nSize = os.path.getsize(sCsv)
+		if (self.nPos > nSize) or (self._csv_mark(sCsv, self.nPos) != self.sMark):
+			perr("INFO:  %s was replaced, recomputing the rollup\n"%sCsv)
+			self.reset()
+
+		nRows = 0
+		for (lLines, nPos) in sumindex.read_lines(sCsv, self.nPos, nSize):
+			for row in sumindex.parse_lines(lLines):
+				self.add(row, sumindex.parse_time(row[1]))
+				nRows += 1
+			self.nPos = nPos
+		self.sMark = self._csv_mark(sCsv, self.nPos)
+		return nRows
+
+	def _update_index(self, sCsv):
+		import magscreen.summary as summary
+		import magscreen.sumindex as sumindex
+
+		summary.update_index(sCsv)
+		idx = sumindex.SummaryIndex(sumindex.index_path(sCsv))
+		try:
+			def _mark(nId):
+				row = idx.con.execute(
+					'SELECT part, timestamp FROM results WHERE id = ?', (nId,)
+				).fetchone()
+				return '%s\t%s'%row if row else None
+
+			if self.nPos and (_mark(self.nPos) != self.sMark):
+				perr("INFO:  %s was re-indexed, recomputing the rollup\n"%sCsv)
+				self.reset()
+
+			nRows = 0
+			cur = idx.con.execute(
+				'SELECT id, utc, %s FROM results WHERE id > ? ORDER BY id'%(
+					', '.join(sumindex.g_lCols)
+				), (self.nPos,)
+			)
+			for tRec in cur:
+				self.add(tRec[2:], tRec[1])
+				self.nPos = tRec[0]
+				nRows += 1
+			self.sMark = _mark(self.nPos) if self.nPos else None
+		finally:
+			idx.close()
+		return nRows
+
+	def update(self, sCsv):
+		"""Add the summary rows appended since the last update
+
+		Returns (int): The number of rows read
+		"""
+		if self.sSource == 'index': return self._update_index(sCsv)
+		return self._update_csv(sCsv)
+
+# ########################################################################## #
+
+def cache_path(sCsv):
+	"""Get the rollup cache file name for a summary file"""
+	return os.path.splitext(sCsv)[0] + '.rollup.json'
+
+def rollup(sCsv, lBy, sWindow='month', sSep='-', nChars=None, bCache=True):
+	"""Compute grouped statistics for a summary file, using and updating the
+	cache.
+
+	Args:
+		sCsv (str): The summary file
+		lBy, sWindow, sSep, nChars: The grouping, see Rollup
+		bCache (bool): If False, the cache is neither read nor written
+
+	Returns (Rollup): The up to date rollup
+	"""
+	ru = Rollup(lBy, sWindow, sSep, nChars)
+	sCache = cache_path(sCsv)
+	dCache = {}
+	if bCache and os.path.isfile(sCache):
+		try:
+			with open(sCache) as fIn:
+				dCache = json.load(fIn)
+			if dCache.get('cache_version') != g_nCacheVer: dCache = {}
+		except (OSError, ValueError) as exc:
+			perr("WARN:  Ignoring unreadable rollup cache %s, %s\n"%(sCache, exc))
+			dCache = {}
+
+	dRollups = dCache.get('rollups', {})
+	if ru.config() in dRollups: ru.load(dRollups[ru.config()])
+
+	nRows = ru.update(sCsv)
+	perr("INFO:  %d new summary rows read\n"%nRows)
+
+	if bCache and (nRows > 0 or ru.config() not in dRollups):
+		dRollups[ru.config()] = ru.to_json()
+		sTmp = '%s.%d.tmp'%(sCache, os.getpid())
+		try:
+			with open(sTmp, 'w') as fOut:
+				json.dump({'cache_version':g_nCacheVer, 'rollups':dRollups}, fOut)
+			os.replace(sTmp, sCache)
+		except OSError as exc:
+			perr("WARN:  Could not save rollup cache %s, %s\n"%(sCache, exc))
+
+	return ru
+
+
+def _fmt(r, sFmt='%.3e'):
+	return '' if r is None else sFmt%r
+
+def report(ru, bCsv=False, fOut=sys.stdout):
+	"""Print one line per group, sorted by group"""
+	lHdr = ru.lBy + [
+		'N', 'Pass %', 'Caution %', 'Fail %', 'Median', 'P90', 'Mean', 'Std',
+		'Min', 'Max', 'Trend /30d'
+	]
+	lLines = []
+	for sKey in sorted(ru.dGroups):
+		agg = ru.dGroups[sKey]
+		n = agg.nRows
+		def _pct(s): return '%.1f'%(100.0*agg.dResults.get(s, 0)/n) if n else ''
+		lLines.append(
+			(sKey.split('\t') if ru.lBy else []) + [
+				'%d'%n, _pct('PASSED'), _pct('CAUTION'),
+				# Old files used FAIL instead of FAILED
+				'%.1f'%(100.0*(agg.dResults.get('FAILED',0) + agg.dResults.get('FAIL',0))/n),
+				_fmt(agg.quantile(0.5)), _fmt(agg.quantile(0.9)),
+				_fmt(agg.rMean if agg.nMoments else None), _fmt(agg.std()),
+				_fmt(agg.rMin), _fmt(agg.rMax), _fmt(agg.trend(), '%+.3e')
+			]
+		)
+
+	if bCsv:
+		import csv
+		wrtr = csv.writer(fOut, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+		wrtr.writerow(lHdr)
+		for l in lLines: wrtr.writerow(l)
+		return
+
+	lWidth = [ max([len(lHdr[i])] + [len(l[i]) for l in lLines]) for i in range(len(lHdr)) ]
+	fOut.write('  '.join(s.ljust(w) for (s, w) in zip(lHdr, lWidth)).rstrip() + '\n')
+	for l in lLines:
+		fOut.write('  '.join(s.ljust(w) for (s, w) in zip(l, lWidth)).rstrip() + '\n')
+
+
+def main(lArgs):
+	psr = argparse.ArgumentParser(
+		prog='mag_screen_sum rollup', formatter_class=common.BreakFormatter
+	)
+	psr.description = \
+	"""Print pass rates, moment statistics and moment trends for groups of
+	summary rows.  Moments are in N m T^-1, the median and 90th percentile
+	are from a histogram and good to about 6%%, the trend is the least
+	squares change in moment per 30 days.  Results are cached so that later
+	runs only read new rows."""
+
+	psr.add_argument('-b', '--by', dest='sBy', metavar='DIMS', default='prefix',
+		help='Comma separated grouping, any of %s.  Defaults to prefix.  '%', '.join(g_lDims)+\
+		'Use an empty string for one group of all rows.'
+	)
+	psr.add_argument('-w', '--window', dest='sWindow', metavar='SIZE',
+		default='month', choices=g_lWindows,
+		help='Time window size for --by window, one of %s.  '%', '.join(g_lWindows)+\
+		'Defaults to month.'
+	)
+	psr.add_argument('--sep', dest='sSep', metavar='TEXT', default='-',
+		help='The part family is the part name up to the first TEXT, defaults to -'
+	)
+	psr.add_argument('--chars', dest='nChars', metavar='N', type=int, default=None,
+		help='Use the first N characters of part names as the family instead'
+	)
+	psr.add_argument('--csv', dest='bCsv', action='store_true', default=False,
+		help='Print CSV instead of aligned columns'
+	)
+	psr.add_argument('--no-cache', dest='bCache', action='store_false', default=True,
+		help="Read the whole summary and don't save the results"
+	)
+	psr.add_argument("SUMMARY_FILE", help='The summary file to read')
+
+	opts = psr.parse_args(lArgs)
+
+	import sqlite3
+
+	lBy = [s.strip() for s in opts.sBy.split(',') if s.strip()]
+	try:
+		ru = rollup(opts.SUMMARY_FILE, lBy, opts.sWindow, opts.sSep, opts.nChars, opts.bCache)
+	except ValueError as exc:
+		perr("ERROR: %s\n"%exc)
+		return 3
+	except (OSError, sqlite3.Error) as exc:
+		perr("ERROR: %s\n"%exc)
+		return 4
+
+	report(ru, opts.bCsv)
+	return 0
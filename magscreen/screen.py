@@ -30,14 +30,15 @@ import platform      # Hostname
 from os.path import join as pjoin
 
 import magscreen.common as common # Local modules
-import magscreen.tlvmr as tlvmr
-import magscreen.semcsv as semcsv
-import magscreen.plot as plot
-import magscreen.summary as summary
+import magscreen.profiling as profiling
+import magscreen.metrics as metrics
 
-# The version of this software, need to be able to set this via the release
-# process somehow
-g_sVersion = "magscreen-0.3"
+# The sensor, plotting and summary modules pull in serial, tldevice and
+# matplotlib, they are imported by the functions below when first needed so
+# that -h and usage errors come back right away.
+
+# The version of this software, now kept in common for all the programs
+g_sVersion = common.g_sVersion
 
 # Output stuff
 #  This is no longer needed using AGG matplotlib backend...
@@ -46,32 +47,23 @@ g_sVersion = "magscreen-0.3"
 #	# environment variable but that's not always set anymore.
 #	os.environ['DISPLAY'] = ':0'
 
-import matplotlib.pyplot as plt 
+# Rigs that are collecting data, the signal handler stops them all.  List
+# append and remove are atomic, so no lock is taken here, the handler may
+# interrupt the main thread at any point.
+g_lActive = []
 
-# Global variable and signal handler to halt main data collection loop
-g_lCollectors = []
-g_display = None
-g_bSigInt = False
+g_nDuration = 20  # Default test length in seconds
 
 perr = sys.stderr.write  # shorten a long function name
-			
-def setDone():
-	"""Function triggered by a timer alarm that is setup in main()"""
-	global g_lCollectors
-	for col in g_lCollectors:
-		col.stop()
-	if g_display != None:
-		g_display.stop()
 
 def setQuit(signal, frame):
 	"""Signal handler for CTRL+C from the keyboard"""
-	global g_bSigInt
-	g_bSigInt = True      # Indicates early exit
-	setDone()
+	for rig in list(g_lActive):
+		rig.quit()     # Indicates early exit
 
 # ############################################################################ #
 
-def _test_properties(sPart, sComments=None):
+def _test_properties(sPart, sComments=None, sRig=None):
 	"""Return a dictionary of basic properties for a screening test"""
 	d = {
 		'Part':sPart,
@@ -82,6 +74,7 @@ def _test_properties(sPart, sComments=None):
 	}
 
 	if sComments: d['Note'] = sComments.replace('"',"'")
+	if sRig: d['Rig'] = sRig
 	return d	
 
 
@@ -95,28 +88,25 @@ def test_summary(sOutFile, dProps, lDatasets):
 	
 
 
+def _background_plot(sFile):
+	"""Start mag_screen_plot for a raw data file in a separate process, don't
+	wait for it to finish."""
+	import subprocess
+	perr("INFO:  Rendering %s in the background\n"%sFile.replace('.csv','.pdf'))
+	subprocess.Popen(
+		[sys.executable, '-m', 'magscreen.plot', sFile],
+		stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL
+	)
+
 # ############################################################################ #
+# Reusable steps, shared with the screening daemon #
 
-def main():
-	"""Program entry point, see argparse setup below or run with -h for overall
-	scope and usage information.
+def add_rig_args(psr):
+	"""Add the sensor, output and plotting options to a command line parser.
 
-	Returns:
-		A standard integer success or fail code suitable for return to
-		the calling shell. 0 = success, non-zero = various error conditions
+	These are common to mag_screen and mag_screen_daemon.  Use check_rig_args()
+	to validate them after parsing.
 	"""
-	global g_lCollectors, g_display, g_sigint
-	
-	psr = argparse.ArgumentParser(formatter_class=common.BreakFormatter)
-	psr.description = '''\
-		Use 2 to N twinleaf VMR sensors to calculate the dipole moment of 
-		an object slowly spinning in a static magnetic field.'''
-	psr.epilog = '''\
-	Author: chris-piker@uiowa.edu, cole-dorman@uiowa.edu\v
-	Source: https://research-git.uiowa.edu/space-physics/utilities/python/vangse
-	'''
-	
-	# By tradition, optional command line parameters are first...
 	psr.add_argument(
 		'-f', '--freq', dest='sRate', metavar='HZ', type=int, default=10,
 		help='The number of data points to collect per sensor, per second.  '+\
@@ -124,7 +114,7 @@ def main():
 	)
 	
 	psr.add_argument(
-		'-t', '--time', dest='sDuration', metavar='SEC', type=int, default=20,
+		'-t', '--time', dest='sDuration', metavar='SEC', type=int, default=None,
 		  help='The total number of seconds to collect data, defaults to 20.\n'
 	)
 	
@@ -148,8 +138,25 @@ def main():
 	)
 	
 	psr.add_argument(
-		'-m', '--message', dest="sMsg", metavar='"Short msg"', type=str, default=None,
-		help="Add a one line message to be saved with the test data."
+		'-R', '--ref-uart', dest='sRefUart', metavar='SERIAL', type=str,
+		default=None, help="The serial number of the UART for an optional far "+\
+		"field reference sensor.  Ambient field changes seen by this sensor "+\
+		"are removed from the near sensors before the dipole fit."
+	)
+
+	psr.add_argument(
+		'--ref-radius', dest='nRefRadius', metavar='CM', type=int, default=100,
+		help="Distance from the center of the object to the reference sensor "+\
+		"face in centimeters, defaults to 100."
+	)
+
+	psr.add_argument(
+		'-c', '--calib', dest='sCalFile', metavar='FILE', type=str,
+		default=os.environ.get('MAGSCREEN_CALIB', None), help="A CSV file of "+\
+		"per-sensor calibration matrices, biases and internal offsets keyed by "+\
+		"UART serial number and VMR identity.  Defaults to the value of the "+\
+		"MAGSCREEN_CALIB environment variable, if set, otherwise nominal "+\
+		"values are used."
 	)
 
 	psr.add_argument(
@@ -165,20 +172,91 @@ def main():
 		"directories will be created as needed."
 	)
 	
-	# ... and positional parameters follow
-	psr.add_argument("PART", 
-		help="An identifier for the object to be measured.  Will be used as "+\
-		"part of the output filenames."
+	psr.add_argument(
+		'--metrics', dest='sMetrics', metavar='PATH', type=str,
+		default=os.environ.get('MAGSCREEN_METRICS', None), help="Keep bench "+\
+		"monitoring metrics in this Prometheus textfile collector file, or in "+\
+		"PROGRAM.prom if PATH is a directory.  Defaults to the value of the "+\
+		"MAGSCREEN_METRICS environment variable, if set."
 	)
-	
-	opts = psr.parse_args()
 
-	# Set user interup handlers in case user wants to quite early.
-	signal.signal(signal.SIGINT, setQuit)
-	signal.signal(signal.SIGTERM, setQuit)
-	
+	psr.add_argument(
+		'--dtype', dest='sDtype', metavar='TYPE', choices=('float64', 'float32'),
+		default=None, help="Hold and "+\
+		"process field values as 'float64' or 'float32'.  float32 halves "+\
+		"memory use for long captures, sample times are always float64.  "+\
+		"Defaults to the MAGSCREEN_DTYPE environment variable, if set, "+\
+		"otherwise float64."
+	)
+
+	psr.add_argument(
+		'--use-times', dest='bUseTimes', action='store_true',
+		default=os.environ.get('MAGSCREEN_USE_TIMES', '0') not in ('', '0'),
+		help="Compute the fit spectra from the recorded sample times instead "+\
+		"of the nominal sample rate.  Slower, but tolerates sampling jitter "+\
+		"and short dropouts.  Also turned on by setting the "+\
+		"MAGSCREEN_USE_TIMES environment variable to 1, which works for any "+\
+		"of the programs."
+	)
+
+	psr.add_argument(
+		'--plan', dest='rRotRate', metavar='HZ', type=float, default=None,
+		help="Choose the sample rate, the test duration and the spectrum "+\
+		"segment length from the expected rotation rate of the turntable in "+\
+		"turns per second, usually 0.25.  "+\
+		"Replaces -f and -t.  The choices are saved with the test data, see "+\
+		"magscreen/planner.py."
+	)
+
+	psr.add_argument(
+		'--resolution', dest='rResolution', metavar='HZ', type=float,
+		default=None, help="With --plan, the target frequency resolution.  "+\
+		"Defaults to an eighth of the rotation rate."
+	)
+
+	psr.add_argument(
+		'--snr', dest='rSnr', metavar='RATIO', type=float, default=10.0,
+		help="With --plan, the target signal to noise ratio at the farthest "+\
+		"sensor for a part at a tenth of the pass limit, defaults to 10."
+	)
+
+	psr.add_argument(
+		'--throughput', dest='rThroughput', metavar='SAMPLES', type=float,
+		default=os.environ.get('MAGSCREEN_THROUGHPUT', None), help="With "+\
+		"--plan, the samples per second this host can collect from all "+\
+		"sensors.  Defaults to the MAGSCREEN_THROUGHPUT environment variable, "+\
+		"if set, otherwise it is measured."
+	)
+
+	psr.add_argument(
+		'-p', '--preview', dest='bPreview', action='store_true', default=False,
+		help="Write a low resolution PNG of the dipole fit page first, for a "+\
+		"quick result, then render the full PDF in a background process."
+	)
+
+	psr.add_argument(
+		'--defer-pdf', dest='bDeferPdf', action='store_true', default=False,
+		help="Don't render the full PDF at all.  It can be generated later "+\
+		"with mag_screen_plot, which can process whole directories at once."
+	)
+
+
+def check_rig_args(opts):
+	"""Validate the options added by add_rig_args().  Errors are printed.
+
+	On success two derived values are added to opts: lDist, a list of integer
+	distances, and lSerial, the UART serial numbers for each distance.  The
+	summary file name is also placed in the output directory if no path was
+	given.  With --plan the rate and duration are replaced by planned values
+	and nSegLen and plan are set, see planner.apply(), otherwise these two
+	are None.
+
+	Returns (int): 0 if the options are usable, otherwise an exit code
+	"""
 	# Since SIGALRM isn't available on Windows, spawn a thread to countdown to
-	# the end of the data collection period, check user supplied time
+	# the end of the data collection period, check user supplied time.  None
+	# if -t wasn't given, so that mag_screen_daemon --send can tell.
+	if opts.sDuration is None: opts.sDuration = g_nDuration
 	if opts.sDuration < 1 or opts.sDuration > 60*60:
 		perr('ERROR: Test sDuration must be between 1 second and 1 hour\n')
 		return 7
@@ -190,89 +268,444 @@ def main():
 		return 8
 
 	# See how many sensors we're going to use
-	lDist = [int(s.strip(),10) for s in opts.sRadii.split(',')]
-	nSensors = len(lDist)
+	opts.lDist = [int(s.strip(),10) for s in opts.sRadii.split(',')]
+	nSensors = len(opts.lDist)
 	if nSensors < 1:
 		perr("ERROR: At least one measurement distance must be given via -r\n")
 		return 9
 
-	lSerial = [s.strip() for s in opts.sUarts.split(',')]
-	if len(lSerial) < nSensors:
+	opts.lSerial = [s.strip() for s in opts.sUarts.split(',')][:nSensors]
+	if len(opts.lSerial) < nSensors:
 		perr("ERROR: %d UARTs are required for measurements at %d distances.\n"%(
 			nSensors, nSensors
 		))
 		return 10
 
-	rTime0 = time.time()  # Current unix time in floating point seconds	
-	g_bSigInt = False    # Global interrupt flag
-
 	# Check that our non-empty sensors can be distinguished from each other
-	g_lCollectors = []
 	for i in range(nSensors):
-		lTest = []
-		for j in range(nSensors): 
-			if (j != i): lTest.append(lSerial[j])
-		if lSerial[i] in lTest:
-			perr("ERROR: UART serial number %s is not unique in %s!\n"%(lSerial[i], opts.sUarts))
+		if opts.lSerial[i] in (opts.lSerial[:i] + opts.lSerial[i+1:]):
+			perr("ERROR: UART serial number %s is not unique in %s!\n"%(
+				opts.lSerial[i], opts.sUarts
+			))
 			return 13
 
+	if opts.sRefUart and (opts.sRefUart in opts.lSerial):
+		perr("ERROR: Reference UART %s is also used as a near sensor\n"%opts.sRefUart)
+		return 13
+
+	# Open the roll-up info file (or create one if it doesn't exist)
+	if os.sep not in opts.sSummary:
+		opts.sSummary = pjoin(opts.sOutDir, opts.sSummary)
+
+	# Sensor buffers are made with this type, so set it before they're opened.
+	# Without --dtype, semcsv has already applied a valid MAGSCREEN_DTYPE.
+	import magscreen.semcsv as semcsv
+	if opts.sDtype: semcsv.set_dtype(opts.sDtype)
+
+	# Worker processes read the environment, so they fit the same way
+	import magscreen.calc as calc
+	calc.set_use_times(opts.bUseTimes)
+	os.environ['MAGSCREEN_USE_TIMES'] = '1' if opts.bUseTimes else '0'
+
+	# Replace the rate and duration with planned values, the planner keeps
+	# them in range
+	opts.nSegLen = None
+	opts.plan = None
+	if opts.rRotRate is not None:
+		import magscreen.planner as planner
+		planner.apply(opts)
+
+	return 0
+
+
+@profiling.timed('discover')
+def open_sensors(opts):
+	"""Connect to all the sensors given in a checked set of rig options
+
+	Args:
+		opts: Parsed command line options, see check_rig_args()
+
+	Returns (list[tlvmr.VMR]):
+		The near sensors followed by the reference sensor if one was
+		requested, or None if any sensor could not be opened.  Errors are
+		printed.
+	"""
+	import magscreen.tlvmr as tlvmr
+
+	lCollectors = []
+	for i in range(len(opts.lDist)):
 		try:
-			g_lCollectors.append( tlvmr.VMR('%d'%i, lSerial[i], opts.sRate) )
-		except OSError as e:
+			lCollectors.append( tlvmr.VMR(
+				'%d'%i, opts.lSerial[i], opts.sRate, sCalFile=opts.sCalFile
+			) )
+		except (OSError, ValueError) as e:
 			perr("ERROR: %s\n"%e)
 			perr('HINT:  Sensors can be ignored by requesting data at fewer distances.')
 			perr('  Use -h for more info.\n')
-			return 15
+			for col in lCollectors: col.close()
+			return None
 
-		g_lCollectors[-1].set_time0(rTime0)
-		g_lCollectors[-1].set_dist(lDist[i])
+		lCollectors[-1].set_dist(opts.lDist[i])
+		lCollectors[-1].set_nperseg(opts.nSegLen)
 
-	if len(g_lCollectors) == 0:
-		perr('INFO:  No data collection ports specified, successfully did nothing.\n')
-		return 0
-	
-	# Create a display output thread
-	perr("MSG:   Use CTRL+C to quit early\n")
-	g_display = common.Display("MSG:   Collecting ~%d seconds of data "%opts.sDuration)
+	if opts.sRefUart:
+		try:
+			lCollectors.append( tlvmr.VMR(
+				'%d'%len(opts.lDist), opts.sRefUart, opts.sRate, sCalFile=opts.sCalFile
+			) )
+		except (OSError, ValueError) as e:
+			perr("ERROR: %s\n"%e)
+			perr('HINT:  Omit --ref-uart to run without a reference sensor.\n')
+			for col in lCollectors: col.close()
+			return None
+
+		lCollectors[-1].set_dist(opts.nRefRadius)
+		lCollectors[-1].set_role('reference')
+		lCollectors[-1].set_nperseg(opts.nSegLen)
+
+	return lCollectors
+
+
+class Rig:
+	"""One screening fixture, its options, its sensors and the state of the
+	current data collection.
+
+	A host may drive several fixtures at once, each with its own Rig, see
+	rigs.py.  The signal handler, setQuit(), stops all rigs that are
+	collecting.
+
+	Args:
+		opts: Checked rig options, see check_rig_args()
+		sName (str): The fixture name, saved with each test as the Rig
+			property.  None for a host with a single fixture.
+	"""
+	def __init__(self, opts, sName=None):
+		self.opts = opts
+		self.sName = sName
+		self.lCollectors = None
+		self.display = None
+		self.bQuit = False
+		self.lock = threading.Lock()  # Held by the job using the sensors
+
+	def open(self):
+		"""Open the sensors if they aren't open already
+
+		Returns (bool): True if the sensors are ready
+		"""
+		if self.lCollectors is None:
+			if self.opts.plan is not None:
+				import magscreen.planner as planner
+				perr("INFO:  %sPlan, %s\n"%(
+					'Rig %s, '%self.sName if self.sName else '',
+					planner.describe(self.opts.plan)
+				))
+			self.lCollectors = open_sensors(self.opts)
+		return self.lCollectors is not None
+
+	def close(self):
+		"""Close the sensors, the next open() connects to them again"""
+		for col in (self.lCollectors or []):
+			col.close()
+		self.lCollectors = None
+
+	def stop(self):
+		"""End data collection, triggered by the timer setup in acquire()"""
+		for col in (self.lCollectors or []):
+			col.stop()
+		if self.display != None:
+			self.display.stop()
+
+	def quit(self):
+		"""End data collection early"""
+		self.bQuit = True
+		self.stop()
+
+	def test_properties(self, sPart, sComments=None):
+		"""Return a dictionary of basic properties for a test on this rig"""
+		return _test_properties(sPart, sComments, self.sName)
+
+	@profiling.timed('acquire')
+	def acquire(self, nDuration, bDisplay=True):
+		"""Collect data from the open sensors for a fixed time.
+
+		Sensors are reset first, so the same objects may be used for any
+		number of tests.  Collection can be ended early by quit(), or by
+		SIGINT or SIGTERM if the setQuit() handler is installed.
+
+		Args:
+			nDuration (int): The number of seconds to collect data
+			bDisplay (bool): Print progress dots.  Programs collecting from
+				several rigs at once should show their own progress instead.
+
+		Returns (bool): True if collection ran the full time, False if it was
+			interrupted.
+		"""
+		lCollectors = self.lCollectors
+		self.bQuit = False
+
+		rTime0 = time.time()  # Current unix time in floating point seconds
+		for collector in lCollectors:
+			collector.reset()
+			collector.set_time0(rTime0)
+
+		# Create a display output thread
+		if bDisplay:
+			perr("MSG:   Use CTRL+C to quit early\n")
+			self.display = common.Display("MSG:   Collecting ~%d seconds of data "%nDuration)
+
+		# create an alarm thread to stop taking data
+		alarm = threading.Timer(nDuration, self.stop)
+
+		# Start all the threads
+		g_lActive.append(self)
+		try:
+			for collector in lCollectors:
+				collector.start()
+			alarm.start()
+			if self.display: self.display.start()
+
+			# Wait on all my threads to exit
+			for collector in lCollectors:
+				if collector:
+					collector.join()
+			if self.display: self.display.join()
+		finally:
+			g_lActive.remove(self)
+			alarm.cancel() # Cancel the alarm if it hasn't gone off
+			self.display = None
+		if bDisplay: perr('\n')
+
+		rElapsed = time.time() - rTime0
+		for collector in lCollectors:
+			metrics.inc('magscreen_samples_total', len(collector), sensor=collector.serialno)
+			metrics.inc('magscreen_dropped_samples_total', collector.dropped(),
+				sensor=collector.serialno
+			)
+			metrics.set_gauge('magscreen_sample_rate_hz', round(len(collector)/rElapsed, 3),
+				sensor=collector.serialno
+			)
+
+		return not self.bQuit
+
+
+def count_run(sOutcome, sRig=None):
+	"""Record the end of a screening run in the bench metrics
+
+	Args:
+		sOutcome (str): One of 'ok', 'interrupted' or 'error'
+		sRig (str): The fixture name on hosts with several, see Rig
+	"""
+	if sRig: metrics.inc('magscreen_runs_total', outcome=sOutcome, rig=sRig)
+	else: metrics.inc('magscreen_runs_total', outcome=sOutcome)
+	metrics.set_gauge('magscreen_last_run_timestamp_seconds', round(time.time(), 3))
+
+
+@profiling.timed('post_process')
+def post_process(lCollectors, dTest, opts, pool=None):
+	"""Write the raw data, plots and summary line for one test
+
+	The datasets are built in memory from the collectors, then three stages
+	run at the same time: the CSV file is written by a thread, the PDF is
+	rendered by a separate process, and the dipole fit and summary line are
+	done here.  The result is printed as soon as the fit is done, before the
+	other stages finish.  The fit is then saved next to the raw data file,
+	see results.py, so that later plots and summaries don't redo it.
+
+	Args:
+		lCollectors (list[tlvmr.VMR]): Sensors holding data from Rig.acquire()
+		dTest (dict): Test properties, see _test_properties().  The Plan
+			property is added if the options have one.
+		opts: Checked rig options, see check_rig_args()
+		pool (concurrent.futures.Executor): Renders the PDF.  If None, a one
+			worker pool is started for this test by a fork server, since the
+			sensor threads are running, see common.process_pool().  Long running
+			programs should pass in a pool of their own, so that the worker
+			keeps matplotlib loaded between tests.
+
+	Returns (sFile, tResult):
+		The raw data file name and the (moment, stray field, status) tuple
+		from summary.append()
+	"""
+	import magscreen.tlvmr as tlvmr
+	import magscreen.summary as summary
+	import magscreen.calc as calc
+	import magscreen.results as results
+	from concurrent.futures import ThreadPoolExecutor
+
+	sFile = pjoin(opts.sOutDir, "%s.csv"%(common.safe_filename(dTest['Part'])+str(time.strftime('%Y_%m_%dT%H_%M_%S'))))
+	sTitle = "Magnetic Screening Test, Raw Data"
+	if opts.plan is not None:
+		import magscreen.planner as planner
+		dTest = dict(dTest, Plan=planner.describe(opts.plan))
+	(dProps, lDatasets) = tlvmr.to_datasets(lCollectors, sTitle, dTest)
+
+	# Plot time series and PSD of the raw data, as a cross check.  The sensor
+	# threads are still running, so a pool made here must not fork them, see
+	# common.process_pool().
+	futPdf = None
+	bOwnPool = False
+	if opts.bPreview or not opts.bDeferPdf:
+		import magscreen.plot as plot
+	if (not opts.bPreview) and (not opts.bDeferPdf):
+		if pool is None:
+			pool = common.process_pool(1)
+			bOwnPool = True
+		futPdf = pool.submit(
+			plot.screen_plot_pdf, dProps, lDatasets, sFile.replace('.csv','.pdf')
+		)
+
+	# Save raw-data from collectors
+	writer = ThreadPoolExecutor(max_workers=1)
+	futCsv = writer.submit(tlvmr.write_mag_vecs, sFile, lCollectors, sTitle, dTest)
+	writer.shutdown(wait=False)
+
+	try:
+		ana = calc.analyze(lDatasets)
+		tResult = summary.append(opts.sSummary, dProps, lDatasets, ana)
+		metrics.inc('magscreen_results_total', result=tResult[2])
+		perr("INFO:  Summary appended to %s\n"%opts.sSummary)
+		perr("INFO:  %s: %s, dipole %.3e [N m T^-1], %.3e [nT] @ 1 m\n"%(
+			dTest['Part'], tResult[2], tResult[0], tResult[1]
+		))
+
+		if opts.bPreview:
+			plot.screen_plot_preview(
+				dProps, lDatasets, sFile.replace('.csv','.preview.png'), ana=ana
+			)
+
+		with profiling.span('wait_csv'):
+			futCsv.result()   # Re-raises any write error
+		try:
+			results.save(sFile, dProps, ana)
+		except OSError as exc:
+			perr("WARN:  Could not save analysis results for %s, %s\n"%(sFile, exc))
+		if opts.bPreview and not opts.bDeferPdf:
+			_background_plot(sFile)
+
+		if futPdf:
+			with profiling.span('wait_pdf'):
+				futPdf.result()
+	finally:
+		if bOwnPool: pool.shutdown()
+
+	return (sFile, tResult)
+
+# ############################################################################ #
+
+def main():
+	"""Program entry point, see argparse setup below or run with -h for overall
+	scope and usage information.
+
+	Returns:
+		A standard integer success or fail code suitable for return to
+		the calling shell. 0 = success, non-zero = various error conditions
+	"""
+	psr = argparse.ArgumentParser(formatter_class=common.BreakFormatter)
+	psr.description = '''\
+		Use 2 to N twinleaf VMR sensors to calculate the dipole moment of 
+		an object slowly spinning in a static magnetic field.'''
+	psr.epilog = '''\
+	Author: chris-piker@uiowa.edu, cole-dorman@uiowa.edu\v
+	Source: https://research-git.uiowa.edu/space-physics/utilities/python/vangse
+	'''
 	
-	# create an alarm thread to stop taking data
-	alarm = threading.Timer(opts.sDuration + (time.time() - rTime0), setDone)
+	# By tradition, optional command line parameters are first...
+	add_rig_args(psr)
+
+	psr.add_argument(
+		'-m', '--message', dest="sMsg", metavar='"Short msg"', type=str, default=None,
+		help="Add a one line message to be saved with the test data."
+	)
+
+	psr.add_argument(
+		'--profile', dest='bProfile', action='store_true', default=False,
+		help="Time each processing stage and write a JSON report to "+\
+		"mag_screen_DATE.profile.json in the output directory.  The "+\
+		"MAGSCREEN_PROFILE environment variable does the same."
+	)
+
+	psr.add_argument(
+		'--profile-file', dest='sProfile', metavar='FILE', default=None,
+		help="Write the --profile report to FILE instead, implies --profile."
+	)
+
+	psr.add_argument(
+		'--profile-hot', dest='sProfHot', metavar='STAGE', default=None,
+		help="With --profile, also run the named stage under cProfile, for "+\
+		"example post_process or summary.append."
+	)
+
+	psr.add_argument(
+		'--rigs', dest='sRigFile', metavar='FILE', default=None,
+		help="Screen parts on several fixtures at once, as described in the "+\
+		"rig file FILE, see etc/rigs.ini.  Each PART is then given as "+\
+		"RIG=PART and the options above are defaults for every rig."
+	)
+
+	# ... and positional parameters follow
+	psr.add_argument("PART", nargs='+',
+		help="An identifier for the object to be measured.  Will be used as "+\
+		"part of the output filenames."
+	)
 	
-	# Start all the threads
-	for collector in g_lCollectors:
-		collector.start()
-	alarm.start()
-	g_display.start()
+	opts = psr.parse_args()
+
+	# Set user interup handlers in case user wants to quite early.
+	signal.signal(signal.SIGINT, setQuit)
+	signal.signal(signal.SIGTERM, setQuit)
 	
-	# Wait on all my threads to exit
-	for collector in g_lCollectors:
-		if collector:
-			collector.join()
-	g_display.join()
+	if opts.sRigFile:
+		import magscreen.rigs as rigs
+		tRigs = rigs.read(opts.sRigFile, opts)
+		if tRigs is None: return 18
+		lParts = rigs.assign_parts(opts.PART, tRigs[1])
+		if lParts is None: return 18
+		lJobs = [(rig, rig.test_properties(sPart, opts.sMsg)) for (rig, sPart) in lParts]
+		fnRun = lambda opts: rigs.run(tRigs[0], lJobs)
+	else:
+		if len(opts.PART) > 1:
+			perr("ERROR: Only one PART may be given without --rigs\n")
+			return 18
+		nRet = check_rig_args(opts)
+		if nRet != 0: return nRet
+		fnRun = _run
+
+	if opts.bProfile or opts.sProfile:
+		sReport = opts.sProfile or pjoin(
+			opts.sOutDir, 'mag_screen_%s.profile.json'%time.strftime('%Y%m%dT%H%M%S')
+		)
+		profiling.enable('mag_screen', sReport, opts.sProfHot)
+	else:
+		profiling.enable_from_env('mag_screen')
+
+	if opts.sMetrics: metrics.enable('mag_screen', opts.sMetrics)
+
+	nRet = None
+	try:
+		nRet = fnRun(opts)
+		return nRet
+	finally:
+		# nRet is None if an exception is on the way out, rigs count their own
+		if not opts.sRigFile:
+			count_run({0:'ok', 4:'interrupted'}.get(nRet, 'error'))
+		metrics.write()
+		profiling.finish()
+
+
+def _run(opts):
+	"""Run one test with checked options, returns an exit code"""
+	rig = Rig(opts)
+	if not rig.open(): return 15
+
+	if len(rig.lCollectors) == 0:
+		perr('INFO:  No data collection ports specified, successfully did nothing.\n')
+		return 0
 	
-	alarm.cancel() # Cancel the alarm if it hasn't gone off
-	perr('\n')
-	if g_bSigInt:
+	if not rig.acquire(opts.sDuration):
 		perr('WARN:  Data collection terminated, no output written\n')
 		return 4  # An error return value
 	
-	# Save raw-data from collectors
-	sFile = pjoin(opts.sOutDir, "%s.csv"%(common.safe_filename(opts.PART)+str(time.strftime('%Y_%m_%dT%H_%M_%S'))))
-	sTitle = "Magnetic Screening Test, Raw Data"
-	tlvmr.write_mag_vecs(
-		sFile, g_lCollectors, sTitle, _test_properties(opts.PART, opts.sMsg)
-	)
-
-	# Plot time series and PSD of the raw data, as a cross check
-	(dProps, lDatasets) = semcsv.read(sFile)
-	plot.screen_plot_pdf(dProps, lDatasets, sFile.replace('.csv','.pdf'))
-	
-	# Open the roll-up info file (or create one if it doesn't exist)
-	if os.sep not in opts.sSummary:
-		opts.sSummary = pjoin(opts.sOutDir, opts.sSummary)
-	
-	summary.append(opts.sSummary, dProps, lDatasets)
-	perr("INFO:  Summary appended to %s\n"%opts.sSummary)
+	post_process(rig.lCollectors, rig.test_properties(opts.PART[0], opts.sMsg), opts)
 	
 	return 0  # An all-okay return value
 
@@ -34,15 +34,58 @@ History:
    C. Piker 2021-12-21: Original v0.1
 """
 
+import os
 import sys
 import csv
 import re
 import math
-from collections import namedtuple
 import numpy as np
 
+import magscreen.profiling as profiling
+
 perr = sys.stderr.write  # shorten a long function name
 
+# The floating point type used for data values.  The VMRs resolve about
+# 0.1 nT and files hold 1 decimal place, so float32 is enough for field
+# values and halves memory use for long captures.  Time variables, those in
+# seconds, stay float64 since offsets into a long capture need more digits.
+# Set by set_dtype() or the MAGSCREEN_DTYPE environment variable.
+g_lDtypes = ('float64', 'float32')
+g_dtype = np.dtype('float64')
+
+def set_dtype(sDtype):
+	"""Set the floating point type for data values read or collected after
+	this call
+
+	Args:
+		sDtype (str|numpy.dtype): 'float64' or 'float32'
+
+	Returns (numpy.dtype): The previous setting
+	"""
+	global g_dtype
+	dtype = np.dtype(sDtype)
+	if dtype.name not in g_lDtypes:
+		raise ValueError("Data type must be one of %s, not %s"%(', '.join(g_lDtypes), dtype.name))
+	dtypeOld = g_dtype
+	g_dtype = dtype
+	return dtypeOld
+
+def get_dtype():
+	"""Get the floating point type for data values, see set_dtype()"""
+	return g_dtype
+
+def _dtype_from_env():
+	"""Apply MAGSCREEN_DTYPE if set, a bad value is reported and ignored so
+	that it can't stop every program at import time"""
+	sDtype = os.environ.get('MAGSCREEN_DTYPE')
+	if not sDtype: return
+	try:
+		set_dtype(sDtype)
+	except (TypeError, ValueError) as exc:
+		perr("WARN:  Ignoring MAGSCREEN_DTYPE, %s, using %s\n"%(exc, g_dtype.name))
+
+_dtype_from_env()
+
 # Here's an example data file with interleaved data.  It consists of
 # 
 #  1. Global Properties  -- Rows that start with G
@@ -88,10 +131,160 @@ perr = sys.stderr.write  # shorten a long function name
 #
 # ---------
 
-import csv
+class Variable:
+	"""One variable in a dataset, an array of values and the units string"""
+	__slots__ = ('data', 'units')
+
+	def __init__(self, data, units=''):
+		self.data = data
+		self.units = units
+
+	def __len__(self):
+		return len(self.data)
+
+	def __iter__(self):
+		# Unpacks as (data, units), same as the original named tuple
+		return iter((self.data, self.units))
+
+	def __repr__(self):
+		return 'Variable(%d values, units=%r)'%(len(self.data), self.units)
+
+
+def _prop_float(dProps, sKey, iVal=0):
+	try:
+		return float(dProps[sKey][iVal])
+	except (KeyError, IndexError, ValueError):
+		return None
+
+class Dataset:
+	"""The properties and variables for one sensor
+
+	Attributes:
+		props (dict): Property name to list of strings, as in the file
+		vars (dict): Variable name to Variable
+		block (ndarray): When all numeric variables of the data value type,
+			see set_dtype(), have the same length they are rows of this
+			[n_vars, n_values] array, and each Variable.data is a contiguous
+			view of one row.  Otherwise None.  With float32 values the time
+			variables are separate float64 arrays.
+
+	The common numeric properties are parsed once, when the dataset is made,
+	so that calculations don't convert strings on every use.  Each is None
+	if the property is missing or is not a number:
+
+		rate (float): The 'Rate' property, samples per second
+		distance (float): The 'Distance' property value
+		distance_units (str): The 'Distance' property units, such as '[cm]'
+		offset_cm (ndarray): The three 'Offset_cm' property values
+		nperseg (int): The 'Nperseg' property, the Welch segment length
+			chosen for the test, see planner.py.  Older files don't have it.
+
+	The typed fields are not updated if props is changed afterwards.  For
+	code written against the original named tuple a dataset also unpacks as
+	(props, vars).
+	"""
+	__slots__ = (
+		'props', 'vars', 'block', 'rate', 'distance', 'distance_units', 'offset_cm',
+		'nperseg'
+	)
+
+	def __init__(self, props, vars, block=None):
+		self.props = props
+		self.vars = vars
+		self.block = block
+
+		self.rate = _prop_float(props, 'Rate')
+		self.distance = _prop_float(props, 'Distance')
+		lDist = props.get('Distance', [])
+		self.distance_units = lDist[1] if len(lDist) > 1 else None
+		try:
+			self.offset_cm = np.array([float(s) for s in props['Offset_cm'][:3]])
+			if len(self.offset_cm) != 3: self.offset_cm = None
+		except (KeyError, ValueError):
+			self.offset_cm = None
+		rSeg = _prop_float(props, 'Nperseg')
+		self.nperseg = int(rSeg) if rSeg else None
+
+	def require(self, sField):
+		"""Get a typed property field, raising KeyError if it is not known"""
+		val = getattr(self, sField)
+		if val is None:
+			raise KeyError("Dataset property for '%s' is missing or not a number"%sField)
+		return val
+
+	def __iter__(self):
+		return iter((self.props, self.vars))
+
+	def __repr__(self):
+		return 'Dataset(props=%s, vars=%s)'%(sorted(self.props), sorted(self.vars))
+
+	def __reduce__(self):
+		# Send the block once, not once for each variable view, when datasets
+		# are passed to worker processes
+		if self.block is None: return (Dataset, (self.props, self.vars))
+		lVars = []
+		for (sName, var) in self.vars.items():
+			aData = var.data
+			if isinstance(aData, np.ndarray) and (aData.base is self.block) and \
+				(aData.shape == self.block.shape[1:]):
+				iRow = (aData.ctypes.data - self.block.ctypes.data)//self.block.strides[0]
+				lVars.append((sName, var.units, iRow))
+			else:
+				lVars.append((sName, var.units, aData))
+		return (_unreduce, (self.props, lVars, self.block))
 
-Dataset = namedtuple('Dataset', ['props','vars'])
-Variable = namedtuple('Variable', ['data','units'])
+def _unreduce(dProps, lVars, aBlock):
+	dVars = {}
+	for (sName, sUnits, data) in lVars:
+		if isinstance(data, int): data = aBlock[data]
+		dVars[sName] = Variable(data, sUnits)
+	return Dataset(dProps, dVars, aBlock)
+
+
+def make_dataset(dProps, lVars, dtype=None):
+	"""Make a dataset from numeric columns, following the data type policy
+
+	Time variables, with units of 's', are float64 and the rest use the
+	data type setting.  Variables of the data type that all have the same
+	length are packed into one block, see Dataset.
+
+	Args:
+		dProps (dict): The dataset properties
+		lVars (list): (name, units, values) tuples in file order.  Values are
+			a sequence of floats, or an ndarray which is passed through as is
+			if it is not floating point, such as string data.
+		dtype (numpy.dtype): Override the data type setting, see set_dtype()
+
+	Returns (Dataset):
+	"""
+	dtype = g_dtype if dtype is None else np.dtype(dtype)
+
+	lBlock = []   # indexes into lVars
+	dVars = {}
+	for i in range(len(lVars)):
+		(sName, sUnits, values) = lVars[i]
+		if isinstance(values, np.ndarray) and (values.dtype.kind != 'f'):
+			dVars[sName] = Variable(values, sUnits)
+		elif (sUnits == 's') and (dtype != np.float64):
+			dVars[sName] = Variable(np.asarray(values, dtype=np.float64), sUnits)
+		else:
+			lBlock.append(i)
+
+	aBlock = None
+	if lBlock and (len(set(len(lVars[i][2]) for i in lBlock)) == 1):
+		aBlock = np.empty((len(lBlock), len(lVars[lBlock[0]][2])), dtype=dtype)
+		for j in range(len(lBlock)):
+			(sName, sUnits, values) = lVars[lBlock[j]]
+			aBlock[j] = values
+			dVars[sName] = Variable(aBlock[j], sUnits)
+	else:
+		for i in lBlock:
+			(sName, sUnits, values) = lVars[i]
+			dVars[sName] = Variable(np.asarray(values, dtype=dtype), sUnits)
+
+	# Keep the variables in file order
+	dVars = dict((t[0], dVars[t[0]]) for t in lVars)
+	return Dataset(dProps, dVars, aBlock)
 
 class ParseError(Exception):
 	def __init__(self, sFile, nLine, sMsg):
@@ -102,6 +295,10 @@ class ParseError(Exception):
 	def __str__(self):
 		return "%s, line %d: %s"%(self.sFile, self.nLine, super().__str__())
 
+	def __reduce__(self):
+		# Needed to pass errors back from worker processes
+		return (ParseError, (self.sFile, self.nLine, self.args[0]))
+
 
 def _toCol(sFile, nLine, sCol):
 	p = [1,26,26*26]
@@ -197,54 +394,33 @@ def _parse_ds_cols(sFile, nLine, ds,row):
 			ds['vars'][sVar]['data'].append(row[i].strip())  # Convert to numpy array at export
 
 
-def _ds_finalize(dDs):
-	"""Try to convert data values to floats and remove all column mappings"""
-
-	#perr('Finalize Ds Keys: %s\n'%dDs.keys())
-	#perr('Finalizse Ds Vars: %s\n'%dDs['vars'].keys())
-
-	ds_obj = Dataset(dDs['props'], dDs['vars'])
+def _ds_finalize(dDs, dtype=None):
+	"""Try to convert data values to floats and remove all column mappings
 
+	Numeric variables are stored as described for make_dataset().
+	"""
+	lVars = []
 	for sVar in dDs['vars']:
 		dVar = dDs['vars'][sVar]
 		# Try to convert float (with nan for ""), if that fails leave variable data
 		# as a string
 		lStrs = dVar['data']
-		#perr("Data for %s:\n%s\n"%(sVar, dVar['data']))
 		try:
-			lFlt = [float(s) if len(s) > 0 else math.nan for s in lStrs]
-			dVar['data'] = np.array(lFlt, dtype=np.float)
+			values = [float(s) if len(s) > 0 else math.nan for s in lStrs]
 		except ValueError:
-			dVar['data'] = np.array(lStr)  # Leave as string data
-
-		var_obj = Variable(dVar['data'],dVar['units'])
-		ds_obj.vars[sVar] = var_obj
+			values = np.array(lStrs)
+		lVars.append((sVar, dVar['units'], values))
 
-	return ds_obj
+	return make_dataset(dDs['props'], lVars, dtype)
 	
 			
-def read(sFile):
-	"""Read a semantic CSV file and return a dictionary of global properties
-	and datasets.
-
-	Returns: (dict, dict)
-		(global_properties, datasets) 
-		The properties dictionary contains lists for data values. Thus each
-		property can have multiple entries.
+def _parse(sFile, dProps, lDs):
+	"""Parse a semantic CSV file, filling in global properties and dataset
+	dictionaries as it goes.
 
-		The datasets dictionary has the following sub items:
-		{
-			'props': { local property dictionary }
-			'vars': {
-				'data': ndarray,
-				'units': str
-			}
-		}
+	This is a generator, it yields once after each data row so that callers
+	can take partial results.  Both dProps and lDs are updated in place.
 	"""
-
-	dProps = {}
-	lDs = [] 
-
 	with open(sFile, 'r', newline='') as fIn:
 		rdr = csv.reader(fIn)
 		for row in rdr:
@@ -286,8 +462,8 @@ def read(sFile):
 						i += 1
 			
 				elif (row[0] in ('P','H','D')) and (len(lDs) == 0): # PhD, totally not planned
-					lDs = [ _new_ds(0,1024)  ]
-					_parse_ds_cols(lDs, row)
+					lDs.append( _new_ds(sFile, rdr.line_num, '0', '1024') )
+					_parse_ds_cols(sFile, rdr.line_num, lDs[0], row)
 
 				elif row[0] == 'C':
 					continue
@@ -295,12 +471,93 @@ def read(sFile):
 					raise ParseError(sFile, rdr.line_num, "Unknown row type '%s'"%row[0])
 			else:
 				# pull out columns and feed to each dataset object
+				bData = False
 				for ds in lDs:
 					#perr("Reading columns: %s\n"%str(ds['_bounds']))
 					lSub = row[ ds['_bounds'][0] : ds['_bounds'][1] +1 ]
 					_parse_ds_cols(sFile, rdr.line_num, ds,lSub)
+					if (len(lSub) > 0) and (lSub[0] == 'D'): bData = True
+
+				if bData: yield rdr.line_num
+
+
+@profiling.timed('semcsv.read')
+def read(sFile, dtype=None):
+	"""Read a semantic CSV file and return a dictionary of global properties
+	and datasets.
+
+	Args:
+		sFile (str): The file to read
+		dtype (numpy.dtype): The floating point type for data values, defaults
+			to the setting from set_dtype()
+
+	Returns: (dict, dict)
+		(global_properties, datasets) 
+		The properties dictionary contains lists for data values. Thus each
+		property can have multiple entries.
+
+		The datasets are Dataset objects with these attributes:
+
+			props: { local property dictionary }
+			vars: { name: Variable(data=ndarray, units=str) }
+			block: the ndarray holding all numeric variables, or None
+
+		and typed copies of the common properties, see Dataset.
+	"""
+
+	dProps = {}
+	lDs = [] 
+
+	for nLine in _parse(sFile, dProps, lDs):
+		pass
 
 	for i in range(len(lDs)):
-		lDs[i] = _ds_finalize(lDs[i])  # Make object, Convert to numpy, drop internal column tracking
+		lDs[i] = _ds_finalize(lDs[i], dtype)  # Make object, Convert to numpy, drop internal column tracking
 
 	return (dProps, lDs)
+
+
+def _ds_take(dDs, dtype=None):
+	"""Make a dataset object from the data values parsed so far and then
+	clear them from the parser state.  Properties are shared, not copied.
+	"""
+	dVars = {}
+	for sVar in dDs['vars']:
+		dVar = dDs['vars'][sVar]
+		dVars[sVar] = {'units':dVar['units'], 'data':dVar['data']}
+		dVar['data'] = []
+
+	return _ds_finalize({'props':dDs['props'], 'vars':dVars}, dtype)
+
+
+def read_chunks(sFile, nRows=4096, dtype=None):
+	"""Read a semantic CSV file a few rows at a time.
+
+	This is for captures that are too long to hold in memory all at once.  At
+	most nRows data rows are converted and held at any one time.
+
+	Args:
+		sFile (str): The file to read
+		nRows (int): The maximum number of data rows in each chunk
+		dtype (numpy.dtype): The data value type, see read()
+
+	Returns: generator
+		Yields (global_properties, datasets) tuples as for read(), except that
+		each dataset only contains the data values for the current chunk.
+		Datasets that have run out of data in a chunk have zero length
+		variables.
+	"""
+	if nRows < 1:
+		raise ValueError("Chunk size must be at least one row")
+
+	dProps = {}
+	lDs = []
+	nHave = 0
+	for nLine in _parse(sFile, dProps, lDs):
+		nHave += 1
+		if nHave >= nRows:
+			yield (dProps, [ _ds_take(ds, dtype) for ds in lDs ])
+			nHave = 0
+
+	if nHave > 0:
+		yield (dProps, [ _ds_take(ds, dtype) for ds in lDs ])
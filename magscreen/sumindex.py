@@ -0,0 +1,393 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An SQLite index of a summary file, for fast part and date lookups
+
+The summary CSV file stays the master record, the index is kept next to it
+with the same name and a .sqlite extension, ScreenResults.sqlite for
+ScreenResults.csv.  The index remembers how many bytes of the CSV file it
+has seen, so lines appended by programs that don't know about the index
+are picked up the next time it is updated, and it can always be rebuilt
+from the CSV file.  The reverse also works, see write_csv().
+
+Index updates are made by summary.SummaryWriter while it holds the CSV
+file lock, so there is only ever one writer.  Readers may run at any time.
+
+Rows are (part, timestamp, technician, software, moment, field, result,
+host), host is only known for rows written through by summary.append().
+"""
+
+import os
+import re
+import sys
+import csv
+import time
+import sqlite3
+import calendar
+import functools
+
+perr = sys.stderr.write  # shorten a long function name
+
+g_lCols = [
+	'part', 'timestamp', 'technician', 'software', 'moment', 'field',
+	'result', 'host'
+]
+
+g_sSchema = '''
+CREATE TABLE IF NOT EXISTS results (
+	id INTEGER PRIMARY KEY,
+	part TEXT NOT NULL,
+	timestamp TEXT,
+	utc REAL,
+	technician TEXT,
+	software TEXT,
+	moment REAL,
+	field REAL,
+	result TEXT,
+	host TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+# Kept separate so that they can be dropped while a whole file is indexed,
+# building them afterwards is several times faster than keeping them updated
+g_lIndexes = [
+	('results_part', 'part, utc'), ('results_utc', 'utc'),
+	('results_tech', 'technician, utc'), ('results_result', 'result, utc'),
+	('results_host', 'host, utc')
+]
+
+# Rows are committed in batches of this size when indexing a whole file
+g_nBatch = 10000
+
+def index_path(sCsv):
+	"""Get the index file name for a summary CSV file"""
+	return os.path.splitext(sCsv)[0] + '.sqlite'
+
+# YYYY-MM-DD[THH:MM[:SS[.fff]]][Z|+HHMM|+HH:MM], strptime is too slow for
+# indexing millions of rows
+g_reTime = re.compile(
+	r'^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d*)?)?)?'+\
+	r'\s*(Z|([+-])(\d\d):?(\d\d))?$'
+)
+
+@functools.lru_cache(maxsize=4096)
+def _utc_day(sDate):
+	return calendar.timegm(tuple(int(s) for s in sDate.split('-')) + (0, 0, 0))
+
+def parse_time(sTime):
+	"""Convert an ISO-8601 time or date to unix seconds
+
+	Times without a UTC offset are taken to be local times.
+
+	Returns (float): Seconds since 1970-01-01, or None if not understood
+	"""
+	match = g_reTime.match(sTime.strip())
+	if not match: return None
+	(sY, sMo, sD, sH, sMi, sS, sZone, sSign, sOffH, sOffM) = match.groups()
+	nSec = int(sH or 0)*3600 + int(sMi or 0)*60 + int(sS or 0)
+
+	if not sZone:
+		return time.mktime((int(sY), int(sMo), int(sD), 0, 0, nSec, 0, 0, -1))
+
+	if sSign:
+		nOff = int(sOffH)*3600 + int(sOffM)*60
+		nSec -= nOff if sSign == '+' else -nOff
+	return float(_utc_day('%s-%s-%s'%(sY, sMo, sD)) + nSec)
+
+def _float(sVal):
+	try:
+		return float(sVal)
+	except ValueError:
+		return None
+
+def parse_lines(lLines):
+	"""Parse summary CSV lines into index rows, headers and short lines are
+	skipped.
+
+	Returns (list of tuple): Rows in g_lCols order, host is None
+	"""
+	lRows = []
+	for lFields in csv.reader(lLines, skipinitialspace=True):
+		lFields = [s.strip() for s in lFields]
+		if len(lFields) < 7 or lFields[0] == 'Part': continue
+		lRows.append((
+			lFields[0], lFields[1], lFields[2], lFields[3], _float(lFields[4]),
+			_float(lFields[5]), lFields[6], None
+		))
+	return lRows
+
+def _pread_lines(fd, nStart, nEnd, nBlock=1<<20):
+	"""Iterate over the lines between two offsets of an open file without
+	moving its position or opening it again.  The last line may be partial."""
+	xRest = b''
+	nPos = nStart
+	while nPos < nEnd:
+		xBlock = os.pread(fd, min(nBlock, nEnd - nPos), nPos)
+		if not xBlock: break
+		nPos += len(xBlock)
+		lParts = (xRest + xBlock).split(b'\n')
+		xRest = lParts.pop()
+		for xLine in lParts: yield xLine + b'\n'
+	if xRest: yield xRest
+
+def read_lines(sCsv, nStart=0, nEnd=None, nBatch=g_nBatch, fd=None):
+	"""Read whole lines from part of a summary file, in batches
+
+	A line that is still being written, without its newline, ends the read.
+
+	Args:
+		sCsv (str): The summary CSV file
+		nStart (int): The byte offset to start at, the start of a line
+		nEnd (int): Don't read past this offset, defaults to the file size
+		nBatch (int): The maximum number of lines in each batch
+		fd (int): A readable descriptor for the file to read through instead
+			of opening it.  Needed while the file is locked, closing any other
+			descriptor for the file would drop the caller's POSIX lock.
+
+	Yields (lLines, nPos): A list of decoded lines and the file offset just
+		after the last one
+	"""
+	if (fd is not None) and hasattr(os, 'pread'):
+		if nEnd is None: nEnd = os.fstat(fd).st_size
+		for tBatch in _batches(_pread_lines(fd, nStart, nEnd), nStart, nEnd, nBatch):
+			yield tBatch
+		return
+
+	# Windows locks aren't tied to descriptors, the file can be opened again
+	if nEnd is None: nEnd = os.path.getsize(sCsv)
+	with open(sCsv, 'rb') as fIn:
+		fIn.seek(nStart)
+		for tBatch in _batches(fIn, nStart, nEnd, nBatch):
+			yield tBatch
+
+def _batches(iLines, nStart, nEnd, nBatch):
+	nPos = nStart
+	bMore = True
+	while bMore:
+		lLines = []
+		nBytes = 0
+		bMore = False
+		for xLine in iLines:
+			if (nPos + nBytes + len(xLine) > nEnd) or not xLine.endswith(b'\n'):
+				break     # Partial line, the rest is being written
+			lLines.append(xLine.decode('utf-8', 'replace'))
+			nBytes += len(xLine)
+			if len(lLines) >= nBatch:
+				bMore = True
+				break
+		if not lLines: break
+
+		nPos += nBytes
+		yield (lLines, nPos)
+
+# ########################################################################## #
+
+class SummaryIndex:
+	"""An open summary index"""
+
+	def __init__(self, sDb):
+		"""Open or create an index file
+
+		Args:
+			sDb (str): The SQLite file name, see index_path()
+		"""
+		self.sDb = sDb
+		# Wait for readers rather than failing, summary files are often on
+		# network shares where SQLite's WAL mode can't be used.  An index may
+		# be used by any thread, callers make sure only one at a time does.
+		self.con = sqlite3.connect(sDb, timeout=30, check_same_thread=False)
+		self.con.executescript(g_sSchema)
+		self._indexes(True)
+
+	def _indexes(self, bCreate):
+		for (sName, sCols) in g_lIndexes:
+			if bCreate:
+				self.con.execute('CREATE INDEX IF NOT EXISTS %s ON results (%s)'%(sName, sCols))
+			else:
+				self.con.execute('DROP INDEX IF EXISTS %s'%sName)
+		self.con.commit()
+
+	def close(self):
+		self.con.close()
+
+	def offset(self):
+		"""Get the number of CSV file bytes that have been indexed"""
+		row = self.con.execute("SELECT value FROM meta WHERE key='csv_offset'").fetchone()
+		return int(row[0]) if row else 0
+
+	def add(self, lRows, nOffset):
+		"""Add rows and record the CSV file position they end at, in one
+		transaction.
+
+		Args:
+			lRows (list of tuple): Rows in g_lCols order
+			nOffset (int): The CSV file size after these rows
+		"""
+		lRecs = [ tuple(row[:2]) + (parse_time(row[1]),) + tuple(row[2:]) for row in lRows ]
+		with self.con:
+			self.con.executemany(
+				'INSERT INTO results (part, timestamp, utc, technician, software, '+\
+				'moment, field, result, host) VALUES (?,?,?,?,?,?,?,?,?)', lRecs
+			)
+			self.con.execute(
+				"INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_offset', ?)",
+				('%d'%nOffset,)
+			)
+
+	def clear(self):
+		with self.con:
+			self.con.execute('DELETE FROM results')
+			self.con.execute("DELETE FROM meta WHERE key='csv_offset'")
+
+	def catch_up(self, sCsv, nEnd=None, fd=None):
+		"""Index the CSV lines added since the last update
+
+		If the CSV file is shorter than the indexed size it was replaced,
+		and the whole file is indexed again.
+
+		Args:
+			sCsv (str): The summary CSV file
+			nEnd (int): Stop at this byte offset, defaults to the file size.
+				Only whole lines are indexed.
+			fd (int): Read through this descriptor, see read_lines()
+
+		Returns (int): The number of rows added
+		"""
+		if nEnd is None:
+			nEnd = os.fstat(fd).st_size if fd is not None else os.path.getsize(sCsv)
+		nStart = self.offset()
+		if nStart > nEnd:
+			perr("WARN:  %s is shorter than its index, re-indexing\n"%sCsv)
+			self.clear()
+			nStart = 0
+		if nStart == nEnd: return 0
+
+		if nStart == 0: self._indexes(False)   # Indexing the whole file
+
+		try:
+			return self._read(sCsv, nStart, nEnd, fd)
+		finally:
+			if nStart == 0: self._indexes(True)
+
+	def _read(self, sCsv, nStart, nEnd, fd):
+		"""Index whole lines between two file offsets, in batches"""
+		nAdded = 0
+		for (lLines, nPos) in read_lines(sCsv, nStart, nEnd, fd=fd):
+			lRows = parse_lines(lLines)
+			self.add(lRows, nPos)
+			nAdded += len(lRows)
+		return nAdded
+
+	def query(self, sPart=None, sPrefix=None, rSince=None, rUntil=None,
+		sTech=None, sResult=None, sHost=None, nLimit=None, bCount=False):
+		"""Find summary rows
+
+		Args:
+			sPart (str): Exact part name
+			sPrefix (str): Part names starting with this string
+			rSince (float): Tests at or after this unix time
+			rUntil (float): Tests before this unix time
+			sTech (str): Technician name
+			sResult (str): Result text, FAILED, CAUTION or PASSED
+			sHost (str): Bench host name
+			nLimit (int): Return only the most recent nLimit rows
+			bCount (bool): Return the number of matches instead of the rows
+
+		Returns (list of tuple | int): Rows in g_lCols order, oldest first
+		"""
+		lWhere = []
+		lArgs = []
+		if sPart is not None:
+			lWhere.append('part = ?')
+			lArgs.append(sPart)
+		if sPrefix:
+			# A range instead of LIKE so that the part index is used
+			lWhere.append('part >= ? AND part < ?')
+			lArgs += [sPrefix, sPrefix[:-1] + chr(ord(sPrefix[-1]) + 1)]
+		if rSince is not None:
+			lWhere.append('utc >= ?')
+			lArgs.append(rSince)
+		if rUntil is not None:
+			lWhere.append('utc < ?')
+			lArgs.append(rUntil)
+		for (sCol, sVal) in (('technician', sTech), ('result', sResult), ('host', sHost)):
+			if sVal is not None:
+				lWhere.append('%s = ?'%sCol)
+				lArgs.append(sVal)
+
+		sWhere = (' WHERE ' + ' AND '.join(lWhere)) if lWhere else ''
+		if bCount:
+			return self.con.execute('SELECT count(*) FROM results' + sWhere, lArgs).fetchone()[0]
+
+		sSql = 'SELECT %s FROM results%s ORDER BY utc DESC, id DESC'%(', '.join(g_lCols), sWhere)
+		if nLimit: sSql += ' LIMIT %d'%nLimit
+		lRows = self.con.execute(sSql, lArgs).fetchall()
+		lRows.reverse()
+		return lRows
+
+	def rows(self):
+		"""Iterate over all rows in the order they were indexed"""
+		return self.con.execute(
+			'SELECT %s FROM results ORDER BY id'%', '.join(g_lCols)
+		)
+
+# ########################################################################## #
+
+def update(sCsv, bFull=False, fd=None):
+	"""Bring the index for a summary file up to date
+
+	Args:
+		sCsv (str): The summary CSV file
+		bFull (bool): Drop the index and rebuild it from the whole file
+		fd (int): Read through this descriptor, see read_lines()
+
+	Returns (int): The number of rows added
+	"""
+	idx = SummaryIndex(index_path(sCsv))
+	try:
+		if bFull: idx.clear()
+		return idx.catch_up(sCsv, fd=fd)
+	finally:
+		idx.close()
+
+
+def write_csv(sDb, sCsv):
+	"""Write a summary CSV file from an index, for when the CSV file is lost
+
+	Args:
+		sDb (str): The index file
+		sCsv (str): The CSV file to write, must not exist
+
+	Returns (int): The number of rows written
+	"""
+	import magscreen.summary as summary
+
+	if os.path.exists(sCsv):
+		raise IOError("Cowardly refusing to overwrite existing summary data")
+
+	idx = SummaryIndex(sDb)
+	nRows = 0
+	try:
+		with open(sCsv, 'w', newline='') as fOut:
+			fOut.write(summary.g_sHeader)
+			for row in idx.rows():
+				fOut.write(summary.format_row(row))
+				nRows += 1
+	finally:
+		idx.close()
+	return nRows
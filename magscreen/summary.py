@@ -19,29 +19,233 @@
 
 import os
 import sys
+import time
+import threading
 import argparse
 from os.path import basename as bname
 from os.path import dirname as dname
 
 import magscreen.common as common
 import magscreen.semcsv as semcsv
-import magscreen.calc as calc
+import magscreen.profiling as profiling
 
 perr = sys.stderr.write  # shorten a long function name
 
-def _mkHeader(sAbsFile):
-	if os.path.isfile(sAbsFile):
-		raise IOError("Cowardly refusing to overwrite existing summary data")
-	perr("INFO:  Creating file %s\n"%sAbsFile)
-	fOut = open(sAbsFile, "w", newline='')
-	fOut.write('"Part","Timestamp","Technician","Software","Dipole [N m T^-1]","Field @ 1 m [nT]","Result"\r\n')
-	fOut.flush()
-	fOut.close()
+g_sHeader = '"Part","Timestamp","Technician","Software","Dipole [N m T^-1]",'+\
+	'"Field @ 1 m [nT]","Result"\r\n'
 
+# Advisory whole file locks.  POSIX record locks are used instead of flock()
+# since they also work on NFS shares.  They are held per process, threads
+# in one process are kept apart by the SummaryWriter commit lock.
+try:
+	import fcntl
 
-def append(sAbsFile, dProps, lDs):
+	def _lock(fd):
+		fcntl.lockf(fd, fcntl.LOCK_EX)
+
+	def _unlock(fd):
+		fcntl.lockf(fd, fcntl.LOCK_UN)
+
+except ImportError:
+	import msvcrt
+
+	# Windows locks byte ranges, lock the first byte even if the file is
+	# empty.  LK_LOCK gives up after 10 seconds, so keep trying.
+	def _lock(fd):
+		os.lseek(fd, 0, os.SEEK_SET)
+		while True:
+			try:
+				msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+				return
+			except OSError:
+				time.sleep(0.1)
+
+	def _unlock(fd):
+		os.lseek(fd, 0, os.SEEK_SET)
+		msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class SummaryWriter:
+	"""Appends rows to a summary file that other processes may also be
+	writing to.
+
+	Each commit takes an exclusive lock on the file, adds the header if the
+	file is empty, writes all pending lines with a single write call and
+	syncs the file to disk.  Lines from threads that arrive while a commit is
+	in progress are gathered up and written together by the next commit, so
+	the file is locked and synced once per group instead of once per line.
+	Only the write is done under the lock, so benches sharing a file wait on
+	each other for milliseconds at most.
+
+	While the lock is held the rows are also added to the SQLite index next
+	to the file, see magscreen.sumindex.  The CSV file is the master copy,
+	if the index can't be updated a warning is printed and the rows are
+	picked up from the CSV file by a later commit.
+	"""
+
+	def __init__(self, sAbsFile, bIndex=True):
+		"""
+		Args:
+			sAbsFile (str): The summary file, it and any intermediate
+				directories are created as needed.
+			bIndex (bool): Keep the SQLite index up to date
+		"""
+		self.sFile = sAbsFile
+		self.bIndex = bIndex
+		self.idx = None
+		self.lPending = []
+		self.nQueued = 0       # Sequence number of the last line queued
+		self.nDone = 0         # Sequence number of the last line committed
+		self.nWaiting = 0      # write() calls with lines in lPending
+		self.lFailed = []      # [first, last, exception, calls left] per failed commit
+		self.lockQueue = threading.Lock()
+		self.lockCommit = threading.Lock()
+
+	def write(self, lRows):
+		"""Append rows to the file, returns once they are on disk
+
+		If the commit holding these rows fails, the error is raised in every
+		thread that had rows in it, not just the one that ran the commit.
+
+		Args:
+			lRows (list of tuple): Rows from make_row()
+		"""
+		with self.lockQueue:
+			nFirst = self.nQueued + 1
+			self.lPending.extend(lRows)
+			self.nQueued += len(lRows)
+			self.nWaiting += 1
+			nMine = self.nQueued
+
+		with self.lockCommit:
+			if self.nDone >= nMine:
+				# Handled by another thread's commit, which may have failed
+				self._check_failed(nFirst, nMine)
+				return
+
+			with self.lockQueue:
+				lBatch = self.lPending
+				self.lPending = []
+				nTop = self.nQueued
+				nCalls = self.nWaiting
+				self.nWaiting = 0
+
+			try:
+				self._commit(lBatch)
+			except Exception as exc:
+				if nCalls > 1: self.lFailed.append([self.nDone + 1, nTop, exc, nCalls - 1])
+				raise
+			finally:
+				self.nDone = nTop
+
+	def _check_failed(self, nFirst, nLast):
+		"""Raise the error of a failed commit that held lines nFirst to nLast,
+		called with the commit lock held"""
+		for lFail in self.lFailed:
+			if (nFirst <= lFail[1]) and (nLast >= lFail[0]):
+				lFail[3] -= 1
+				if lFail[3] <= 0: self.lFailed.remove(lFail)
+				raise lFail[2]
+
+	def _commit(self, lRows):
+		sDir = dname(self.sFile)
+		if len(sDir) > 0: os.makedirs(sDir, exist_ok=True)
+
+		# Read access too, so the index catch up can read through this fd
+		fd = os.open(self.sFile, os.O_RDWR|os.O_APPEND|os.O_CREAT|getattr(os,'O_BINARY',0), 0o666)
+		try:
+			_lock(fd)
+			try:
+				lLines = [ format_row(row) for row in lRows ]
+
+				# Checked under the lock so that only one writer adds a header
+				nBefore = os.fstat(fd).st_size
+				if nBefore == 0:
+					perr("INFO:  Creating file %s\n"%self.sFile)
+					lLines = [g_sHeader] + lLines
+
+				xData = ''.join(lLines).encode('utf-8')
+				nOff = 0
+				while nOff < len(xData):
+					nOff += os.write(fd, xData[nOff:])
+				os.fsync(fd)
+
+				if self.bIndex: self._index(fd, lRows, nBefore, nBefore + len(xData))
+			finally:
+				_unlock(fd)
+		finally:
+			os.close(fd)
+
+	def _index(self, fd, lRows, nBefore, nAfter):
+		"""Add rows to the index, called with the CSV file locked through fd.
+		The file is read through fd, opening and closing it again would drop
+		the lock."""
+		import sqlite3
+		import magscreen.sumindex as sumindex
+		try:
+			if self.idx is None:
+				self.idx = sumindex.SummaryIndex(sumindex.index_path(self.sFile))
+
+			# Lines from writers that don't keep the index go in first
+			if self.idx.offset() != nBefore: self.idx.catch_up(self.sFile, nBefore, fd)
+			self.idx.add(lRows, nAfter)
+
+		except (sqlite3.Error, OSError) as exc:
+			perr("WARN:  Summary index not updated, %s\n"%exc)
+			if self.idx: self.idx.close()
+			self.idx = None
+
+
+# One writer per file, so that threads in a process commit together
+g_dWriters = {}
+g_lockWriters = threading.Lock()
+
+def get_writer(sAbsFile):
+	"""Get the shared SummaryWriter for a summary file"""
+	sKey = os.path.normcase(os.path.abspath(sAbsFile))
+	with g_lockWriters:
+		if sKey not in g_dWriters: g_dWriters[sKey] = SummaryWriter(sAbsFile)
+		return g_dWriters[sKey]
+
+
+def make_row(dProps, moment, Bstray, sStatus):
+	"""Get the summary row for one test
+
+	Args:
+		dProps (dict): The global properties of the test file
+		moment (float): The fitted dipole moment [N m T^-1]
+		Bstray (float): The field at 1 m [nT]
+		sStatus (str): The result text, see calc.status_text
+
+	Returns (tuple): (part, timestamp, technician, software, moment, field,
+		result, host), host is None for files written before it was saved
+	"""
+	return (
+		dProps['Part'][0], dProps['Timestamp'][0], dProps['User'][0],
+		dProps['Version'][0], moment, Bstray, sStatus,
+		dProps['Host'][0] if 'Host' in dProps else None
+	)
+
+
+def format_row(row):
+	"""Get the summary file line for a row, the host is not included
+
+	Returns (str): The line, with a \\r\\n ending
+	"""
+	def _num(r): return '' if r is None else '%.3e'%r
+
+	return '"%s","%s","%s","%s",%s,%s,"%s"\r\n'%(
+		row[0], row[1], row[2], row[3], _num(row[4]), _num(row[5]), row[6]
+	)
+
+
+@profiling.timed('summary.append')
+def append(sAbsFile, dProps, lDs, ana=None):
 	"""Append dataset summaries to a tracking file.
 
+	Safe to call from several threads and processes at once, see
+	SummaryWriter.
+
 	Args:
 	sAbsFile (str): The absolute path to the summary file.  The file is
 		created if it does not exist.  Intermediate directories are 
@@ -50,44 +254,258 @@ def append(sAbsFile, dProps, lDs):
 	dProps (dict): A dictionary of global properties for each test set.
 
 	lDs (list of semcsv.Dataset): A list of all the datasets for a single
-		test.
+		test.  May be None if ana is given.
+
+	ana (calc.Analysis): The fit results if already known, see
+		results.get(), otherwise the fit is run here.
+
+	Returns (moment, stray_field, status):
+		The fitted dipole moment [N m T^-1], the field at 1 m [nT] and the
+		result text, as written to the file.
 	"""
+	import magscreen.calc as calc  # Not needed until a fit is run
 
-	sDir = dname(sAbsFile)
-	if len(sDir) > 0: os.makedirs(sDir, exist_ok=True)
+	if ana is None: ana = calc.analyze(lDs)
+	sStatus = calc.status_text[ana.status]
 
-	if not os.path.isfile(sAbsFile):
-		_mkHeader(sAbsFile)
+	get_writer(sAbsFile).write([make_row(dProps, ana.moment, ana.Bstray, sStatus)])
 
-	fOut = open(sAbsFile, "a", newline='') # Should auto seek(END)
+	return (ana.moment, ana.Bstray, sStatus)
 
-	(dist, rate, Zangle, Xangle, Bdipole, moment, merror) = calc.dipole_from_rotation(lDs)
-	(Bstray, BstrayErr, iStatus) = calc.stray_field_1m(moment, merror)
+def update_index(sAbsFile, bFull=False):
+	"""Bring the SQLite index of a summary file up to date
 
-	fOut.write('"%s","%s","%s","%s",%.3e,%.3e,"%s"\r\n'%(
-		dProps['Part'][0], dProps['Timestamp'][0], dProps['User'][0],
-		dProps['Version'][0], moment, Bstray, calc.status_text[iStatus]
-	))
+	The summary file is locked while the index is updated, so that rows
+	being written through by other programs are not indexed twice.
+
+	Args:
+		sAbsFile (str): The summary file
+		bFull (bool): Rebuild the whole index
 
-	fOut.flush()
-	fOut.close()
+	Returns (int): The number of rows added to the index
+	"""
+	import magscreen.sumindex as sumindex
+
+	fd = os.open(sAbsFile, os.O_RDWR|os.O_APPEND|getattr(os,'O_BINARY',0))
+	try:
+		_lock(fd)
+		try:
+			return sumindex.update(sAbsFile, bFull, fd)
+		finally:
+			_unlock(fd)
+	finally:
+		os.close(fd)
 
 # ########################################################################## #
+
+def _main_query(lArgs):
+	import sqlite3
+	import magscreen.sumindex as sumindex
+
+	psr = argparse.ArgumentParser(
+		prog='mag_screen_sum query', formatter_class=common.BreakFormatter
+	)
+	psr.description = \
+	"""Find results in a summary file using its SQLite index.  The index is
+	brought up to date first.  Matching rows are printed in summary file
+	format, oldest first, with an extra Host column.  All conditions given
+	must match."""
+
+	psr.add_argument('--part', dest='sPart', metavar='PART', help='Exactly this part')
+	psr.add_argument('--prefix', dest='sPrefix', metavar='TEXT',
+		help='Parts with names starting with TEXT')
+	psr.add_argument('--since', dest='sSince', metavar='DATE',
+		help='Tests on or after DATE, as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS local time')
+	psr.add_argument('--until', dest='sUntil', metavar='DATE',
+		help='Tests before DATE')
+	psr.add_argument('--tech', dest='sTech', metavar='NAME', help='Technician')
+	psr.add_argument('--result', dest='sResult', metavar='RESULT',
+		help='FAILED, CAUTION or PASSED')
+	psr.add_argument('--host', dest='sHost', metavar='HOST', help='Bench host name')
+	psr.add_argument('-n', '--limit', dest='nLimit', metavar='N', type=int,
+		default=None, help='Only print the most recent N rows')
+	psr.add_argument('-c', '--count', dest='bCount', action='store_true',
+		default=False, help='Only print the number of matching rows')
+	psr.add_argument("SUMMARY_FILE", help='The summary file to search')
+
+	opts = psr.parse_args(lArgs)
+
+	dTimes = {}
+	for sOpt in ('sSince','sUntil'):
+		sVal = getattr(opts, sOpt)
+		dTimes[sOpt] = None if sVal is None else sumindex.parse_time(sVal)
+		if (sVal is not None) and (dTimes[sOpt] is None):
+			perr("ERROR: Can't parse date %s\n"%sVal)
+			return 3
+
+	sDb = sumindex.index_path(opts.SUMMARY_FILE)
+	try:
+		update_index(opts.SUMMARY_FILE)
+	except OSError as exc:
+		if not os.path.isfile(sDb):
+			perr("ERROR: %s\n"%exc)
+			return 4
+		perr("WARN:  Index not updated, %s\n"%exc)
+
+	idx = sumindex.SummaryIndex(sDb)
+	try:
+		xOut = idx.query(
+			opts.sPart, opts.sPrefix, dTimes['sSince'], dTimes['sUntil'], opts.sTech,
+			opts.sResult.upper() if opts.sResult else None, opts.sHost,
+			opts.nLimit, opts.bCount
+		)
+	except sqlite3.Error as exc:
+		perr("ERROR: %s\n"%exc)
+		return 4
+	finally:
+		idx.close()
+
+	if opts.bCount:
+		print(xOut)
+		return 0
+
+	fOut = sys.stdout
+	fOut.write(g_sHeader.rstrip() + ',"Host"\n')
+	for row in xOut:
+		fOut.write('%s,"%s"\n'%(format_row(row).rstrip(), row[7] or ''))
+	return 0
+
+
+def _main_index(lArgs):
+	import sqlite3
+
+	psr = argparse.ArgumentParser(
+		prog='mag_screen_sum index', formatter_class=common.BreakFormatter
+	)
+	psr.description = \
+	"""Create or update the SQLite index of a summary file.  Rows appended
+	since the last update are added, use --full to start over."""
+	psr.add_argument('--full', dest='bFull', action='store_true', default=False,
+		help='Rebuild the whole index from the summary file')
+	psr.add_argument("SUMMARY_FILE", help='The summary file to index')
+	opts = psr.parse_args(lArgs)
+
+	try:
+		nRows = update_index(opts.SUMMARY_FILE, opts.bFull)
+	except (OSError, sqlite3.Error) as exc:
+		perr("ERROR: %s\n"%exc)
+		return 4
+	perr("INFO:  %d rows added to the index of %s\n"%(nRows, opts.SUMMARY_FILE))
+	return 0
+
+
+def _main_rebuild(lArgs):
+	import sqlite3
+	import magscreen.sumindex as sumindex
+
+	psr = argparse.ArgumentParser(
+		prog='mag_screen_sum rebuild-csv', formatter_class=common.BreakFormatter
+	)
+	psr.description = \
+	"""Write a summary file from its SQLite index, for when the summary
+	file is lost or damaged.  The summary file must not exist."""
+	psr.add_argument('-i', '--index', dest='sDb', metavar='FILE', default=None,
+		help='The index file, defaults to SUMMARY_FILE with a .sqlite extension')
+	psr.add_argument("SUMMARY_FILE", help='The summary file to write')
+	opts = psr.parse_args(lArgs)
+
+	sDb = opts.sDb or sumindex.index_path(opts.SUMMARY_FILE)
+	if not os.path.isfile(sDb):
+		perr("ERROR: Index file %s not found\n"%sDb)
+		return 4
+	try:
+		nRows = sumindex.write_csv(sDb, opts.SUMMARY_FILE)
+	except (OSError, sqlite3.Error) as exc:
+		perr("ERROR: %s\n"%exc)
+		return 4
+	perr("INFO:  %d rows written to %s\n"%(nRows, opts.SUMMARY_FILE))
+	return 0
+
+
+def _main_reprocess(lArgs):
+	import magscreen.reprocess as reprocess
+	return reprocess.main(lArgs)
+
+
+def _main_rollup(lArgs):
+	import magscreen.rollup as rollup
+	return rollup.main(lArgs)
+
+
+# Sub commands, the first argument selects one of these instead of the
+# original TEST_DATA SUMMARY_FILE usage
+g_dCommands = {
+	'query':_main_query, 'index':_main_index, 'rebuild-csv':_main_rebuild,
+	'reprocess':_main_reprocess, 'rollup':_main_rollup
+}
+
+
+def _uncertainty(sFile, nTrials, nSeed):
+	"""Print the bootstrap interval of a test's dipole moment"""
+	import magscreen.uncert as uncert
+
+	(dProps, lDs) = semcsv.read(sFile)
+	try:
+		unc = uncert.moment_uncertainty(lDs, nTrials, nSeed=nSeed)
+	except (ValueError, KeyError) as exc:
+		perr("ERROR: Can't estimate the moment uncertainty for %s, %s\n"%(sFile, exc))
+		return 5
+
+	perr("INFO:  Median moment %.3e [N m T^-1], 95%% interval %.3e to %.3e from %d trials\n"%(
+		unc.moment, unc.lower, unc.upper, len(unc.trials)
+	))
+	perr("INFO:  Chance of exceeding 5.000e-02 [N m T^-1], %.1f%%\n"%(
+		unc.prob_exceed*100
+	))
+	return 0
+
+
 def main():
+	if (len(sys.argv) > 1) and (sys.argv[1] in g_dCommands):
+		return g_dCommands[sys.argv[1]](sys.argv[2:])
+
 	psr = argparse.ArgumentParser(formatter_class=common.BreakFormatter)
 	psr.description = '''\
-	Read raw mag-screening data and append summary to a master result file
-	'''
+	Read raw mag-screening data and append summary to a master result file.
+	Other tasks are run by giving a command first, see
+	mag_screen_sum COMMAND -h for each of: %s
+	'''%', '.join(sorted(g_dCommands))
 
 	psr.add_argument("TEST_DATA",help='A file containing magnetic screening test'+\
 		' data in in Semantic CSV format')
 
 	psr.add_argument("SUMMARY_FILE", help='A file to recive test summary information')
 
+	psr.add_argument(
+		'-u', '--uncertainty', dest='nTrials', metavar='N', type=int, default=None,
+		help="Also estimate the 95%% confidence interval of the dipole moment "+\
+		"and the chance that it is over the 0.05 [N m T^-1] limit, by "+\
+		"re-running the fit N times on resampled data.  Several thousand "+\
+		"trials are typical, try 4000.  Off by default since it takes much "+\
+		"longer than the fit itself."
+	)
+
+	psr.add_argument(
+		'--seed', dest='nSeed', metavar='N', type=int, default=None,
+		help="Random number seed for --uncertainty, runs with the same seed "+\
+		"give the same interval."
+	)
+
 	opts = psr.parse_args()
-	(dProps, lDatasets) = semcsv.read(opts.TEST_DATA)
-	append(opts.SUMMARY_FILE, dProps, lDatasets)
-	perr("INFO:  Summary appended to %s\n"%opts.SUMMARY_FILE)
+	if (opts.nTrials is not None) and (opts.nTrials < 1):
+		psr.error("--uncertainty needs at least 1 trial")
+
+	profiling.enable_from_env('mag_screen_sum')
+	try:
+		import magscreen.results as results
+		(dProps, ana) = results.get(opts.TEST_DATA)   # Only reads data if needed
+		append(opts.SUMMARY_FILE, dProps, None, ana)
+		perr("INFO:  Summary appended to %s\n"%opts.SUMMARY_FILE)
+
+		if opts.nTrials is not None:
+			return _uncertainty(opts.TEST_DATA, opts.nTrials, opts.nSeed)
+	finally:
+		profiling.finish()
 
 	return 0
 
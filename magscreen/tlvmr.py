@@ -27,6 +27,10 @@ import serial
 import serial.tools.list_ports
 from os.path import dirname as dname
 
+import magscreen.calib as calib
+import magscreen.semcsv as semcsv
+import magscreen.profiling as profiling
+
 try:
 	import tldevice
 except ImportError as exc:
@@ -35,6 +39,7 @@ except ImportError as exc:
 perr = sys.stderr.write  # shorten a long function names
 
 # ########################################################################## #
+@profiling.timed('tlvmr.find_device')
 def find_device(serialno, pid=0x6015, vid=0x0403):
 	"""Find the port number for a serial device.
 
@@ -73,12 +78,64 @@ def find_device(serialno, pid=0x6015, vid=0x0403):
 
 # ########################################################################## #
 
-class VMR(threading.Thread):
+class SampleBuffer:
+	"""A growable [N, K] array filled one row at a time
+
+	Rows are kept in fixed size numpy chunks so that growing never copies
+	what has already been collected, and a long capture at float32 takes
+	12 bytes per 3-axis sample instead of a python list per reading.  One
+	thread may append while others read.
+	"""
+
+	def __init__(self, nCols, dtype, nChunk=4096):
+		self.nCols = nCols
+		self.dtype = np.dtype(dtype)
+		self.nChunk = nChunk
+		self.lFull = []
+		self.aCur = np.empty((nChunk, nCols), dtype=self.dtype)
+		self.nCur = 0
+		self.lock = threading.Lock()
+
+	def append(self, row):
+		with self.lock:
+			if self.nCur == self.nChunk:
+				self.lFull.append(self.aCur)
+				self.aCur = np.empty((self.nChunk, self.nCols), dtype=self.dtype)
+				self.nCur = 0
+			self.aCur[self.nCur] = row
+			self.nCur += 1
+
+	def __len__(self):
+		return len(self.lFull)*self.nChunk + self.nCur
+
+	def __getitem__(self, i):
+		with self.lock:
+			n = len(self.lFull)*self.nChunk + self.nCur
+			if i < 0: i += n
+			if (i < 0) or (i >= n): raise IndexError("Sample %d is out of range"%i)
+			(iChunk, iRow) = divmod(i, self.nChunk)
+			if iChunk < len(self.lFull): return self.lFull[iChunk][iRow]
+			return self.aCur[iRow]
+
+	def array(self):
+		"""Get a copy of all rows as one [N, K] array"""
+		with self.lock:
+			return np.concatenate(self.lFull + [self.aCur[:self.nCur]])
+
+# ########################################################################## #
+
+class VMR:
 	"""
 	Gather data from a single serial port and generate a list ofdata values
 	and associated time values
+
+	Collection runs in a background thread with the same start(), stop() and
+	join() calls as a threading.Thread.  Unlike a Thread it can be started
+	again after reset(), so a long running program can keep the sensor
+	connection open between tests.
 	"""
-	def __init__(self, sid, serialno, hertz, pid=0x6015, vid=0x0403):
+	@profiling.timed('tlvmr.open')
+	def __init__(self, sid, serialno, hertz, pid=0x6015, vid=0x0403, sCalFile=None):
 		"""Create a new VMR communication object.
 
 		Instead of connecting to a specific COM or TTY port, available ports are
@@ -105,17 +162,21 @@ class VMR(threading.Thread):
 
 			vid (int): The vendor ID for the device.  Defaults to 0x0403 which
 		   is assigned to 'FTDI - Future Technology Devices International LTD'
+
+			sCalFile (str): A calibration registry file, see magscreen.calib.
+				If None, nominal values are used.
 		"""
-		threading.Thread.__init__(self)
+		self.thread = None
 		self.sid = sid      # Sensor ID
 		self.serialno = serialno
 		self.pid = pid
 		self.vid = vid
 		self.dist = 999     # In centimeters
+		self.role = 'near'  # or 'reference' for a far field ambient sensor
 		self.rate = hertz
+		self.nperseg = None # Welch segment length, saved if set
 		self.time0 = time.time()
-		self.time = []      # Time values for measurements 
-		self.raw_data = []  # Raw mag, accel, gyro, pressure & thermal data values
+		self._new_buffers()
 
 		self.port = find_device(serialno,pid,vid)
 		if self.port is None:
@@ -145,10 +206,11 @@ class VMR(threading.Thread):
 
 		# Information about this sensor
 		self.dev_info = self.device.dev.desc()
-		
-      # Internal magnetometer displacement from front face of sensor in long
-      # dimension.        X     Y     Z
-		self.displace = [0.01025, 0, 0.00475]
+
+		# Gain, bias and internal magnetometer displacement from front face of
+		# sensor, looked up by UART serial number and VMR identity
+		self.calib = calib.lookup(self.serialno, self.dev_info, sCalFile)
+		self.displace = [ r*0.01 for r in self.calib.offset_cm ]  # meters
 
 	def set_dist(self, dist):
 		"""Set the distance from the sensor to the object measured
@@ -159,6 +221,27 @@ class VMR(threading.Thread):
 		"""
 		self.dist = dist
 
+	def set_role(self, role):
+		"""Set the role of this sensor in the screening setup
+
+		Args:
+			role (str): Either 'near' for sensors close to the rotating object, or
+				'reference' for a far field sensor that only sees the ambient
+				field.
+		"""
+		if role not in ('near','reference'):
+			raise ValueError("Unknown sensor role '%s'"%role)
+		self.role = role
+
+	def set_nperseg(self, nperseg):
+		"""Set the Welch segment length to save with the data, see planner.py
+
+		Args:
+			nperseg (int): The segment length in samples, or None to leave it
+				out and have the analysis use its default.
+		"""
+		self.nperseg = nperseg
+
 	def set_time0(self, new_zero):
 		"""Reset the zero time for measurements.
 		Args:
@@ -168,50 +251,99 @@ class VMR(threading.Thread):
 		"""
 		self.time0 = new_zero
 
+	def reset(self):
+		"""Drop the data from the last collection run so that start() can be
+		called again.
+		"""
+		if self.thread and self.thread.is_alive():
+			raise RuntimeError("Sensor %s is still collecting data"%self.sid)
+		self.thread = None
+		self._new_buffers()
+
+	def _new_buffers(self):
+		# Only the magnetic field vector is kept from each reading, in the
+		# data value type current when collection is reset, see semcsv.set_dtype()
+		self.time = SampleBuffer(1, np.float64)     # Time values for measurements
+		self.vecs = SampleBuffer(3, semcsv.get_dtype())  # Raw mag vectors
+
+	def start(self):
+		"""Start collecting data in a background thread"""
+		if self.thread is not None:
+			raise RuntimeError("Sensor %s must be reset before restarting"%self.sid)
+		self.go = True
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
 	def stop(self):
 		self.go = False
 
-	def close(self):
-		"""Close the comm port for this sensor.  Do this before creating an 
-		new connection to the same sensor at a different sampling rate.
+	def join(self, timeout=None):
+		"""Wait for the collection thread to exit"""
+		if self.thread: self.thread.join(timeout)
+
+	def close(self, timeout=2.0):
+		"""Stop collecting and close the comm port for this sensor.  Do this
+		before creating an new connection to the same sensor at a different
+		sampling rate, or after it stopped sending data.
+
+		Args:
+			timeout (float): Seconds to wait for the collection thread.  It
+				only sees the stop request when the next sample arrives, a
+				sensor that went quiet is closed without waiting longer.
 		"""
-	
+		self.stop()
+		self.join(timeout)
+		if self.device is not None:
+			self.device._tio.close()
+			self.device = None
+
 	def run(self):
-		self.raw_data = []
 		self.go = True
+		(iBx, iBy, iBz) = (self.iBx, self.iBy, self.iBz)
+		# data.iter() flushes samples queued while the sensor sat idle, so a
+		# warm connection does not pick up data from between runs
 		for row in self.device.data.iter():
 			if not self.go:
 				break
 			self.time.append(time.time() - self.time0)
-			self.raw_data.append(row)
+			self.vecs.append((row[iBx], row[iBy], row[iBz]))
 			
 	def mag_vectors(self):
-		"""Output an [N x 3] array of the mag vectors"""
-		vecs = np.zeros([len(self.raw_data), 3])
-		
-		# TODO: Vectorize this
-		for i in range(len(self.raw_data)):
-			vecs[i,0] = self.raw_data[i][self.iBx]
-			vecs[i,1] = self.raw_data[i][self.iBy]
-			vecs[i,2] = self.raw_data[i][self.iBz]
-		
-		return vecs
+		"""Output an [N x 3] array of the raw mag vectors, in the data value
+		type set when collection started"""
+		return self.vecs.array()
+
+	def cal_vectors(self):
+		"""Output an [N x 3] array of the calibrated mag vectors"""
+		aVecs = self.mag_vectors()
+		return calib.apply(self.calib, aVecs).astype(aVecs.dtype, copy=False)
+
+	def dropped(self):
+		"""Estimate the number of samples lost during the last collection run
+
+		The number expected is taken from the data rate and the time between
+		the first and last samples received, so samples lost at the very start
+		or end of a run are not counted.
+
+		Returns (int): Expected samples less those received, never negative
+		"""
+		if len(self.time) < 2: return 0
+		nExpect = int(round((self.time[-1][0] - self.time[0][0])*self.rate)) + 1
+		return max(0, nExpect - len(self.time))
 
 	def __len__(self):
 		"""Provide data length method"""
-		return len(self.raw_data)
+		return len(self.vecs)
 
 	def __getitem__(self, key):
 		"""Provide get data by index method, akay []"""
-		return (
-			self.time[key], self.raw_data[key][self.iBx],
-			self.raw_data[key][self.iBy], self.raw_data[key][self.iBz]
-		)
+		aVec = self.vecs[key]
+		return (float(self.time[key][0]), aVec[0], aVec[1], aVec[2])
 
 		
 	def times(self):
 		"""Output an [N] length array of the time points"""
-		return np.array(self.time)
+		return self.time.array()[:,0]
 		
 	def time0(self):
 		"""Get time0 as an ISO-8601 string"""
@@ -227,6 +359,72 @@ def _basetime(rTime):
 	sTz = time.strftime("%z",time.localtime(rTime))
 	return "%s%s"%(sTime, sTz)
 
+def _vmr_props(vmr):
+	"""Get the dataset properties for one sensor, values are pre-formatted
+	for output with strings in double quotes.
+
+	Returns (list): A list of (key, [value, ...]) tuples, one per row
+	"""
+	lCal = calib.to_props(vmr.calib)
+	lSeg = [('Nperseg', ['%d'%vmr.nperseg])] if vmr.nperseg else []
+	return [
+		('Dataset', ['"%s"'%vmr.sid]),
+		('Sensor',  ['"%s"'%vmr.dev_info]),
+		('UART',    ['"0x%04X"'%vmr.vid, '"0x%04X"'%vmr.pid, '"%s"'%vmr.serialno]),
+		('Port',    ['"%s"'%vmr.port]),
+		('Rate',    ['%.3f'%vmr.rate, '"[Hz]"']),
+		('Distance',['%.2f'%vmr.dist, '"[cm]"']),
+		lCal[0],    # x,y,z magnetometer offsets, varies by sensor type
+		('Epoch',   ['"%s"'%_basetime(vmr.time0)]),
+		('Role',    ['"%s"'%vmr.role]),
+		('Calibration', ['"%s"'%vmr.calib.source])
+	] + lCal[2:] + lSeg  # matrix and bias, then the segment length if set
+
+
+@profiling.timed('tlvmr.to_datasets')
+def to_datasets(lVMRs, sTitle=None, dProps=None):
+	"""Build the datasets for a set of VMR readings directly in memory
+
+	The output is the same as writing the readings with write_mag_vecs() and
+	reading the file back with semcsv.read(), without the round trip.  Time
+	offsets and field values are rounded to the precision used in the file
+	so that results match those from the saved data.
+
+	Args:
+		lVMRs (list,VMR): A list of VMR objects with data
+		sTitle (str): The title property
+		dProps (dict): A dictionary of extra properties, same as for
+			write_mag_vecs()
+
+	Returns: (dict, list)
+		(global_properties, datasets) as from semcsv.read()
+	"""
+	def _unquote(sVal):
+		if (len(sVal) > 1) and sVal.startswith('"') and sVal.endswith('"'):
+			return sVal[1:-1]
+		return sVal
+
+	dGlobal = {'Title': [sTitle.replace('"',"'") if sTitle else 'Mag Vectors']}
+	if dProps:
+		for key in sorted(dProps.keys()):
+			dGlobal[key.replace('"',"'")] = [dProps[key].replace('"',"'")]
+
+	lDs = []
+	for vmr in lVMRs:
+		dDsProps = {}
+		for (sKey, lVals) in _vmr_props(vmr):
+			dDsProps[sKey] = [_unquote(s) for s in lVals if s]
+
+		aVecs = np.round(vmr.cal_vectors(), 1)
+		lDs.append(semcsv.make_dataset(dDsProps, [
+			('Offset', 's', np.round(vmr.times(), 3)), ('Bx', 'nT', aVecs[:,0]),
+			('By', 'nT', aVecs[:,1]), ('Bz', 'nT', aVecs[:,2])
+		], aVecs.dtype))
+
+	return (dGlobal, lDs)
+
+
+@profiling.timed('tlvmr.write_mag_vecs')
 def write_mag_vecs(sFile, lVMRs, sTitle=None, dProps=None):
 	"""Save a set of VMR readings to a semantic CSV file
 	Args:
@@ -286,67 +484,47 @@ def write_mag_vecs(sFile, lVMRs, sTitle=None, dProps=None):
 		# Dataset Headers: fill by column
 		fOut.write(','*(nCols-1)+'\r\n')
 
-		tKeys = ('Dataset','Sensor','UART','Port','Rate','Distance','Offset_cm','Epoch','','') # rows
-		llHdrs = [ ['']*(nSensors*5) for n in range(len(tKeys)) ]     # Empty grid
+		# Dataset properties, values are pre-formatted, one row per key
+		llProps = [ _vmr_props(vmr) for vmr in lVMRs ]
+
+		nPropRows = len(llProps[0])
+		llHdrs = [ ['']*(nSensors*5) for n in range(nPropRows + 2) ]  # Empty grid
 
 		for i in range(nSensors):  # i = col index * 5, j = row index
-			vmr = lVMRs[i]
-			for j in range(len(tKeys)-2):         # Last two rows are empty for now
+			for j in range(nPropRows):   # Last two rows are a spacer and the header
+				(sKey, lVals) = llProps[i][j]
 				llHdrs[j][i*5]   = '"P"'           # Property
-				llHdrs[j][i*5+1] = '"%s"'%tKeys[j] # Sub hdrs
-
-			llHdrs[0][i*5 + 2] = '"%s"'%vmr.sid              # Dataset 
-
-			llHdrs[1][i*5 + 2] = '"%s"'%vmr.dev_info         # Sensor
-
-			llHdrs[2][i*5 + 2] = '"0x%04X"'%vmr.vid          # UART
-			llHdrs[2][i*5 + 3] = '"0x%04X"'%vmr.pid
-			llHdrs[2][i*5 + 4] = '"%s"'%vmr.serialno
-
-			llHdrs[3][i*5 + 2] = '"%s"'%vmr.port             # Port
-
-			llHdrs[4][i*5 + 2] = '%.3f'%vmr.rate             # Sampling rate
-			llHdrs[4][i*5 + 3] = '"[Hz]"'
-
-			llHdrs[5][i*5 + 2] = '%.2f'%vmr.dist             # Distance
-			llHdrs[5][i*5 + 3] = '"[cm]"'
-
-			llHdrs[6][i*5 + 2] = '1.025'                     # x,y,z magnetometer offests
-			llHdrs[6][i*5 + 3] = '0.0'                       # Varies by sensor type
-			llHdrs[6][i*5 + 4] = '0.475'                     # this is for Twinleaf VMR sensors
-
-			llHdrs[7][i*5 + 2] = '"%s"'%_basetime(vmr.time0) # Epoch
+				llHdrs[j][i*5+1] = '"%s"'%sKey     # Sub hdrs
+				for k in range(len(lVals)):
+					llHdrs[j][i*5 + 2 + k] = lVals[k]
 
 		for i in range(nSensors):
-			llHdrs[9][i*5]     = '"H"'
-			llHdrs[9][i*5 + 1] = '"Offset [s]"'
-			llHdrs[9][i*5 + 2] = '"Bx [nT]"' 
-			llHdrs[9][i*5 + 3] = '"By [nT]"'
-			llHdrs[9][i*5 + 4] = '"Bz [nT]"'
+			llHdrs[-1][i*5]     = '"H"'
+			llHdrs[-1][i*5 + 1] = '"Offset [s]"'
+			llHdrs[-1][i*5 + 2] = '"Bx [nT]"' 
+			llHdrs[-1][i*5 + 3] = '"By [nT]"'
+			llHdrs[-1][i*5 + 4] = '"Bz [nT]"'
 
 		# Dataset Headers: write by row
-		for j in range(len(tKeys)):
+		for j in range(len(llHdrs)):
 			fOut.write( "%s\r\n"%( ','.join( llHdrs[j])) )
 
-		# Saving data values
-		i = 0 # Sensor
-		nRow = 0
-		while True:
-			nRow += 1
-			nDone = 0
-			for i in range(nSensors):
-				vmr = lVMRs[i]
-				if nRow > len(vmr): nDone += 1
-
-			if nDone >= nSensors:  break # Stop condition
+		# Get all the data once, calibration is applied to the whole block
+		lTimes = [ vmr.times() for vmr in lVMRs ]
+		lVecs = [ vmr.cal_vectors() for vmr in lVMRs ]
 
-			# At least one still has data
+		# Saving data values
+		nRows = max([ len(aTime) for aTime in lTimes ])
+		for iRow in range(nRows):
 			for i in range(nSensors):
-				vmr = lVMRs[i]
 				if i > 0: fOut.write(',')
 
-				if nRow > len(vmr):  fOut.write(',,,,')
-				else:  fOut.write('"D",%.3f,%.1f,%.1f,%.1f'%vmr[nRow - 1])
+				if iRow >= len(lTimes[i]):  fOut.write(',,,,')
+				else:
+					aVec = lVecs[i][iRow]
+					fOut.write('"D",%.3f,%.1f,%.1f,%.1f'%(
+						lTimes[i][iRow], aVec[0], aVec[1], aVec[2]
+					))
 
 			fOut.write('\r\n')
 
@@ -0,0 +1,232 @@
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bootstrap / Monte Carlo uncertainty of the fitted dipole moment
+
+The covariance returned by curve_fit in calc.dipole_from_rotation comes from
+only 2 or 3 points and says nothing about the data quality or about how well
+the sensors were placed.  Here the whole analysis chain is re-run a few
+thousand times:
+
+  1. The Welch segments of each sensor's time series are resampled with
+     replacement, so noisy or unsteady runs produce a wider spread of
+     peak amplitudes.
+
+  2. Sensor distances and internal magnetometer offsets (Offset_cm) are
+     perturbed uniformly within the given tolerances.
+
+  3. The single parameter dipole fit is redone for every trial.  Since
+     calc.bmag_from_moment is linear in the moment, the least squares
+     solution has a closed form and all trials in a block are fit at once.
+
+Blocks of trials are spread across a process pool.  Each block gets its own
+child of a numpy SeedSequence, so a given seed yields the same answer no
+matter how many worker processes are used.
+"""
+
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+import magscreen.common as common
+import magscreen.calc as calc
+
+perr = sys.stderr.write  # shorten a long function name
+
+Uncertainty = namedtuple(
+	'Uncertainty', ['moment','lower','upper','prob_exceed','trials']
+)
+
+# Trials per work unit, fixed so that results do not depend on worker count
+_BLOCK_SZ = 250
+
+# ########################################################################## #
+
+def _segment_spectra(dataset):
+	"""Get the individual Welch segment power spectra for one sensor
+
+	Returns (ndarray):
+		A [3, n_freq, n_segment] array, the mean over the last axis is the
+		same power spectrum that calc.spectrum takes the square root of.
+	"""
+	from scipy import signal
+
+	rRate = dataset.require('rate')
+	lSxx = []
+	for sComp in ('Bx','By','Bz'):
+		aData = dataset.vars[sComp].data
+		nSegLen = dataset.nperseg or calc.g_nSegLen
+		if len(aData) < nSegLen: nSegLen = len(aData)
+
+		# Must match the welch() settings used in calc.spectrum
+		(aXf, aT, aSxx) = signal.spectrogram(
+			aData, rRate, window='flattop', nperseg=nSegLen,
+			noverlap=nSegLen//2, detrend='constant', scaling='spectrum',
+			mode='psd'
+		)
+		lSxx.append(aSxx)
+
+	return np.array(lSxx)
+
+
+def _sensor_geometry(dataset):
+	"""Get the nominal distance and magnetometer offsets in meters"""
+	if dataset.distance_units != '[cm]':
+		raise ValueError(
+			"General unit handling not implemented, 'Distance' property is " +\
+			"expected in units of centimeters [cm]."
+		)
+	rDist_m = dataset.require('distance') * 0.01
+	aOffset_m = dataset.require('offset_cm') * 0.01
+	return (rDist_m, aOffset_m)
+
+
+def _trial_block(lSxx, aDist_m, aOffset_m, rDistTol_m, rOffTol_m, nTrials, seed):
+	"""Run one block of trials, this is the process pool work unit.
+
+	Args:
+		lSxx (list[ndarray]): Segment spectra for each sensor, see
+			_segment_spectra()
+		aDist_m (ndarray): Nominal sensor distances, shape [S]
+		aOffset_m (ndarray): Nominal magnetometer offsets, shape [S, 3]
+		rDistTol_m (float): Distance tolerance, +/-
+		rOffTol_m (float): Offset tolerance, +/-
+		nTrials (int): Number of trials in this block
+		seed (np.random.SeedSequence): Seed for this block
+
+	Returns (ndarray):
+		The fitted moment for each trial, shape [nTrials]
+	"""
+	from scipy.constants import pi, mu_0
+
+	rng = np.random.default_rng(seed)
+	nSensors = len(lSxx)
+
+	aPeak_nT = np.empty((nSensors, 3, nTrials))
+	for i in range(nSensors):
+		aSxx = lSxx[i]
+		nSeg = aSxx.shape[2]
+
+		# Bootstrap by weight: multinomial counts are the same as drawing
+		# nSeg segments with replacement, but need only [T, nSeg] memory.
+		# The same draw is used for all 3 components of a sensor since they
+		# share the same disturbances.
+		aWeight = rng.multinomial(nSeg, np.full(nSeg, 1.0/nSeg), size=nTrials) / nSeg
+		aAmp = np.sqrt(aSxx @ aWeight.T)              # [3, F, T]
+		aPeak_nT[i] = aAmp.max(axis=1)                # [3, T]
+
+	aDist = aDist_m[:,None] + rng.uniform(-rDistTol_m, rDistTol_m, (nSensors, nTrials))
+	aOff = aOffset_m[:,:,None] + rng.uniform(-rOffTol_m, rOffTol_m, (nSensors, 3, nTrials))
+
+	# Same steps as calc.dipole_from_rotation, broadcast over trials
+	aB_nT = calc._dipole_adjust(aPeak_nT, aDist[:,None,:], aOff)
+	aMag_nT = np.sqrt(np.sum(aB_nT**2, axis=1))     # [S, T]
+	aAngleZ = np.arccos(aB_nT[:,2,:] / aMag_nT)
+	aAngleX = np.arccos(aB_nT[:,0,:] / aMag_nT)
+
+	aMoment = np.abs(calc.moment_from_bvec(aDist, aMag_nT*1e-9, aAngleZ, aAngleX))
+
+	# Linear least squares, B = k*m with k = mu_0 / (2 pi d^3)
+	aK = mu_0 / (2*pi*aDist**3)
+	return np.sum(aK*aK*aMoment, axis=0) / np.sum(aK*aK, axis=0)
+
+
+def moment_uncertainty(
+	lDsRaw, nTrials=4000, rConf=0.95, rDistTol_cm=0.05, rOffsetTol_cm=0.05,
+	rThreshold=0.05, nWorkers=None, nSeed=None, sRefMode='regress'
+):
+	"""Estimate the distribution of the fitted dipole moment
+
+	Args:
+		lDsRaw (list[semcsv.Dataset]): Raw datasets, with the same variables
+			and properties needed by calc.dipole_from_rotation
+
+		nTrials (int): The number of bootstrap trials to run
+
+		rConf (float): The confidence level of the returned interval
+
+		rDistTol_cm (float): Sensor distances are perturbed uniformly within
+			+/- this many centimeters.
+
+		rOffsetTol_cm (float): The Offset_cm values are perturbed uniformly
+			within +/- this many centimeters.
+
+		rThreshold (float): The moment limit in [N m T**-1], defaults to the
+			same 0.05 used by calc.stray_field_1m
+
+		nWorkers (int): The number of worker processes.  Defaults to the CPU
+			count, use 1 to run everything in this process.
+
+		nSeed (int): Seed for the random number generator.  If given, the
+			results are repeatable.
+
+		sRefMode (str): Ambient field rejection mode used when a reference
+			sensor is present, see calc.dipole_from_rotation()
+
+	Returns (Uncertainty):
+		A named tuple with the fields:
+
+		moment [N m T**-1]: The median trial moment
+		lower  [N m T**-1]: Lower bound of the confidence interval
+		upper  [N m T**-1]: Upper bound of the confidence interval
+		prob_exceed:        Fraction of trials with a moment above rThreshold
+		trials:             Array of the individual trial moments
+	"""
+	(lDsRaw, dsRef) = calc.split_reference(lDsRaw)
+	if (dsRef is not None) and sRefMode:
+		lDsRaw = calc.reject_ambient(lDsRaw, dsRef, sRefMode)
+
+	if len(lDsRaw) < 2:
+		raise ValueError("At least two datasets are required for a dipole fit")
+	if nTrials < 1:
+		raise ValueError("At least one trial is required")
+
+	lSxx = [ _segment_spectra(ds) for ds in lDsRaw ]
+	lGeom = [ _sensor_geometry(ds) for ds in lDsRaw ]
+	aDist_m = np.array([ t[0] for t in lGeom ])
+	aOffset_m = np.array([ t[1] for t in lGeom ])
+
+	lBlocks = [_BLOCK_SZ]*(nTrials // _BLOCK_SZ)
+	if nTrials % _BLOCK_SZ: lBlocks.append(nTrials % _BLOCK_SZ)
+	lSeeds = np.random.SeedSequence(nSeed).spawn(len(lBlocks))
+
+	tCommon = (lSxx, aDist_m, aOffset_m, rDistTol_cm*0.01, rOffsetTol_cm*0.01)
+
+	if nWorkers is None: nWorkers = os.cpu_count() or 1
+	nWorkers = min(nWorkers, len(lBlocks))
+
+	if nWorkers <= 1:
+		lOut = [
+			_trial_block(*tCommon, lBlocks[i], lSeeds[i]) for i in range(len(lBlocks))
+		]
+	else:
+		with common.process_pool(nWorkers) as pool:
+			lFut = [
+				pool.submit(_trial_block, *tCommon, lBlocks[i], lSeeds[i])
+				for i in range(len(lBlocks))
+			]
+			lOut = [ fut.result() for fut in lFut ]
+
+	aTrials = np.concatenate(lOut)
+
+	rTail = (1.0 - rConf) / 2.0
+	(rLo, rMed, rHi) = np.quantile(aTrials, [rTail, 0.5, 1.0 - rTail])
+	rProb = np.count_nonzero(aTrials > rThreshold) / len(aTrials)
+
+	return Uncertainty(rMed, rLo, rHi, rProb, aTrials)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare float32 and float64 data values for memory, speed and accuracy
+
+The example raw data file and synthetic captures of a rotating dipole, in a
+large ambient field and quantized to 0.1 nT as in a raw data file, are
+analyzed with both data types.  A case fails if the float32 dipole moment
+differs from the float64 one by more than the tolerance.
+
+Run from the top of the source tree:
+
+  python test/bench_dtype.py
+  python test/bench_dtype.py -d 60,3600 -r 50     # longer, faster captures
+
+Exit status is 0 if all cases pass, 1 otherwise.
+"""
+
+import sys
+import os
+import time
+import argparse
+
+import numpy as np
+
+perr = sys.stderr.write  # shorten a long function name
+
+g_sRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, g_sRoot)
+
+import magscreen.semcsv as semcsv
+import magscreen.calc as calc
+
+# Sensor distances in cm and the ambient field in nT, about what the bench sees
+g_lDist = [11.0, 15.0, 20.0]
+g_aAmbient = np.array([20000.0, -44000.0, 10000.0])
+
+def synthetic(rMoment, rDuration, rRate, dtype, nSeed=1):
+	"""Make the datasets for a part rotating at 0.25 Hz
+
+	Returns (list[semcsv.Dataset]):
+	"""
+	rng = np.random.default_rng(nSeed)
+	nPts = int(rDuration * rRate)
+	aTime = np.round(np.arange(nPts) / rRate + 1.0, 3)
+	aPhase = 2*np.pi*0.25*aTime
+
+	lDs = []
+	for i in range(len(g_lDist)):
+		rAmp = calc.bmag_from_moment(g_lDist[i]*0.01, rMoment) * 1e9
+		aB = np.empty((3, nPts))
+		aB[0] = rAmp*np.cos(aPhase)
+		aB[1] = rAmp*np.sin(aPhase)
+		aB[2] = 0.5*rAmp*np.cos(aPhase)
+		aB += g_aAmbient[:,None] + rng.normal(0.0, 0.5, aB.shape)
+		aB = np.round(aB, 1)
+
+		dProps = {
+			'Dataset':['%d'%i], 'UART':['0x0403', '0x6015', 'SYN%d'%i],
+			'Rate':['%.3f'%rRate, '[Hz]'], 'Distance':['%.2f'%g_lDist[i], '[cm]'],
+			'Offset_cm':['0.0', '0.0', '0.0']
+		}
+		lDs.append(semcsv.make_dataset(dProps, [
+			('Offset', 's', aTime), ('Bx', 'nT', aB[0]), ('By', 'nT', aB[1]),
+			('Bz', 'nT', aB[2])
+		], dtype))
+	return lDs
+
+def nbytes(lDs):
+	"""Memory held by the variable arrays"""
+	nBytes = 0
+	for ds in lDs:
+		if ds.block is not None: nBytes += ds.block.nbytes
+		for var in ds.vars.values():
+			if (ds.block is None) or (var.data.base is not ds.block):
+				nBytes += var.data.nbytes
+	return nBytes
+
+def run_case(sName, fnMake, rTol, nRepeat):
+	"""Analyze one case with both data types
+
+	Returns (bool): True if the float32 moment is within tolerance
+	"""
+	dOut = {}
+	for sType in ('float64', 'float32'):
+		lDs = fnMake(sType)
+		rBest = None
+		for n in range(nRepeat):
+			rStart = time.perf_counter()
+			ana = calc.analyze(lDs)
+			rTime = time.perf_counter() - rStart
+			if (rBest is None) or (rTime < rBest): rBest = rTime
+		dOut[sType] = (ana, nbytes(lDs), rBest, len(lDs[0].vars['Bx']))
+
+	(ana64, nB64, rT64, nPts) = dOut['float64']
+	(ana32, nB32, rT32, nPts) = dOut['float32']
+	rDiff = abs(ana32.moment - ana64.moment) / abs(ana64.moment)
+	bPass = (rDiff <= rTol) and (ana32.status == ana64.status)
+
+	print('%-22s %8d %9.1f %9.1f %8.1f %8.1f  %.6e  %.1e  %s'%(
+		sName, nPts, nB64/1024, nB32/1024, rT64*1000, rT32*1000, ana64.moment,
+		rDiff, 'ok' if bPass else 'FAIL'
+	))
+	return bPass
+
+def main():
+	psr = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	psr.add_argument('-d', '--durations', dest='sDur', default='20,600,3600',
+		help='Synthetic capture lengths in seconds, comma separated, '+\
+		'defaults to %(default)s.'
+	)
+	psr.add_argument('-r', '--rate', dest='rRate', type=float, default=20.0,
+		help='Synthetic sample rate in Hz, defaults to %(default)s.'
+	)
+	psr.add_argument('-m', '--moment', dest='rMoment', type=float, default=0.02,
+		help='Synthetic dipole moment in N m T^-1, defaults to %(default)s.'
+	)
+	psr.add_argument('-t', '--tol', dest='rTol', type=float, default=1e-4,
+		help='Largest allowed relative moment difference, defaults to %(default)s.'
+	)
+	psr.add_argument('-n', '--repeat', dest='nRepeat', type=int, default=3,
+		help='Analyze each case this many times and keep the fastest, '+\
+		'defaults to %(default)s.'
+	)
+	opts = psr.parse_args()
+
+	# The first fit pays for the scipy imports, keep that out of the timings
+	calc.analyze(synthetic(opts.rMoment, 20, opts.rRate, 'float64'))
+
+	print('%-22s %8s %9s %9s %8s %8s  %-12s  %-7s  %s'%(
+		'case', 'samples', 'f64 [kB]', 'f32 [kB]', 'f64 [ms]', 'f32 [ms]',
+		'moment', 'rel diff', 'result'
+	))
+
+	bPass = True
+	sFile = os.path.join(g_sRoot, 'test', 'screwdriver.csv')
+	bPass &= run_case(
+		'screwdriver.csv', lambda sType: semcsv.read(sFile, sType)[1],
+		opts.rTol, opts.nRepeat
+	)
+
+	for sDur in opts.sDur.split(','):
+		rDur = float(sDur)
+		bPass &= run_case(
+			'synthetic %.0f s'%rDur,
+			lambda sType: synthetic(opts.rMoment, rDur, opts.rRate, sType),
+			opts.rTol, opts.nRepeat
+		)
+
+	return 0 if bPass else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
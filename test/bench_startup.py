@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Check the import time of each console entry point against a budget
+
+Each entry point module is imported in a fresh interpreter under
+'python -X importtime' a few times and the fastest cumulative time is kept.
+An entry point fails if it is over budget, or if it loads any of the heavy
+packages that should only come in when they are needed.
+
+Run from the top of the source tree:
+
+  python test/bench_startup.py
+  python test/bench_startup.py -n 10 -s 2.0    # slow bench computer
+
+Exit status is 0 if all entry points pass, 1 otherwise.
+"""
+
+import sys
+import os
+import re
+import argparse
+import subprocess
+
+perr = sys.stderr.write  # shorten a long function name
+
+# (program, module, budget in ms, packages that must not load on import)
+#
+# numpy alone takes about 100 - 150 ms on a typical desktop, the budgets
+# leave room for that and little else.
+g_lEntries = [
+	('mag_screen',      'magscreen.screen',  350,
+		['matplotlib', 'scipy', 'serial', 'tldevice']),
+	('mag_screen_plot', 'magscreen.plot',    350, ['matplotlib', 'scipy']),
+	('mag_screen_sum',  'magscreen.summary', 350, ['matplotlib', 'scipy']),
+]
+
+# import time: self [us] | cumulative | imported package
+g_reLine = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+def import_profile(sModule, sRoot):
+	"""Import a module in a new interpreter
+
+	Returns (rTotal_ms, dCumulative):
+		The cumulative import time for sModule in milliseconds and a
+		dictionary of cumulative times in ms for all modules loaded.
+	"""
+	dEnv = dict(os.environ)
+	sPath = dEnv.get('PYTHONPATH', '')
+	dEnv['PYTHONPATH'] = sRoot + (os.pathsep + sPath if sPath else '')
+
+	proc = subprocess.run(
+		[sys.executable, '-X', 'importtime', '-c', 'import %s'%sModule],
+		stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=dEnv,
+		universal_newlines=True
+	)
+	if proc.returncode != 0:
+		raise RuntimeError("Importing %s failed:\n%s"%(sModule, proc.stderr))
+
+	dCum = {}
+	for sLine in proc.stderr.splitlines():
+		match = g_reLine.match(sLine)
+		if match: dCum[match.group(4)] = int(match.group(2)) / 1000.0
+
+	if sModule not in dCum:
+		raise RuntimeError("No import time reported for %s"%sModule)
+
+	return (dCum[sModule], dCum)
+
+
+def main():
+	psr = argparse.ArgumentParser()
+	psr.description = 'Check console entry point import times against budgets'
+
+	psr.add_argument(
+		'-n', '--repeat', dest='nRepeat', metavar='N', type=int, default=5,
+		help='Import each module N times and keep the fastest, default 5'
+	)
+	psr.add_argument(
+		'-s', '--scale', dest='rScale', metavar='X', type=float, default=1.0,
+		help='Multiply all budgets by X, for slow computers'
+	)
+	psr.add_argument(
+		'-v', '--verbose', dest='bVerbose', action='store_true', default=False,
+		help='List the slowest packages loaded by each entry point'
+	)
+	psr.add_argument(
+		'PROGRAM', nargs='*', help='Only check these programs, e.g. mag_screen'
+	)
+
+	opts = psr.parse_args()
+
+	sRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+	nFail = 0
+	print('%-16s %9s %9s  %s'%('Program', 'Time [ms]', 'Budget', 'Status'))
+	for (sProg, sModule, rBudget, lHeavy) in g_lEntries:
+		if opts.PROGRAM and (sProg not in opts.PROGRAM): continue
+
+		rBudget *= opts.rScale
+		rBest = None
+		dBest = None
+		try:
+			for i in range(max(opts.nRepeat, 1)):
+				(rTime, dCum) = import_profile(sModule, sRoot)
+				if (rBest is None) or (rTime < rBest):
+					(rBest, dBest) = (rTime, dCum)
+		except RuntimeError as exc:
+			print('%-16s %9s %9.1f  import failed'%(sProg, '-', rBudget))
+			perr("ERROR: %s\n"%exc.args[0].splitlines()[0])
+			nFail += 1
+			continue
+
+		lLoaded = [s for s in lHeavy if s in dBest]
+		lProblems = []
+		if rBest > rBudget: lProblems.append('over budget')
+		if lLoaded: lProblems.append('loads %s'%', '.join(lLoaded))
+
+		print('%-16s %9.1f %9.1f  %s'%(
+			sProg, rBest, rBudget, '; '.join(lProblems) if lProblems else 'ok'
+		))
+		if lProblems: nFail += 1
+
+		if opts.bVerbose:
+			lTop = sorted(
+				[(r, s) for (s, r) in dBest.items() if ('.' not in s) and not sModule.startswith(s)],
+				reverse=True
+			)[:8]
+			for (r, s) in lTop:
+				print('   %-24s %9.1f'%(s, r))
+
+	if nFail:
+		perr("ERROR: %d entry point(s) failed the startup check\n"%nFail)
+		return 1
+	return 0
+
+# Run the main function if this is a top level script
+if __name__ == "__main__":
+	sys.exit(main())
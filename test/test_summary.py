@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+# Copyright 2022 Chris Piker, Cole Dorman
+#
+# This file is part of magscreen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks for summary.SummaryWriter group commits
+
+Run from the top of the source tree with either of:
+
+  python -m unittest test/test_summary.py
+  python -m pytest test/test_summary.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import magscreen.summary as summary
+
+def _row(sPart):
+	return (sPart, '2022-06-01T12:00:00', 'tech', 'magscreen-test', 0.01, 2.0, 'PASSED', None)
+
+class TestSummaryWriter(unittest.TestCase):
+
+	def setUp(self):
+		self.sDir = tempfile.mkdtemp()
+		self.sFile = os.path.join(self.sDir, 'ScreenResults.csv')
+		self.writer = summary.SummaryWriter(self.sFile, bIndex=False)
+
+	def tearDown(self):
+		shutil.rmtree(self.sDir)
+
+	def _parts(self):
+		if not os.path.isfile(self.sFile): return []
+		with open(self.sFile) as fIn:
+			return [sLine.split(',')[0].strip('"') for sLine in fIn.readlines()[1:]]
+
+	def _write_together(self, lParts):
+		"""Queue rows from several threads so that one commit holds them all
+
+		Returns (dict): Part name to the exception raised by write(), or None
+		"""
+		dOut = {}
+		def _work(sPart):
+			try:
+				self.writer.write([_row(sPart)])
+				dOut[sPart] = None
+			except Exception as exc:
+				dOut[sPart] = exc
+
+		# Hold the commit lock until every thread has queued its row
+		self.writer.lockCommit.acquire()
+		lThreads = [threading.Thread(target=_work, args=(s,)) for s in lParts]
+		for th in lThreads: th.start()
+		rEnd = time.time() + 10
+		while (len(self.writer.lPending) < len(lParts)) and (time.time() < rEnd):
+			time.sleep(0.01)
+		self.writer.lockCommit.release()
+		for th in lThreads: th.join(10)
+		return dOut
+
+	def test_group_commit(self):
+		dOut = self._write_together(['A', 'B', 'C'])
+		self.assertEqual(dOut, {'A':None, 'B':None, 'C':None})
+		self.assertEqual(sorted(self._parts()), ['A', 'B', 'C'])
+
+	def test_failed_commit_raises_for_every_writer(self):
+		fnCommit = self.writer._commit
+		lCalls = []
+		def _fail_once(lRows):
+			lCalls.append(len(lRows))
+			if len(lCalls) == 1: raise OSError(28, 'No space left on device')
+			return fnCommit(lRows)
+		self.writer._commit = _fail_once
+
+		dOut = self._write_together(['A', 'B'])
+		self.assertEqual(lCalls, [2])   # Both rows were in the one commit
+		self.assertIsInstance(dOut['A'], OSError)
+		self.assertIsInstance(dOut['B'], OSError)
+		self.assertEqual(self._parts(), [])
+		self.assertEqual(self.writer.lFailed, [])
+
+		# Later writes are not affected
+		self.writer.write([_row('C')])
+		self.assertEqual(self._parts(), ['C'])
+
+if __name__ == '__main__':
+	unittest.main()